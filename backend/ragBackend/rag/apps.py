@@ -1,6 +1,39 @@
+import logging
+import os
+import sys
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _is_serving_process() -> bool:
+    """Skip warm-up for management commands and the runserver reloader parent"""
+    if len(sys.argv) > 1 and os.path.basename(sys.argv[0]) == "manage.py":
+        if sys.argv[1] != "runserver":
+            return False
+        return "--noreload" in sys.argv or os.environ.get("RUN_MAIN") == "true"
+    return True
+
+
+def _warm_up() -> None:
+    from .services.rag import RAGService
+    from .services.registry import registry
+
+    try:
+        registry.warm_up()
+        RAGService(registry).warm_up()
+    except Exception:
+        logger.exception("Error warming up RAG models")
 
 
 class RagConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'rag'
+
+    def ready(self):
+        if getattr(settings, "RAG_WARMUP_ON_STARTUP", False) and _is_serving_process():
+            # Load the models in the background so startup isn't blocked
+            threading.Thread(target=_warm_up, name="rag-warmup", daemon=True).start()
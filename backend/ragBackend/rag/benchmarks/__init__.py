@@ -0,0 +1,30 @@
+"""Performance benchmarks, run with ``python manage.py benchmark <name>``
+
+Each benchmark module exposes ``help``, ``add_arguments(parser)`` and
+``run(options) -> dict``; the returned dict is printed as JSON. Pass
+``--output`` to save it and ``--baseline`` to fail on regressions against an
+earlier saved run (see ``compare``).
+"""
+from . import (
+    batch,
+    embedding,
+    end_to_end,
+    ingest_memory,
+    mmr,
+    retrieval,
+    scheduler,
+    serving,
+    vector_store,
+)
+
+BENCHMARKS = {
+    "batch": batch,
+    "embedding": embedding,
+    "end_to_end": end_to_end,
+    "ingest_memory": ingest_memory,
+    "mmr": mmr,
+    "retrieval": retrieval,
+    "scheduler": scheduler,
+    "serving": serving,
+    "vector_store": vector_store,
+}
@@ -0,0 +1,106 @@
+"""Nightly-job style question sets: one query at a time against ``query_batch``
+
+A synthetic PDF is indexed on fake models, then the same questions (some
+repeated, as real question sets are) are answered twice with the answer
+cache off: through ``RAGService.query``, one call per question as a client
+looping over the query endpoint would, and through ``query_batch``.
+Preparation (embedding, retrieval, prompt packing) is timed on its own too,
+since that is the part the batch shares.
+"""
+import tempfile
+import time
+from typing import Any, Dict
+
+from django.test.utils import override_settings
+
+from .end_to_end import _ingest, _make_queries
+from .synthetic import write_pdf
+
+help = "Questions/sec answering a question set one query at a time and as one batch"
+
+
+def add_arguments(parser):
+    parser.add_argument("--pages", type=int, default=200, help="Pages of the synthetic PDF")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument(
+        "--repeats", type=float, default=0.1, help="Share of questions asked twice"
+    )
+    parser.add_argument("--mode", default="hybrid", choices=["vector", "keyword", "hybrid"])
+    parser.add_argument("--slots", type=int, default=1, help="LLM slots")
+    parser.add_argument("--concurrency", type=int, default=4, help="Batch generations in flight")
+    parser.add_argument("--token-ms", type=float, default=0, help="Fake decode time per token")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def _rate(count: int, seconds: float) -> float:
+    return round(count / seconds, 1)
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    from ..services.chroma_db import ChromaDBService
+    from ..services.rag import RAGService
+    from ..services.registry import ModelRegistry
+
+    questions = _make_queries(options["questions"], options["pages"], options["seed"])
+    repeated = int(len(questions) * options["repeats"])
+    questions = questions[: len(questions) - repeated] + questions[:repeated]
+    mode = options["mode"]
+
+    with override_settings(
+        RAG_EMBEDDING_CACHE_DIR="",
+        RAG_TEXT_CACHE_DIR="",
+        RAG_QUERY_EMBEDDING_CACHE_SIZE=0,
+        RAG_LLM_SLOTS=options["slots"],
+        RAG_LLM_QUEUE_LIMIT=max(16, 2 * options["concurrency"]),
+        RAG_FAKE_LLM_TOKEN_MS=options["token_ms"],
+    ), tempfile.TemporaryDirectory() as directory:
+        registry = ModelRegistry(base_dir=directory)
+        registry.set_backend("fake")
+        chroma = ChromaDBService(registry)
+        name = "synthetic.pdf"
+        file_path = write_pdf(f"{directory}/{name}", options["pages"], seed=options["seed"])
+        _ingest(chroma, file_path, name, window=64)
+
+        rag = RAGService(registry)
+        # Load the scheduler and keyword index outside the measurement
+        rag.query(questions[0], use_cache=False, mode=mode)
+
+        start = time.perf_counter()
+        for question in questions:
+            rag.prepare_query(question, use_cache=False, mode=mode)
+        prepare_single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rag.prepare_queries(questions, use_cache=False, mode=mode)
+        prepare_batch = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for question in questions:
+            rag.query(question, use_cache=False, mode=mode)
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        events = list(
+            rag.query_batch(
+                questions, use_cache=False, mode=mode, concurrency=options["concurrency"]
+            )
+        )
+        batch = time.perf_counter() - start
+        registry.teardown()
+
+    stats = events[-1]["data"]
+    return {
+        "backend": "fake",
+        "questions": len(questions),
+        "mode": mode,
+        "token_ms": options["token_ms"],
+        "prepare": {
+            "single_questions_per_sec": _rate(len(questions), prepare_single),
+            "batch_questions_per_sec": _rate(len(questions), prepare_batch),
+        },
+        "answer": {
+            "single_questions_per_sec": _rate(len(questions), single),
+            "batch_questions_per_sec": _rate(len(questions), batch),
+        },
+        "batch_stats": stats,
+    }
@@ -0,0 +1,70 @@
+"""Compare a benchmark result against a stored baseline
+
+Metrics are told apart by their names: ``*_per_sec`` and ``recall*`` are
+better when higher, ``*_ms``, ``*_seconds``/``seconds`` and ``*_mb`` when
+lower. Anything else (counts, settings, speedup ratios) is not compared.
+Latencies that moved by less than ``MIN_DELTA_MS`` are noise, whatever the
+relative change.
+"""
+from typing import Any, Dict, List, Optional
+
+HIGHER_IS_BETTER = ("_per_sec", "recall")
+LOWER_IS_BETTER = ("_ms", "seconds", "_mb")
+
+MIN_DELTA_MS = 1.0
+
+
+def flatten(result: Any, prefix: str = "") -> Dict[str, float]:
+    """Numeric leaves of a nested result, keyed by their dotted path"""
+    if isinstance(result, dict):
+        items = result.items()
+    elif isinstance(result, list):
+        items = enumerate(result)
+    else:
+        if isinstance(result, (int, float)) and not isinstance(result, bool):
+            return {prefix: float(result)}
+        return {}
+
+    values = {}
+    for key, value in items:
+        values.update(flatten(value, f"{prefix}.{key}" if prefix else str(key)))
+    return values
+
+
+def direction(key: str) -> Optional[int]:
+    """+1 if a higher value is better, -1 if lower is, None if not a metric"""
+    name = key.rsplit(".", 1)[-1]
+    if any(marker in name for marker in HIGHER_IS_BETTER):
+        return 1
+    if name.endswith(LOWER_IS_BETTER):
+        return -1
+    return None
+
+
+def compare(
+    result: Dict[str, Any], baseline: Dict[str, Any], threshold: float
+) -> List[Dict[str, Any]]:
+    """Metrics present in both runs that got worse by more than ``threshold``
+
+    :param threshold: Allowed relative change, e.g. 0.15 for 15%
+    """
+    current, previous = flatten(result), flatten(baseline)
+    regressions = []
+    for key in sorted(current.keys() & previous.keys()):
+        sign = direction(key)
+        if sign is None or not previous[key]:
+            continue
+        delta = current[key] - previous[key]
+        if key.endswith("_ms") and abs(delta) < MIN_DELTA_MS:
+            continue
+        change = delta / abs(previous[key])
+        if -sign * change > threshold:
+            regressions.append(
+                {
+                    "metric": key,
+                    "baseline": previous[key],
+                    "current": current[key],
+                    "change": round(change, 3),
+                }
+            )
+    return regressions
@@ -0,0 +1,108 @@
+"""Throughput of the batched embedding engine against a fake or local model"""
+import random
+import statistics
+import threading
+import time
+from typing import Any, Dict, List
+
+from ..services.embedding import EmbeddingService, get_embeddings
+from ..services.fakes import PaddedFakeEmbeddings
+
+help = "Document and query embedding throughput (bucketing, micro-batching)"
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod".split()
+
+
+def add_arguments(parser):
+    parser.add_argument("--model", choices=["fake", "local"], default="fake")
+    parser.add_argument("--texts", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--queries", type=int, default=50, help="Queries per thread")
+    parser.add_argument("--window-ms", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def make_texts(count: int, seed: int = 0) -> List[str]:
+    """Chunks with a long-tailed length distribution, like real PDF chunks"""
+    rng = random.Random(seed)
+    lengths = [min(300, max(3, int(rng.lognormvariate(4, 0.8)))) for _ in range(count)]
+    return [" ".join(rng.choice(WORDS) for _ in range(n)) for n in lengths]
+
+
+def _documents_per_second(service: EmbeddingService, texts: List[str]) -> float:
+    start = time.perf_counter()
+    service.embed_documents(texts)
+    return len(texts) / (time.perf_counter() - start)
+
+
+def _queries(embed, threads: int, per_thread: int, texts: List[str]) -> Dict[str, float]:
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(offset):
+        local = []
+        for i in range(per_thread):
+            start = time.perf_counter()
+            embed(texts[(offset * per_thread + i) % len(texts)])
+            local.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "queries_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 2),
+    }
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    model = PaddedFakeEmbeddings() if options["model"] == "fake" else get_embeddings()
+    texts = make_texts(options["texts"], options["seed"])
+    batch_size = options["batch_size"]
+
+    unbucketed = EmbeddingService(
+        model, batch_size=batch_size, bucket_by_length=False, micro_batch_window_ms=0
+    )
+    bucketed = EmbeddingService(model, batch_size=batch_size, micro_batch_window_ms=0)
+    micro_batched = EmbeddingService(
+        model, batch_size=batch_size, micro_batch_window_ms=options["window_ms"]
+    )
+
+    try:
+        unbucketed_rate = _documents_per_second(unbucketed, texts)
+        bucketed_rate = _documents_per_second(bucketed, texts)
+
+        queries = texts[:500]
+        direct = _queries(model.embed_query, options["threads"], options["queries"], queries)
+        batched = _queries(
+            micro_batched.embed_query, options["threads"], options["queries"], queries
+        )
+    finally:
+        micro_batched.close()
+
+    return {
+        "model": options["model"],
+        "texts": len(texts),
+        "batch_size": batch_size,
+        "documents": {
+            "unbucketed_per_sec": round(unbucketed_rate, 1),
+            "bucketed_per_sec": round(bucketed_rate, 1),
+            "speedup": round(bucketed_rate / unbucketed_rate, 2),
+        },
+        "queries": {
+            "threads": options["threads"],
+            "direct": direct,
+            "micro_batched": batched,
+            "speedup": round(batched["queries_per_sec"] / direct["queries_per_sec"], 2),
+        },
+    }
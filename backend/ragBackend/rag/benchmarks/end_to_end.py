@@ -0,0 +1,150 @@
+"""Ingestion throughput and query latency through the services, on fake models
+
+Synthetic PDFs go through the streaming ingestion path (parse, split,
+embed, upsert) into a Chroma in a temporary directory. Client threads then
+run full queries against it (query embedding, hybrid retrieval, prompt
+packing and generation on fake LLM slots) with the answer cache off. Stage
+breakdowns come from the request traces, to show where a regression is.
+"""
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from django.test.utils import override_settings
+
+from .synthetic import WORDS, write_pdf
+
+help = "Ingest pages/sec and chunks/sec, query p50/p95/p99 and QPS with fake models"
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--pages", type=int, nargs="+", default=[10, 50, 200], help="Pages per synthetic PDF"
+    )
+    parser.add_argument("--window", type=int, default=64, help="Chunks per embed/upsert window")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--slots", type=int, default=1, help="LLM slots")
+    parser.add_argument("--token-ms", type=float, default=0, help="Fake decode time per token")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _mean_stages(traces: List[Dict[str, float]]) -> Dict[str, float]:
+    stages = sorted({stage for trace in traces for stage in trace})
+    return {
+        f"{stage}_ms": round(sum(trace.get(stage, 0.0) for trace in traces) / len(traces), 2)
+        for stage in stages
+    }
+
+
+def _ingest(chroma, file_path: str, name: str, window: int) -> Dict[str, Any]:
+    from ..services import tracing
+    from ..services.ingestion import _windows
+    from ..services.pdf import PDFProcessor
+
+    pages, chunks = 0, 0
+    start = time.perf_counter()
+    with tracing.collect() as stages:
+        for batch in _windows(PDFProcessor().iter_chunks(file_path, name), window):
+            vectors = chroma.embeddings.embed_documents([c.page_content for c in batch])
+            chroma.upsert_embeddings(
+                batch, vectors, [f"{name}-{c.metadata['chunk_id']}" for c in batch]
+            )
+            pages = batch[-1].metadata.get("total_pages", pages)
+            chunks += len(batch)
+        chroma.commit()
+    seconds = time.perf_counter() - start
+
+    return {
+        "pages": pages,
+        "chunks": chunks,
+        "seconds": round(seconds, 3),
+        "pages_per_sec": round(pages / seconds, 1),
+        "chunks_per_sec": round(chunks / seconds, 1),
+        "stages": _mean_stages([stages]),
+    }
+
+
+def _make_queries(count: int, pages: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        f"What does page {rng.randrange(pages)} say about "
+        + " ".join(rng.choice(WORDS) for _ in range(3))
+        for _ in range(count)
+    ]
+
+
+def _query_load(rag, queries: List[str], concurrency: int) -> Dict[str, Any]:
+    latencies, traces = [], []
+
+    def one(query_text):
+        start = time.perf_counter()
+        result = rag.query(query_text, use_cache=False, trace=True)
+        latencies.append((time.perf_counter() - start) * 1000)
+        traces.append(result["trace"])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, queries))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "queries": len(latencies),
+        "concurrency": concurrency,
+        "queries_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(_percentile(latencies, 0.95), 2),
+        "p99_ms": round(_percentile(latencies, 0.99), 2),
+        "stages": _mean_stages(traces),
+    }
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    # Imported here: the benchmarks package must import without Django set up
+    from ..services.chroma_db import ChromaDBService
+    from ..services.rag import RAGService
+    from ..services.registry import ModelRegistry
+
+    # Keep benchmark vectors and text out of the real caches
+    with override_settings(
+        RAG_EMBEDDING_CACHE_DIR="",
+        RAG_TEXT_CACHE_DIR="",
+        RAG_LLM_SLOTS=options["slots"],
+        RAG_LLM_QUEUE_LIMIT=options["concurrency"],
+        RAG_FAKE_LLM_TOKEN_MS=options["token_ms"],
+    ), tempfile.TemporaryDirectory() as directory:
+        registry = ModelRegistry(base_dir=directory)
+        registry.set_backend("fake")
+        chroma = ChromaDBService(registry)
+        # Open the store outside the measurement
+        chroma.get_vectorstore()
+        chroma.keyword_index
+
+        ingest = {}
+        for pages in options["pages"]:
+            name = f"synthetic-{pages}.pdf"
+            file_path = write_pdf(f"{directory}/{name}", pages, seed=options["seed"])
+            ingest[f"{pages}_pages"] = _ingest(chroma, file_path, name, options["window"])
+
+        rag = RAGService(registry)
+        queries = _make_queries(options["queries"], max(options["pages"]), options["seed"])
+        # Load the scheduler and keyword index outside the measurement
+        rag.query(queries[0], use_cache=False)
+        query = _query_load(rag, queries, options["concurrency"])
+        registry.teardown()
+
+    return {
+        "backend": "fake",
+        "llm_slots": options["slots"],
+        "token_ms": options["token_ms"],
+        "ingest": ingest,
+        "query": query,
+    }
@@ -0,0 +1,87 @@
+"""Peak memory of eager vs streamed PDF ingestion as documents grow
+
+Each measurement runs in a fresh process so peak RSS readings don't leak
+between runs. Vectors are discarded instead of upserted, so the numbers
+cover parsing, splitting and embedding only.
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict
+
+from .synthetic import write_pdf
+
+help = "Peak RSS of eager vs streaming PDF ingestion against page count"
+
+
+def add_arguments(parser):
+    parser.add_argument("--pages", type=int, nargs="+", default=[50, 200, 800, 2000])
+    parser.add_argument("--window", type=int, default=64, help="Chunks per streamed window")
+    parser.add_argument("--model", choices=["fake", "local"], default="fake")
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _measure(mode: str, file_path: str, window: int, model: str) -> Dict[str, Any]:
+    """Ingest one file in this (fresh) process and report its memory use"""
+    import django
+
+    django.setup()
+
+    from ..services.embedding import EmbeddingService, get_embeddings
+    from ..services.fakes import FakeEmbeddings
+    from ..services.ingestion import _windows
+    from ..services.pdf import PDFProcessor
+
+    processor = PDFProcessor()
+    # Measure parsing, not reads of earlier runs' text
+    processor.text_cache = None
+    service = EmbeddingService(
+        FakeEmbeddings() if model == "fake" else get_embeddings(), micro_batch_window_ms=0
+    )
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+
+    if mode == "eager":
+        chunks = processor.process_pdf(file_path)["chunks"]
+        vectors = service.embed_documents([c.page_content for c in chunks])
+        count = len(vectors)
+    else:
+        count = 0
+        for batch in _windows(processor.iter_chunks(file_path), window):
+            service.embed_documents([c.page_content for c in batch])
+            count += len(batch)
+
+    peak = _peak_rss_mb()
+    return {
+        "chunks": count,
+        "seconds": round(time.perf_counter() - start, 2),
+        "peak_rss_mb": round(peak, 1),
+        "growth_mb": round(peak - baseline, 1),
+    }
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for pages in options["pages"]:
+            file_path = write_pdf(os.path.join(directory, f"{pages}.pdf"), pages)
+            row = {"pages": pages, "file_mb": round(os.path.getsize(file_path) / 2**20, 1)}
+            for mode in ("eager", "streaming"):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    row[mode] = pool.submit(
+                        _measure, mode, file_path, options["window"], options["model"]
+                    ).result()
+            results.append(row)
+
+    return {"model": options["model"], "window": options["window"], "results": results}
@@ -0,0 +1,130 @@
+"""MMR selection: LangChain's Chroma path against the vectorized stage in rag.py
+
+The LangChain path asks Chroma for ``fetch_k`` candidates with their
+embeddings and picks ``k`` of them with ``maximal_marginal_relevance`` from
+langchain_chroma, which recomputes similarities to the picked rows on every
+step. The vectorized path runs the same Chroma query and picks with
+``services.mmr``. Both are timed end to end and for the selection alone, and
+must pick the same chunks. Query embedding is timed cold and cached.
+"""
+import statistics
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from django.test.utils import override_settings
+
+from .vector_store import make_vectors
+
+help = "Latency of LangChain's MMR against the vectorized MMR stage, and the query cache"
+
+
+def add_arguments(parser):
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--fetch-k", type=int, nargs="+", default=[20, 100, 500])
+    parser.add_argument("--lambda-mult", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def _p50(latencies: List[float]) -> float:
+    return round(statistics.median(latencies), 3)
+
+
+def _timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def _query_cache(service, queries: int) -> Dict[str, float]:
+    """embed_query p50 for new questions and for repeats (spacing differs)"""
+    texts = [f"what does error code {i} mean" for i in range(queries)]
+    cold = [_timed(service.embed_query, text)[1] for text in texts]
+    cached = [_timed(service.embed_query, f"  {text} ")[1] for text in texts]
+    return {"cold_p50_ms": _p50(cold), "cached_p50_ms": _p50(cached)}
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    from langchain_chroma.vectorstores import maximal_marginal_relevance as langchain_mmr
+
+    from ..services.mmr import maximal_marginal_relevance
+    from ..services.registry import ModelRegistry
+
+    corpus, probes = make_vectors(
+        options["vectors"], options["dim"], options["queries"], options["seed"]
+    )
+    k, lambda_mult = options["k"], options["lambda_mult"]
+    results: Dict[str, Any] = {}
+
+    chroma = override_settings(RAG_VECTOR_BACKEND="chroma")
+    with chroma, tempfile.TemporaryDirectory() as directory:
+        registry = ModelRegistry(base_dir=directory)
+        registry.set_backend("fake")
+        vectorstore = registry.get_vectorstore()
+        collection = vectorstore._collection
+        for offset in range(0, len(corpus), 500):
+            rows = range(offset, min(offset + 500, len(corpus)))
+            collection.upsert(
+                ids=[str(i) for i in rows],
+                embeddings=corpus[offset : offset + 500].tolist(),
+                documents=[f"chunk {i}" for i in rows],
+                metadatas=[{"chunk_id": i} for i in rows],
+            )
+
+        for fetch_k in options["fetch_k"]:
+            langchain, vectorized, langchain_select, vectorized_select = [], [], [], []
+            mismatches = 0
+            for probe in probes:
+                vector = probe.tolist()
+                docs, elapsed = _timed(
+                    vectorstore.max_marginal_relevance_search_by_vector,
+                    vector,
+                    k=k,
+                    fetch_k=fetch_k,
+                    lambda_mult=lambda_mult,
+                )
+                langchain.append(elapsed)
+
+                start = time.perf_counter()
+                found = collection.query(
+                    query_embeddings=[vector],
+                    n_results=fetch_k,
+                    include=["documents", "metadatas", "embeddings"],
+                )
+                selected, select_elapsed = _timed(
+                    maximal_marginal_relevance, vector, found["embeddings"][0], k, lambda_mult
+                )
+                picked = [found["metadatas"][0][i]["chunk_id"] for i in sorted(selected)]
+                vectorized.append((time.perf_counter() - start) * 1000)
+                vectorized_select.append(select_elapsed)
+
+                candidates = np.asarray(found["embeddings"][0], dtype=np.float32)
+                _, elapsed = _timed(
+                    langchain_mmr, probe, candidates, k=k, lambda_mult=lambda_mult
+                )
+                langchain_select.append(elapsed)
+                mismatches += picked != [doc.metadata["chunk_id"] for doc in docs]
+
+            results[f"fetch_k={fetch_k}"] = {
+                "langchain_p50_ms": _p50(langchain),
+                "vectorized_p50_ms": _p50(vectorized),
+                "langchain_select_p50_ms": _p50(langchain_select),
+                "vectorized_select_p50_ms": _p50(vectorized_select),
+                "mismatched_queries": mismatches,
+            }
+
+        embedding = _query_cache(registry.get_embeddings(), options["queries"])
+        registry.teardown()
+
+    return {
+        "vectors": options["vectors"],
+        "dim": options["dim"],
+        "queries": options["queries"],
+        "k": k,
+        "mmr": results,
+        "embed_query": embedding,
+    }
@@ -0,0 +1,117 @@
+"""Recall and latency of vector, keyword and hybrid retrieval on a synthetic corpus
+
+Every chunk carries a unique error code. "code" queries ask about that
+code, the case pure embedding search handles worst; "passage" queries
+quote a stretch of the chunk's prose. The corpus lives in a temporary
+directory with its own Chroma and keyword index.
+"""
+import random
+import statistics
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+from django.test.utils import override_settings
+from langchain.schema import Document
+
+help = "Recall@k and latency of vector, keyword and hybrid retrieval"
+
+
+def add_arguments(parser):
+    parser.add_argument("--model", choices=["fake", "local"], default="fake")
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def make_corpus(count: int, seed: int = 0) -> Tuple[List[Document], List[Tuple[str, str, int]]]:
+    """Chunks with one unique error code each, plus (kind, query, chunk) probes"""
+    rng = random.Random(seed)
+    vocabulary = [
+        "".join(rng.choice("bcdfghklmnprstvz") + rng.choice("aeiou") for _ in range(3))
+        for _ in range(3000)
+    ]
+    chunks, codes = [], rng.sample(range(10000, 99999), count)
+    for i, code in enumerate(codes):
+        words = [rng.choice(vocabulary) for _ in range(120)]
+        words.insert(rng.randrange(len(words)), f"ERR-{code}")
+        chunks.append(
+            Document(
+                page_content=" ".join(words),
+                metadata={"source": "synthetic.pdf", "name": "synthetic.pdf", "chunk_id": i},
+            )
+        )
+
+    probes = []
+    for i in rng.sample(range(count), min(count, 2 * max(1, count // 20))):
+        words = chunks[i].page_content.split()
+        start = rng.randrange(len(words) - 12)
+        if len(probes) % 2:
+            probes.append(("code", f"What does error ERR-{codes[i]} mean?", i))
+        else:
+            probes.append(("passage", " ".join(words[start : start + 12]), i))
+    return chunks, probes
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    # Imported here: the benchmarks package must import without Django set up
+    from ..services.chroma_db import ChromaDBService
+    from ..services.rag import RETRIEVAL_MODES, RAGService
+    from ..services.registry import ModelRegistry
+
+    chunks, probes = make_corpus(options["chunks"], options["seed"])
+    probes = probes[: options["queries"]]
+    k = 10
+
+    # Keep benchmark vectors out of the real embedding cache
+    with override_settings(
+        RAG_EMBEDDING_CACHE_DIR="", RAG_EMBEDDING_MICRO_BATCH_MS=0
+    ), tempfile.TemporaryDirectory() as directory:
+        registry = ModelRegistry(base_dir=directory)
+        registry.set_backend("fake" if options["model"] == "fake" else "default")
+        chroma = ChromaDBService(registry)
+
+        start = time.perf_counter()
+        for offset in range(0, len(chunks), 500):
+            batch = chunks[offset : offset + 500]
+            vectors = chroma.embeddings.embed_documents([c.page_content for c in batch])
+            chroma.upsert_embeddings(batch, vectors, [str(c.metadata["chunk_id"]) for c in batch])
+        chroma.commit()
+        index_seconds = time.perf_counter() - start
+
+        rag = RAGService(registry)
+        query_vectors = chroma.embeddings.embed_documents([query for _, query, _ in probes])
+
+        results = {}
+        for mode in RETRIEVAL_MODES:
+            latencies, hits = [], {"code": [], "passage": []}
+            for (kind, query, target), vector in zip(probes, query_vectors):
+                start = time.perf_counter()
+                docs = rag.retrieve(query, vector, mode)
+                latencies.append((time.perf_counter() - start) * 1000)
+                found = {doc.metadata.get("chunk_id") for doc in docs[:k]}
+                hits[kind].append(target in found)
+
+            results[mode] = {
+                **{
+                    f"recall@{k}_{kind}": round(statistics.mean(values), 3)
+                    for kind, values in hits.items()
+                    if values
+                },
+                "p50_ms": round(statistics.median(latencies), 2),
+                "p95_ms": round(_percentile(latencies, 0.95), 2),
+            }
+        registry.teardown()
+
+    return {
+        "model": options["model"],
+        "chunks": len(chunks),
+        "queries": len(probes),
+        "index_seconds": round(index_seconds, 2),
+        "modes": results,
+    }
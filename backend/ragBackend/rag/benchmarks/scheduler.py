@@ -0,0 +1,85 @@
+"""Load test of the LLM scheduler against fake model slots
+
+Client threads submit generations as fast as they are served. A rejected
+request (queue full) backs off briefly and counts as a rejection. Some
+prompts repeat, so identical queued requests can share a generation.
+"""
+import random
+import statistics
+import threading
+import time
+from typing import Any, Dict
+
+from ..services.fakes import FakeLLM, FakeLlamaClient
+from ..services.llm import LLMQueueFull, LLMScheduler
+
+help = "Throughput, latency and rejections of the LLM scheduler under load"
+
+
+def add_arguments(parser):
+    parser.add_argument("--slots", type=int, default=1)
+    parser.add_argument("--queue", type=int, default=16, help="Queue limit")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=10, help="Requests per client")
+    parser.add_argument("--tokens", type=int, default=32, help="Tokens per answer")
+    parser.add_argument("--token-ms", type=float, default=2, help="Fake decode time per token")
+    parser.add_argument("--distinct", type=int, default=50, help="Distinct prompts")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def _percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    llms = [
+        FakeLLM(
+            client=FakeLlamaClient(),
+            max_tokens=options["tokens"],
+            token_delay=options["token_ms"] / 1000,
+        )
+        for _ in range(options["slots"])
+    ]
+    scheduler = LLMScheduler(llms, max_queue=options["queue"])
+    latencies, rejected = [], []
+    lock = threading.Lock()
+
+    def client(index):
+        rng = random.Random(options["seed"] + index)
+        local, rejections = [], 0
+        for _ in range(options["requests"]):
+            prompt = f"question {rng.randrange(options['distinct'])}"
+            start = time.perf_counter()
+            while True:
+                try:
+                    scheduler.generate(prompt)
+                    break
+                except LLMQueueFull:
+                    rejections += 1
+                    time.sleep(0.05)
+            local.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(local)
+            rejected.append(rejections)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(options["clients"])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    metrics = scheduler.metrics()
+    scheduler.close()
+    return {
+        "slots": options["slots"],
+        "clients": options["clients"],
+        "requests": len(latencies),
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 1),
+        "p95_ms": round(_percentile(latencies, 0.95), 1),
+        "rejections": sum(rejected),
+        "scheduler": metrics,
+    }
@@ -0,0 +1,189 @@
+"""Requests/sec and tail latency of the WSGI and ASGI deployments under load
+
+Each deployment runs in its own process on the fake models, serving a small
+synthetic corpus from a temporary directory. WSGI is a server with a fixed
+pool of worker threads (like gunicorn's gthread worker); ASGI is uvicorn
+with the async views. Part of the load repeats one question with the
+answer cache on, modelling cheap requests that arrive behind slow
+generations.
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+
+help = "Requests/sec and p99 latency of the WSGI vs ASGI deployment with fake models"
+
+
+def add_arguments(parser):
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=8, help="WSGI worker threads")
+    parser.add_argument("--slots", type=int, default=4, help="LLM slots")
+    parser.add_argument("--token-ms", type=float, default=5, help="Fake decode time per token")
+    parser.add_argument("--cached-ratio", type=float, default=0.5)
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _serve(kind: str, port: int, base_dir: str, options: Dict[str, Any]) -> None:
+    """Run one deployment in this (fresh) process until it is terminated"""
+    os.environ.update(
+        RAG_MODEL_BACKEND="fake",
+        RAG_WARMUP_ON_STARTUP="0",
+        RAG_EMBEDDING_CACHE_DIR="",
+        RAG_FAKE_LLM_TOKEN_MS=str(options["token_ms"]),
+        RAG_LLM_SLOTS=str(options["slots"]),
+        RAG_LLM_QUEUE_LIMIT=str(options["requests"]),
+        RAG_ASYNC_VIEWS="1" if kind == "asgi" else "0",
+    )
+    import django
+
+    django.setup()
+
+    from ..services.registry import get_registry
+
+    registry = get_registry()
+    registry.base_dir = base_dir
+    registry.warm_up()
+
+    if kind == "asgi":
+        import uvicorn
+        from django.core.asgi import get_asgi_application
+
+        uvicorn.run(get_asgi_application(), host="127.0.0.1", port=port, log_level="warning")
+        return
+
+    from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer
+    from django.core.wsgi import get_wsgi_application
+
+    class PooledWSGIServer(WSGIServer):
+        """WSGI server handing connections to a fixed pool of threads"""
+
+        request_queue_size = 1024
+        pool = ThreadPoolExecutor(max_workers=options["threads"])
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self._handle, request, client_address)
+
+        def _handle(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = PooledWSGIServer(("127.0.0.1", port), QuietHandler)
+    server.set_app(get_wsgi_application())
+    server.serve_forever()
+
+
+def _wait_until_listening(port: int, process, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise RuntimeError("Server process exited during start-up")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+async def _load(port: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    import httpx
+
+    rng = random.Random(options["seed"])
+    url = f"http://127.0.0.1:{port}/api/query/"
+    cached_query = {"query": "What does error ERR-10000 mean?", "cache": True}
+    bodies = [
+        cached_query
+        if rng.random() < options["cached_ratio"]
+        else {"query": f"question {i} about the synthetic corpus", "cache": False}
+        for i in range(options["requests"])
+    ]
+    limits = httpx.Limits(max_connections=options["concurrency"])
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        # Fill the answer cache for the repeated question
+        await client.post(url, json=cached_query)
+
+        latencies, errors = [], 0
+        semaphore = asyncio.Semaphore(options["concurrency"])
+
+        async def one(body):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post(url, json=body)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if response.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(body) for body in bodies))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 1),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 1),
+        "errors": errors,
+    }
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    # Imported here: the benchmarks package must import without Django set up
+    from ..services.chroma_db import ChromaDBService
+    from ..services.registry import ModelRegistry
+    from .retrieval import make_corpus
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        registry = ModelRegistry(base_dir=directory)
+        registry.set_backend("fake")
+        chroma = ChromaDBService(registry)
+        chunks, _ = make_corpus(options["chunks"], options["seed"])
+        vectors = chroma.embeddings.embed_documents([c.page_content for c in chunks])
+        chroma.upsert_embeddings(chunks, vectors, [str(c.metadata["chunk_id"]) for c in chunks])
+        chroma.commit()
+        registry.teardown()
+
+        for kind in ("wsgi", "asgi"):
+            port = _free_port()
+            process = context.Process(target=_serve, args=(kind, port, directory, options))
+            process.start()
+            try:
+                _wait_until_listening(port, process)
+                results[kind] = asyncio.run(_load(port, options))
+            finally:
+                process.terminate()
+                process.join()
+
+    return {
+        "requests": options["requests"],
+        "concurrency": options["concurrency"],
+        "wsgi_threads": options["threads"],
+        "llm_slots": options["slots"],
+        "cached_ratio": options["cached_ratio"],
+        **results,
+    }
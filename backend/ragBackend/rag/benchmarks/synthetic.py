@@ -0,0 +1,59 @@
+"""Synthetic PDFs for benchmarks, written without any PDF library"""
+import random
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud"
+).split()
+
+
+def _page_stream(rng: random.Random, page: int, lines: int) -> bytes:
+    text = " ".join(
+        "({}) '".format(
+            f"Page {page} line {line} " + " ".join(rng.choice(WORDS) for _ in range(12))
+        )
+        for line in range(lines)
+    )
+    return f"BT /F1 10 Tf 50 780 Td 12 TL {text} ET".encode("latin-1")
+
+
+def write_pdf(path: str, pages: int, lines_per_page: int = 40, seed: int = 0) -> str:
+    """Write a text-only PDF of ``pages`` pages, streaming it to disk page by page"""
+    rng = random.Random(seed)
+    offsets = []
+
+    with open(path, "wb") as f:
+
+        def write_object(number: int, body: bytes) -> None:
+            offsets.append(f.tell())
+            f.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+
+        f.write(b"%PDF-1.4\n")
+        # 1: catalog, 2: page tree, 3: font, then a (page, content) pair per page
+        kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(pages))
+        write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+        write_object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+        for i in range(pages):
+            page_id = 4 + 2 * i
+            write_object(
+                page_id,
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>".encode(),
+            )
+            content = _page_stream(rng, i, lines_per_page)
+            write_object(
+                page_id + 1,
+                f"<< /Length {len(content)} >>\nstream\n".encode() + content + b"\nendstream",
+            )
+
+        xref = f.tell()
+        f.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode())
+        f.write(
+            f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\n"
+            f"startxref\n{xref}\n%%EOF\n".encode()
+        )
+    return path
@@ -0,0 +1,148 @@
+"""Chroma against the compact vector engine: recall, latency, memory and disk
+
+Vectors are synthetic (clustered, normalized) rather than embedded, so the
+numbers cover the engines alone. Recall@k is measured against an exact
+float32 search. Each engine runs in a fresh process, so its RSS growth
+(after indexing and searching, over the process with the vectors loaded)
+doesn't include the others'.
+"""
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+from .ingest_memory import _peak_rss_mb
+
+help = "Recall@k, search latency, RSS and disk use of Chroma vs the compact vector engine"
+
+ENGINES = {
+    "chroma": {"RAG_VECTOR_BACKEND": "chroma"},
+    "compact_int8": {"RAG_VECTOR_BACKEND": "compact", "RAG_COMPACT_PRECISION": "int8"},
+    "compact_float16": {"RAG_VECTOR_BACKEND": "compact", "RAG_COMPACT_PRECISION": "float16"},
+}
+
+
+def add_arguments(parser):
+    parser.add_argument("--vectors", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--engines", nargs="+", choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def make_vectors(count: int, dim: int, queries: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Normalized corpus vectors around a few hundred topics, and queries near them"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, count // 200), dim))
+    corpus = centers[rng.integers(len(centers), size=count)] + 0.8 * rng.normal(size=(count, dim))
+    probes = corpus[rng.integers(count, size=queries)] + 0.5 * rng.normal(size=(queries, dim))
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    probes /= np.linalg.norm(probes, axis=1, keepdims=True)
+    return corpus.astype(np.float32), probes.astype(np.float32)
+
+
+def _rss_mb() -> Tuple[float, float]:
+    """Current resident memory, total and anonymous; the peak without /proc
+
+    Memory-mapped files count towards the total but not the anonymous part:
+    those pages are page cache the kernel can drop under pressure.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["RssAnon"].split()[0]) / 1024
+    except (OSError, KeyError):
+        peak = _peak_rss_mb()
+        return peak, peak
+
+
+def _disk_mb(directory: str) -> float:
+    size = 0
+    for root, _, files in os.walk(directory):
+        size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return size / 2**20
+
+
+def _measure(engine: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """Index and search in this (fresh) process"""
+    import django
+
+    django.setup()
+
+    from django.test.utils import override_settings
+
+    from ..services.registry import ModelRegistry
+
+    corpus, probes = make_vectors(
+        options["vectors"], options["dim"], options["queries"], options["seed"]
+    )
+    k = options["k"]
+    exact = np.argsort(-(probes @ corpus.T), axis=1)[:, :k]
+
+    with override_settings(**ENGINES[engine]), tempfile.TemporaryDirectory() as directory:
+        registry = ModelRegistry(base_dir=directory)
+        registry.set_backend("fake")
+        vectorstore = registry.get_vectorstore()
+        baseline, anon_baseline = _rss_mb()
+
+        start = time.perf_counter()
+        for offset in range(0, len(corpus), 500):
+            rows = range(offset, min(offset + 500, len(corpus)))
+            vectorstore._collection.upsert(
+                ids=[str(i) for i in rows],
+                embeddings=corpus[offset : offset + 500].tolist(),
+                documents=[f"chunk {i}" for i in rows],
+                metadatas=[{"chunk_id": i} for i in rows],
+            )
+        index_seconds = time.perf_counter() - start
+
+        latencies, mmr_latencies, recalls = [], [], []
+        for probe, truth in zip(probes, exact):
+            vector = probe.tolist()
+            start = time.perf_counter()
+            docs = vectorstore.similarity_search_by_vector(vector, k=k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found = {doc.metadata["chunk_id"] for doc in docs}
+            recalls.append(len(found & set(truth.tolist())) / k)
+
+            start = time.perf_counter()
+            vectorstore.max_marginal_relevance_search_by_vector(
+                vector, k=k, fetch_k=max(20, 2 * k), lambda_mult=0.5
+            )
+            mmr_latencies.append((time.perf_counter() - start) * 1000)
+
+        rss, anon_rss = _rss_mb()
+        disk = _disk_mb(directory)
+        registry.teardown()
+
+    latencies.sort()
+    return {
+        "index_seconds": round(index_seconds, 2),
+        f"recall@{k}": round(statistics.mean(recalls), 4),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+        "mmr_p50_ms": round(statistics.median(mmr_latencies), 2),
+        "rss_growth_mb": round(rss - baseline, 1),
+        "anon_rss_growth_mb": round(anon_rss - anon_baseline, 1),
+        "disk_mb": round(disk, 1),
+    }
+
+
+def run(options: Dict[str, Any]) -> Dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for engine in options["engines"]:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results[engine] = pool.submit(_measure, engine, options).result()
+    return {
+        "vectors": options["vectors"],
+        "dim": options["dim"],
+        "queries": options["queries"],
+        "engines": results,
+    }
@@ -0,0 +1,51 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.benchmarks import BENCHMARKS
+from rag.benchmarks.compare import compare
+
+
+class Command(BaseCommand):
+    help = "Run a performance benchmark and print its results as JSON"
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest="benchmark", required=True)
+        for name, module in BENCHMARKS.items():
+            subparser = subparsers.add_parser(name, help=module.help)
+            module.add_arguments(subparser)
+            subparser.add_argument("--output", help="Also write the results to this JSON file")
+            subparser.add_argument(
+                "--baseline",
+                help="Results of an earlier run to compare against; fails on a regression",
+            )
+            subparser.add_argument(
+                "--threshold",
+                type=float,
+                default=0.15,
+                help="Relative change that counts as a regression (default 0.15)",
+            )
+
+    def handle(self, *args, **options):
+        result = BENCHMARKS[options["benchmark"]].run(options)
+        output = json.dumps(result, indent=2, default=str)
+        self.stdout.write(output)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+            regressions = compare(result, baseline, options["threshold"])
+            for regression in regressions:
+                self.stderr.write(
+                    "{metric}: {baseline:g} -> {current:g} ({change:+.0%})".format(**regression)
+                )
+            if regressions:
+                raise CommandError(
+                    f"{len(regressions)} metric(s) regressed by more than "
+                    f"{options['threshold']:.0%} against {options['baseline']}"
+                )
+            self.stderr.write(self.style.SUCCESS("No regressions against the baseline"))
@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.services.chroma_db import ChromaDBService
+from rag.services.registry import DEFAULT_COLLECTION
+
+
+class Command(BaseCommand):
+    help = "Re-index new, changed and removed PDFs (or everything with --full)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Drop the collection and re-index every PDF from scratch",
+        )
+        parser.add_argument(
+            "--collection",
+            default=DEFAULT_COLLECTION,
+            help=f"Collection to rebuild (default {DEFAULT_COLLECTION})",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            chroma = ChromaDBService(collection_name=options["collection"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        result = chroma.rebuild_index(full=options["full"])
+        self.stdout.write(json.dumps(result["details"], indent=2))
+        self.stdout.write(self.style.SUCCESS(result["message"]))
@@ -0,0 +1,58 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.models import Document
+from rag.services.chroma_db import ChromaDBService
+
+
+class Command(BaseCommand):
+    help = "Re-split and re-index indexed PDFs from their cached text, without re-parsing them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--collection",
+            action="append",
+            help="Collection to re-chunk, repeatable (default: every collection)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=getattr(settings, "RAG_CHUNK_SIZE", 1000),
+            help="Splitter chunk size in characters (default RAG_CHUNK_SIZE)",
+        )
+        parser.add_argument(
+            "--chunk-overlap",
+            type=int,
+            default=getattr(settings, "RAG_CHUNK_OVERLAP", 200),
+            help="Splitter chunk overlap in characters (default RAG_CHUNK_OVERLAP)",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size, chunk_overlap = options["chunk_size"], options["chunk_overlap"]
+        if chunk_size <= 0 or not 0 <= chunk_overlap < chunk_size:
+            raise CommandError("Need chunk size > 0 and 0 <= chunk overlap < chunk size")
+
+        collections = options["collection"] or sorted(
+            Document.objects.values_list("collection", flat=True).distinct()
+        )
+        for collection in collections:
+            try:
+                chroma = ChromaDBService(collection_name=collection)
+            except ValueError as e:
+                raise CommandError(str(e))
+            result = chroma.rechunk(chunk_size, chunk_overlap)
+            self.stdout.write(json.dumps(result["details"], indent=2))
+            self.stdout.write(self.style.SUCCESS(f"{collection}: {result['message']}"))
+
+        if (chunk_size, chunk_overlap) != (
+            getattr(settings, "RAG_CHUNK_SIZE", 1000),
+            getattr(settings, "RAG_CHUNK_OVERLAP", 200),
+        ):
+            self.stdout.write(
+                self.style.WARNING(
+                    "New uploads still use RAG_CHUNK_SIZE/RAG_CHUNK_OVERLAP; "
+                    "set them to the same values"
+                )
+            )
@@ -0,0 +1,30 @@
+# Generated by Django 5.2 on 2026-10-18 09:10
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('stage', models.CharField(blank=True, choices=[('parse', 'Parse'), ('split', 'Split'), ('embed', 'Embed'), ('upsert', 'Upsert')], max_length=20)),
+                ('pages_parsed', models.IntegerField(default=0)),
+                ('chunks_total', models.IntegerField(default=0)),
+                ('chunks_embedded', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='rag.document')),
+            ],
+        ),
+    ]
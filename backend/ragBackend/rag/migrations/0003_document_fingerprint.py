@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-18 09:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0002_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='chunk_ids',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='file_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='file_mtime',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='file_size',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0003_document_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='pages_total',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 09:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0004_ingestionjob_pages_total'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='collection',
+            field=models.CharField(db_index=True, default='pdf_collection', max_length=63),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-18 09:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag', '0005_document_collection'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='document',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='file_path',
+            field=models.CharField(db_index=True, max_length=512),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='name',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+    ]
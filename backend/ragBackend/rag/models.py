@@ -6,12 +6,91 @@ class Document(models.Model):
     """Store metadata about indexed documents"""
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    name = models.CharField(max_length=255)
-    file_path = models.CharField(max_length=512)
+    # Indexed: query filters and uploads look documents up by these
+    name = models.CharField(max_length=255, db_index=True)
+    file_path = models.CharField(max_length=512, db_index=True)
     file_type = models.CharField(max_length=50)
     chunk_count = models.IntegerField(default=0)
     indexed = models.BooleanField(default=False)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    # Fingerprint of the file as last indexed, used by incremental rebuilds
+    file_hash = models.CharField(max_length=64, blank=True)
+    file_size = models.BigIntegerField(default=0)
+    file_mtime = models.FloatField(null=True, blank=True)
+    # Ids of the vectors written to Chroma for this document
+    chunk_ids = models.JSONField(default=list, blank=True)
+    # Chroma collection (namespace) holding the vectors; queries search only
+    # the collections they ask for. Default: registry.DEFAULT_COLLECTION
+    collection = models.CharField(max_length=63, default="pdf_collection", db_index=True)
 
     def __str__(self):
         return f"{self.name} ({self.file_type})"
+
+
+class IngestionJob(models.Model):
+    """Track the background parse -> split -> embed -> upsert of a document"""
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_COMPLETED = "completed"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_COMPLETED, "Completed"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    STAGE_PARSE = "parse"
+    STAGE_SPLIT = "split"
+    STAGE_EMBED = "embed"
+    STAGE_UPSERT = "upsert"
+    STAGE_CHOICES = [
+        (STAGE_PARSE, "Parse"),
+        (STAGE_SPLIT, "Split"),
+        (STAGE_EMBED, "Embed"),
+        (STAGE_UPSERT, "Upsert"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name="jobs")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    stage = models.CharField(max_length=20, choices=STAGE_CHOICES, blank=True)
+    pages_parsed = models.IntegerField(default=0)
+    pages_total = models.IntegerField(default=0)
+    chunks_total = models.IntegerField(default=0)
+    chunks_embedded = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.document.name} [{self.status}]"
+
+
+class UploadSession(models.Model):
+    """A resumable upload sent as numbered parts, assembled once all arrived"""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    name = models.CharField(max_length=255)
+    collection = models.CharField(max_length=63, default="pdf_collection")
+    size = models.BigIntegerField()
+    part_size = models.IntegerField()
+    # Set once the parts are assembled
+    file_hash = models.CharField(max_length=64, blank=True)
+    document = models.ForeignKey(
+        Document, null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    @property
+    def part_count(self) -> int:
+        return max(1, -(-self.size // self.part_size))
+
+    def part_length(self, index: int) -> int:
+        """Bytes expected in part ``index`` (the last one may be shorter)"""
+        return min(self.part_size, self.size - index * self.part_size)
+
+    def __str__(self):
+        return f"{self.name} ({self.size} bytes)"
@@ -0,0 +1,76 @@
+# rag/services/aio.py
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List
+
+from django.conf import settings
+from django.db import close_old_connections
+
+# Blocking work offloaded by the async views: retrieval (embedding, Chroma,
+# reranking, answer cache lookups) and file I/O get separate pools so a burst
+# of uploads can't starve queries
+RETRIEVAL = "retrieval"
+IO = "io"
+# Per-collection searches of one query. A pool of its own: the fan-out runs
+# from retrieval pool threads and must not wait on that same pool
+SEARCH = "search"
+
+_POOL_SIZES = {
+    RETRIEVAL: ("RAG_ASYNC_RETRIEVAL_WORKERS", 8),
+    IO: ("RAG_ASYNC_IO_WORKERS", 4),
+    SEARCH: ("RAG_SEARCH_WORKERS", 8),
+}
+
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name: str) -> ThreadPoolExecutor:
+    """Get the process-wide executor for one kind of blocking work"""
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                setting, default = _POOL_SIZES[name]
+                executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, setting, default),
+                    thread_name_prefix=f"rag-async-{name}",
+                )
+                _executors[name] = executor
+    return executor
+
+
+def _call(fn: Callable, args, kwargs) -> Any:
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        # Pool threads outlive requests: drop connections past their max age
+        close_old_connections()
+
+
+async def run_blocking(executor: str, fn: Callable, *args, **kwargs) -> Any:
+    """Run a blocking call on one of the executors without blocking the event loop
+
+    The call sees the caller's context variables (e.g. the request trace).
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_executor(executor), functools.partial(context.run, _call, fn, args, kwargs)
+    )
+
+
+def map_blocking(executor: str, fn: Callable, items: Iterable) -> List[Any]:
+    """Call ``fn`` on every item in parallel on an executor; results in item order
+
+    Like ``run_blocking``, the calls see the caller's context variables.
+    """
+    pool = get_executor(executor)
+    futures = [
+        pool.submit(contextvars.copy_context().run, _call, fn, (item,), {}) for item in items
+    ]
+    return [future.result() for future in futures]
@@ -0,0 +1,160 @@
+# rag/services/answer_cache.py
+import copy
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+
+from ..models import Document as DocumentModel
+
+CACHE_HIT = "hit"
+CACHE_SEMANTIC = "semantic"
+CACHE_MISS = "miss"
+
+
+def normalize_query(query_text: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return re.sub(r"\s+", " ", query_text).strip().lower().rstrip("?!. ")
+
+
+class AnswerCache:
+    """Two-layer cache of query results in front of ``RAGService.query``
+
+    The exact layer matches the normalized query text; the semantic layer
+    compares the query embedding against past questions and accepts the
+    closest one above ``similarity_threshold``. Both layers only match
+    entries computed against the current corpus version and the same
+    request scope (retrieval options that change the answer).
+    """
+
+    def __init__(
+        self, max_entries: int = 256, similarity_threshold: float = 0.95, version_ttl: float = 2
+    ):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.version_ttl = version_ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+        self._vectors: Dict[Tuple[str, str, str], np.ndarray] = {}
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: List[Tuple[str, str, str]] = []
+        self._generation = 0
+        self._version: Optional[str] = None
+        # (generation, monotonic time) the last computed version is valid for
+        self._version_checked: Tuple[int, float] = (-1, 0.0)
+
+    def corpus_version(self) -> str:
+        """Identify the indexed corpus, so other workers' re-indexing is noticed too"""
+        stats = DocumentModel.objects.filter(indexed=True).aggregate(
+            count=Count("id"), chunks=Sum("chunk_count"), mtime=Max("file_mtime")
+        )
+        return f"{self._generation}:{stats['count']}:{stats['chunks']}:{stats['mtime']}"
+
+    def invalidate(self) -> None:
+        """Drop every entry, e.g. after an upload or an index rebuild"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._vectors.clear()
+            self._matrix = None
+
+    def _key(self, query_text: str, version: str, scope: Dict[str, Any]) -> Tuple[str, str, str]:
+        return (
+            normalize_query(query_text),
+            version,
+            json.dumps(scope or {}, sort_keys=True, default=str),
+        )
+
+    def _check_version(self) -> str:
+        generation, checked = self._version_checked
+        now = time.monotonic()
+        if generation == self._generation and now - checked < self.version_ttl:
+            return self._version
+        version = self.corpus_version()
+        self._version_checked = (self._generation, now)
+        if version != self._version:
+            # The corpus changed under us: nothing cached is valid any more
+            self._entries.clear()
+            self._vectors.clear()
+            self._matrix = None
+            self._version = version
+        return version
+
+    def get(
+        self,
+        query_text: str,
+        query_vector: List[float] = None,
+        scope: Dict[str, Any] = None,
+    ) -> Tuple[Optional[Dict[str, Any]], str]:
+        """Return ``(result, "hit" | "semantic")`` or ``(None, "miss")``"""
+        with self._lock:
+            key = self._key(query_text, self._check_version(), scope)
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                return copy.deepcopy(result), CACHE_HIT
+
+            if query_vector is None or not self._vectors:
+                return None, CACHE_MISS
+
+            if self._matrix is None:
+                self._matrix_keys = list(self._vectors)
+                self._matrix = np.stack([self._vectors[k] for k in self._matrix_keys])
+
+            vector = np.asarray(query_vector, dtype=np.float32)
+            scores = self._matrix @ (vector / (np.linalg.norm(vector) or 1.0))
+            for i in np.argsort(-scores):
+                if scores[i] < self.similarity_threshold:
+                    break
+                candidate = self._matrix_keys[i]
+                # Only reuse answers computed with the same scope
+                if candidate[1:] == key[1:]:
+                    self._entries.move_to_end(candidate)
+                    return copy.deepcopy(self._entries[candidate]), CACHE_SEMANTIC
+            return None, CACHE_MISS
+
+    def put(
+        self,
+        query_text: str,
+        result: Dict[str, Any],
+        query_vector: List[float] = None,
+        scope: Dict[str, Any] = None,
+    ) -> None:
+        with self._lock:
+            key = self._key(query_text, self._check_version(), scope)
+            self._entries[key] = copy.deepcopy(result)
+            self._entries.move_to_end(key)
+            if query_vector is not None:
+                vector = np.asarray(query_vector, dtype=np.float32)
+                self._vectors[key] = vector / (np.linalg.norm(vector) or 1.0)
+                self._matrix = None
+
+            # Evict least recently used entries
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                if self._vectors.pop(evicted, None) is not None:
+                    self._matrix = None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """Get the process-wide answer cache"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AnswerCache(
+                    max_entries=getattr(settings, "RAG_ANSWER_CACHE_SIZE", 256),
+                    similarity_threshold=getattr(settings, "RAG_ANSWER_CACHE_SIMILARITY", 0.95),
+                    version_ttl=getattr(settings, "RAG_ANSWER_CACHE_VERSION_TTL", 2),
+                )
+    return _cache
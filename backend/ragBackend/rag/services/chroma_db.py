@@ -1,102 +1,393 @@
 # rag/services/chroma_db.py
+import logging
 import os
-import shutil
-from typing import List, Dict, Any
-from langchain_chroma import Chroma
+import uuid
+from typing import List, Dict, Any, Optional
 from langchain.schema import Document
 
 from django.conf import settings
-from .embedding import get_embeddings
+from . import tracing
+from .answer_cache import get_answer_cache
+from .registry import DEFAULT_COLLECTION, ModelRegistry, get_registry, validate_collection
 from ..models import Document as DocumentModel
 
+logger = logging.getLogger(__name__)
+
+
+def documents_dir(collection_name: str = DEFAULT_COLLECTION) -> str:
+    """Directory holding a collection's PDFs (the default one keeps the top level)"""
+    directory = os.path.join(settings.MEDIA_ROOT, "documents")
+    if collection_name != DEFAULT_COLLECTION:
+        directory = os.path.join(directory, validate_collection(collection_name))
+    return directory
+
 
 class ChromaDBService:
-    """Service for interacting with the ChromaDB vector database"""
+    """Service for interacting with the ChromaDB vector database
+
+    Every instance works on one collection (``collection_name``, defaults
+    to ``DEFAULT_COLLECTION``).
+    """
 
-    def __init__(self):
-        self.persist_directory = os.path.join(settings.BASE_DIR, "chroma_db")
-        self.collection_name = "pdf_collection"
-        self.embeddings = get_embeddings()
+    def __init__(self, registry: ModelRegistry = None, collection_name: str = None):
+        self.registry = registry or get_registry()
+        self.collection_name = validate_collection(collection_name or DEFAULT_COLLECTION)
+        self.embeddings = self.registry.get_embeddings()
 
     def get_vectorstore(self):
-        """Get or create the vector store"""
-        try:
-            return Chroma(
-                persist_directory=self.persist_directory,
-                embedding_function=self.embeddings,
-                collection_name=self.collection_name,
-            )
-        except Exception as e:
-            print(f"Error creating ChromaDB: {str(e)}")
-            # If there's an error, try to recreate the database
-            if os.path.exists(self.persist_directory):
-                print(f"Recreating ChromaDB directory")
-                shutil.rmtree(self.persist_directory, ignore_errors=True)
-
-            # Try again with a fresh database
-            return Chroma(
-                persist_directory=self.persist_directory,
-                embedding_function=self.embeddings,
-                collection_name=self.collection_name,
-            )
+        """Get the shared vector store of this collection"""
+        return self.registry.get_vectorstore(self.collection_name)
+
+    @property
+    def keyword_index(self):
+        """BM25 index kept in step with the vector store"""
+        return self.registry.get_keyword_index(self.collection_name)
+
+    @property
+    def chunk_store(self):
+        """Extracted text and chunk offsets, for citations"""
+        return self.registry.get_chunk_store()
 
     def add_documents(self, chunks: List[Document]) -> List[str]:
         """Add document chunks to the vector store"""
         vectorstore = self.get_vectorstore()
 
         # Add documents and get the IDs
-        return vectorstore.add_documents(chunks)
+        ids = vectorstore.add_documents(chunks)
+        self.keyword_index.add(ids, [chunk.page_content for chunk in chunks])
+        return ids
+
+    def upsert_embeddings(
+        self,
+        chunks: List[Document],
+        embeddings: List[List[float]],
+        ids: List[str] = None,
+    ) -> List[str]:
+        """Write chunks whose embeddings were already computed"""
+        ids = ids or [str(uuid.uuid4()) for _ in chunks]
+        with tracing.span("upsert"):
+            self.get_vectorstore()._collection.upsert(
+                ids=ids,
+                embeddings=embeddings,
+                documents=[chunk.page_content for chunk in chunks],
+                metadatas=[chunk.metadata for chunk in chunks],
+            )
+            self.keyword_index.add(ids, [chunk.page_content for chunk in chunks])
+        return ids
+
+    def commit(self) -> None:
+        """Persist keyword index changes made since the last commit"""
+        self.keyword_index.save()
 
     def similarity_search(self, query: str, k: int = 5) -> List[Document]:
         """Search for similar documents"""
         db = self.get_vectorstore()
         return db.similarity_search(query, k=k)
 
-    def rebuild_index(self) -> Dict[str, Any]:
-        """Rebuild the entire vector index from stored documents"""
-        from .pdf import PDFProcessor
+    def document_vector_ids(self, document: DocumentModel) -> List[str]:
+        """Ids of the vectors currently written for a document"""
+        if document.chunk_ids:
+            return list(document.chunk_ids)
+        # Indexed before chunk ids were recorded
+        return self.get_vectorstore()._collection.get(
+            where={"source": document.file_path}, include=[]
+        )["ids"]
+
+    def delete_vectors(self, ids: List[str]) -> None:
+        """Remove vectors by id from the vector store and the keyword index"""
+        if ids:
+            self.get_vectorstore().delete(ids=ids)
+            self.keyword_index.delete(ids)
+
+    def delete_document_vectors(self, document: DocumentModel) -> None:
+        """Remove every vector written for a document"""
+        self.delete_vectors(self.document_vector_ids(document))
+        self.chunk_store.delete(document.id)
+
+    def document_chunk_ids(self, document: DocumentModel, chunks: List[Document]) -> List[str]:
+        """Tag chunks with their document and derive stable vector ids"""
+        for chunk in chunks:
+            chunk.metadata["document_id"] = str(document.id)
+        return [f"{document.id}-{chunk.metadata['chunk_id']}" for chunk in chunks]
+
+    def chunk_text(
+        self, document: DocumentModel, chunk_id: int, context: int = 0
+    ) -> Optional[Dict[str, Any]]:
+        """Full text of a chunk and up to ``context`` neighbours on each side
+
+        Served from the chunk store; documents indexed before it existed
+        fall back to fetching the chunks from Chroma by id.
+        """
+        chunk = self.chunk_store.get(document.id, chunk_id, context)
+        if chunk is not None:
+            return chunk
+
+        first = max(0, chunk_id - context)
+        ids = [f"{document.id}-{i}" for i in range(first, chunk_id + context + 1)]
+        found = self.get_vectorstore()._collection.get(ids=ids, include=["documents", "metadatas"])
+        chunks = sorted(
+            (metadata["chunk_id"], metadata.get("page", -1), text)
+            for metadata, text in zip(found["metadatas"], found["documents"])
+        )
+        pages = {found_id: page for found_id, page, _ in chunks}
+        if chunk_id not in pages:
+            return None
+        before = "\n".join(text for found_id, _, text in chunks if found_id < chunk_id)
+        target = next(text for found_id, _, text in chunks if found_id == chunk_id)
+        after = "\n".join(text for found_id, _, text in chunks if found_id > chunk_id)
+        chunk_start = len(before) + 1 if before else 0
+        return {
+            "chunk_id": chunk_id,
+            "page": pages[chunk_id],
+            "text": "\n".join(part for part in (before, target, after) if part),
+            "chunk_start": chunk_start,
+            "chunk_end": chunk_start + len(target),
+            "first_chunk_id": chunks[0][0],
+            "last_chunk_id": chunks[-1][0],
+        }
+
+    def replace_document(
+        self,
+        document: DocumentModel,
+        chunks: List[Document],
+        embeddings: List[List[float]] = None,
+    ) -> List[str]:
+        """Swap a document's vectors for freshly processed chunks
+
+        The old vectors keep answering queries until the new ones are in.
+        Chunk ids are derived from the document id, so most are overwritten
+        in place and only those past the new last chunk are deleted. A
+        failed upsert drops the document rather than leaving it half
+        replaced.
+        """
+        if not chunks:
+            self.delete_document_vectors(document)
+            return []
+
+        old_ids = self.document_vector_ids(document)
+        ids = self.document_chunk_ids(document, chunks)
+        if embeddings is None:
+            embeddings = self.embeddings.embed_documents([c.page_content for c in chunks])
+        try:
+            self.upsert_embeddings(chunks, embeddings, ids)
+            self.chunk_store.write(document.id, chunks)
+        except Exception:
+            self.discard_document(document, old_ids + ids)
+            raise
+
+        self.delete_stale_vectors(old_ids, ids)
+        return ids
+
+    def delete_stale_vectors(self, old_ids: List[str], ids: List[str]) -> None:
+        """Delete the vectors of an earlier version that the new one didn't overwrite"""
+        replaced = set(ids)
+        self.delete_vectors([i for i in old_ids if i not in replaced])
+
+    def discard_document(self, document: DocumentModel, ids: List[str]) -> None:
+        """Drop a half-replaced document's vectors and mark it unindexed"""
+        self.delete_vectors(list(dict.fromkeys(ids)))
+        self.chunk_store.delete(document.id)
+        self.commit()
+        DocumentModel.objects.filter(pk=document.pk).update(
+            chunk_count=0, chunk_ids=[], indexed=False
+        )
+
+    def rebuild_index(self, full: bool = False) -> Dict[str, Any]:
+        """Bring this collection in line with the PDFs in its directory
+
+        Only new or changed files are processed; vectors of changed and
+        removed files are deleted. ``full`` drops the collection and
+        re-indexes every file.
+        """
+        from .pdf import PDFProcessor, file_fingerprint
 
         # Create document processor
         processor = PDFProcessor()
 
         # Get all documents directory
-        documents_dir = os.path.join(settings.MEDIA_ROOT, "documents")
-        os.makedirs(documents_dir, exist_ok=True)
+        directory = documents_dir(self.collection_name)
+        os.makedirs(directory, exist_ok=True)
 
         # Get all PDF files in the documents directory
-        pdf_files = [f for f in os.listdir(documents_dir) if f.lower().endswith(".pdf")]
+        pdf_files = sorted(f for f in os.listdir(directory) if f.lower().endswith(".pdf"))
+        file_paths = {os.path.join(directory, f) for f in pdf_files}
 
-        processed_docs = []
+        if full:
+            self.registry.reset_collection(self.collection_name)
+
+        known = {
+            doc.file_path: doc
+            for doc in DocumentModel.objects.filter(collection=self.collection_name)
+        }
+        diff = {"added": [], "updated": [], "removed": [], "skipped": [], "failed": []}
         total_chunks = 0
 
+        def failed(file_path, name, error, vectors_dropped=full):
+            logger.error("Error processing %s: %s", file_path, error)
+            diff["failed"].append(name)
+            document = known.get(file_path)
+            if vectors_dropped and document is not None:
+                # Re-indexed by the next rebuild instead of being skipped
+                DocumentModel.objects.filter(pk=document.pk).update(
+                    chunk_count=0, chunk_ids=[], indexed=False
+                )
+
+        # Files that disappeared from disk
+        for file_path, document in known.items():
+            if file_path not in file_paths:
+                if full:
+                    self.chunk_store.delete(document.id)
+                else:
+                    self.delete_document_vectors(document)
+                document.delete()
+                diff["removed"].append(document.name)
+
+        # Work out which files changed before parsing anything
+        fingerprints = {}
         for pdf_file in pdf_files:
-            file_path = os.path.join(documents_dir, pdf_file)
+            file_path = os.path.join(directory, pdf_file)
+            document = known.get(file_path)
+            try:
+                stat = os.stat(file_path)
+                if not full and document is not None and document.indexed:
+                    # Cheap check first, hash only when size or mtime moved
+                    if (stat.st_size, stat.st_mtime) == (document.file_size, document.file_mtime):
+                        diff["skipped"].append(document.name)
+                        continue
+                    fingerprint = file_fingerprint(file_path)
+                    if fingerprint[0] == document.file_hash:
+                        document.file_mtime = fingerprint[2]
+                        document.save(update_fields=["file_mtime"])
+                        diff["skipped"].append(document.name)
+                        continue
+                else:
+                    fingerprint = file_fingerprint(file_path)
+                fingerprints[file_path] = fingerprint
+            except Exception as e:
+                failed(file_path, pdf_file, e)
+
+        # Parse and split on a process pool, indexing each file as it finishes
+        hashes = {file_path: fingerprint[0] for file_path, fingerprint in fingerprints.items()}
+        for result in processor.process_many(fingerprints, file_hashes=hashes):
+            file_path = result["file_path"]
+            if "error" in result:
+                failed(file_path, result["name"], result["error"])
+                continue
+
             try:
-                result = processor.process_pdf(file_path)
                 chunks = result["chunks"]
+                document = known.get(file_path)
+                if document is None:
+                    document = DocumentModel.objects.create(
+                        name=result["name"],
+                        file_path=file_path,
+                        file_type=result["file_type"],
+                        collection=self.collection_name,
+                    )
+                    diff["added"].append(document.name)
+                else:
+                    diff["updated"].append(document.name)
 
-                # Add to vector store
-                self.add_documents(chunks)
-
-                # Update or create document in database
-                document, created = DocumentModel.objects.update_or_create(
-                    file_path=file_path,
-                    defaults={
-                        "name": result["name"],
-                        "file_type": result["file_type"],
-                        "chunk_count": len(chunks),
-                        "indexed": True,
-                    },
-                )
+                # A full rebuild already dropped every vector
+                if full:
+                    document.chunk_ids = []
+                ids = self.replace_document(document, chunks)
+
+                file_hash, file_size, file_mtime = fingerprints[file_path]
+                document.name = result["name"]
+                document.chunk_count = len(chunks)
+                document.chunk_ids = ids
+                document.file_hash = file_hash
+                document.file_size = file_size
+                document.file_mtime = file_mtime
+                document.indexed = True
+                document.save()
 
-                processed_docs.append(document)
                 total_chunks += len(chunks)
             except Exception as e:
-                print(f"Error processing {file_path}: {e}")
+                failed(file_path, result["name"], e)
+
+        processed = len(diff["added"]) + len(diff["updated"])
+        if full or processed or diff["removed"]:
+            self.commit()
+            get_answer_cache().invalidate()
+            if processor.text_cache is not None:
+                # Text of files no collection indexes any more
+                processor.text_cache.prune(
+                    DocumentModel.objects.values_list("file_hash", flat=True)
+                )
+
+        return {
+            "success": True,
+            "collection": self.collection_name,
+            "full": full,
+            **{key: len(names) for key, names in diff.items()},
+            "details": diff,
+            "documents_processed": processed,
+            "total_chunks": total_chunks,
+            "message": (
+                f"Added {len(diff['added'])}, updated {len(diff['updated'])}, "
+                f"removed {len(diff['removed'])}, skipped {len(diff['skipped'])} "
+                f"documents ({total_chunks} chunks indexed)."
+            ),
+        }
+
+    def rechunk(self, chunk_size: int = None, chunk_overlap: int = None) -> Dict[str, Any]:
+        """Re-split and re-index every indexed document of this collection
+
+        Pages come from the extracted-text cache, so PDFs are not parsed
+        again; only documents indexed before the cache existed are (which
+        caches them). Chunks whose text didn't change hit the embedding
+        cache. A document that fails keeps its old chunks, unless writing the
+        new ones failed part way, in which case it is left unindexed for the
+        next rebuild. Splitter parameters default to the settings.
+        """
+        from .pdf import PDFProcessor, file_fingerprint
+
+        processor = PDFProcessor(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        diff = {"cached": [], "parsed": [], "failed": []}
+        total_chunks = 0
+
+        documents = DocumentModel.objects.filter(collection=self.collection_name, indexed=True)
+        for document in documents.order_by("name"):
+            try:
+                fingerprint = None
+                if not processor.is_cached(document.file_hash):
+                    # Parsed now: key the cache by the bytes on disk today
+                    fingerprint = file_fingerprint(document.file_path)
+                file_hash = fingerprint[0] if fingerprint else document.file_hash
+
+                with tracing.span("pdf_parse"):
+                    pages = list(processor.load_pages(document.file_path, file_hash))
+                chunks = processor.split_pages(pages, document.file_path, document.name)
+                ids = self.replace_document(document, chunks)
+
+                document.chunk_count = len(chunks)
+                document.chunk_ids = ids
+                if fingerprint:
+                    document.file_hash, document.file_size, document.file_mtime = fingerprint
+                document.save()
+
+                diff["parsed" if fingerprint else "cached"].append(document.name)
+                total_chunks += len(chunks)
+            except Exception:
+                logger.exception("Error re-chunking %s", document.file_path)
+                diff["failed"].append(document.name)
+
+        self.commit()
+        get_answer_cache().invalidate()
 
         return {
             "success": True,
-            "documents_processed": len(processed_docs),
+            "collection": self.collection_name,
+            "chunk_size": processor.chunk_size,
+            "chunk_overlap": processor.chunk_overlap,
+            **{key: len(names) for key, names in diff.items()},
+            "details": diff,
             "total_chunks": total_chunks,
-            "message": f"Successfully processed {len(processed_docs)} documents with {total_chunks} chunks.",
+            "message": (
+                f"Re-chunked {len(diff['cached']) + len(diff['parsed'])} documents "
+                f"({len(diff['parsed'])} parsed, {len(diff['failed'])} failed) "
+                f"into {total_chunks} chunks."
+            ),
         }
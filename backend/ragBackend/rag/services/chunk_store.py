@@ -0,0 +1,193 @@
+# rag/services/chunk_store.py
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+# Shortest overlap treated as the splitter's chunk overlap; shorter matches
+# are more likely coincidence, and cost at most a few duplicated characters
+MIN_OVERLAP = 16
+
+_TRAILER = np.dtype("<i8")
+_ROW = np.dtype(("<i8", 3))
+
+
+def _overlap(previous: str, text: str) -> Optional[int]:
+    """Index in ``previous`` from which ``text`` continues it, if the two overlap"""
+    if len(text) < MIN_OVERLAP:
+        return None
+    head = text[:MIN_OVERLAP]
+    index = previous.find(head, max(0, len(previous) - len(text)))
+    while index != -1 and index <= len(previous) - MIN_OVERLAP:
+        if text.startswith(previous[index:]):
+            return index
+        index = previous.find(head, index + 1)
+    return None
+
+
+class ChunkStoreWriter:
+    """Stream a document's chunks, in chunk id order, into its store file
+
+    The file is written under a temporary name and swapped in on ``close``;
+    an exception inside the ``with`` block discards it instead.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._file = open(self.tmp_path, "wb")
+        self._rows: Dict[int, Tuple[int, int, int]] = {}
+        self._previous = ""
+        self._previous_start = 0
+        self._size = 0
+
+    def _write(self, data: bytes) -> None:
+        self._file.write(data)
+        self._size += len(data)
+
+    def add(self, chunks: Iterable[Document]) -> None:
+        for chunk in chunks:
+            text = chunk.page_content
+            index = _overlap(self._previous, text)
+            if index is None:
+                if self._size:
+                    self._write(b"\n")
+                start = self._size
+                self._write(text.encode("utf-8"))
+            else:
+                # Only the part past the previous chunk is new text
+                start = self._previous_start + len(self._previous[:index].encode("utf-8"))
+                self._write(text[len(self._previous) - index :].encode("utf-8"))
+            self._rows[chunk.metadata["chunk_id"]] = (
+                start,
+                self._size,
+                chunk.metadata.get("page", -1),
+            )
+            self._previous, self._previous_start = text, start
+
+    def close(self) -> None:
+        """Append the offsets (start byte, end byte, page per chunk id) and publish"""
+        count = max(self._rows, default=-1) + 1
+        rows = np.full((count, 3), -1, dtype=_ROW.base)
+        for chunk_id, row in self._rows.items():
+            rows[chunk_id] = row
+        self._file.write(rows.astype(_ROW.base).tobytes())
+        self._file.write(np.array([count], dtype=_TRAILER).tobytes())
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self._file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self) -> "ChunkStoreWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ChunkStore:
+    """Extracted text of every indexed document, with the offsets of its chunks
+
+    Each document has one file: the text its chunks cover (overlapping chunks
+    merged, so every chunk is a single slice of it), then a table of
+    (start byte, end byte, page) per chunk id, then the chunk count. Files
+    are memory-mapped on first read, so citations and neighbouring chunks
+    are slices of the map rather than Chroma round trips.
+    """
+
+    SUFFIX = ".chunks"
+
+    def __init__(self, directory: str, max_open: int = 256):
+        self.directory = directory
+        self.max_open = max_open
+        self._open_files: "OrderedDict[str, Tuple[int, Any, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, document_id) -> str:
+        return os.path.join(self.directory, f"{document_id}{self.SUFFIX}")
+
+    def writer(self, document_id) -> ChunkStoreWriter:
+        os.makedirs(self.directory, exist_ok=True)
+        return ChunkStoreWriter(self._path(document_id))
+
+    def write(self, document_id, chunks: List[Document]) -> None:
+        """Replace a document's stored chunks"""
+        with self.writer(document_id) as writer:
+            writer.add(chunks)
+
+    def delete(self, document_id) -> None:
+        with self._lock:
+            self._open_files.pop(str(document_id), None)
+        try:
+            os.remove(self._path(document_id))
+        except FileNotFoundError:
+            pass
+
+    def _open(self, document_id: str) -> Optional[Tuple[Any, np.ndarray]]:
+        path = self._path(document_id)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            cached = self._open_files.get(document_id)
+            if cached is not None and cached[0] == mtime:
+                self._open_files.move_to_end(document_id)
+                return cached[1], cached[2]
+
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count = int(np.frombuffer(data, dtype=_TRAILER, count=1, offset=len(data) - 8)[0])
+        offsets = np.frombuffer(
+            data, dtype=_ROW.base, count=3 * count, offset=len(data) - 8 - 24 * count
+        ).reshape(count, 3)
+
+        with self._lock:
+            # Evicted maps close once no reader holds their offsets any more
+            self._open_files[document_id] = (mtime, data, offsets)
+            self._open_files.move_to_end(document_id)
+            while len(self._open_files) > self.max_open:
+                self._open_files.popitem(last=False)
+        return data, offsets
+
+    def has(self, document_id) -> bool:
+        return os.path.exists(self._path(document_id))
+
+    def get(self, document_id, chunk_id: int, context: int = 0) -> Optional[Dict[str, Any]]:
+        """Text of a chunk, widened by up to ``context`` neighbouring chunks on each side
+
+        Returns None if the document or the chunk isn't stored.
+        """
+        opened = self._open(str(document_id))
+        if opened is None:
+            return None
+        data, offsets = opened
+        if not 0 <= chunk_id < len(offsets) or offsets[chunk_id][0] < 0:
+            return None
+
+        first = max(0, chunk_id - context)
+        last = min(len(offsets) - 1, chunk_id + context)
+        span = offsets[first : last + 1]
+        span = span[span[:, 0] >= 0]
+        start, end = int(span[:, 0].min()), int(span[:, 1].max())
+        chunk_start, chunk_end, page = (int(value) for value in offsets[chunk_id])
+        return {
+            "chunk_id": chunk_id,
+            "page": page,
+            "text": data[start:end].decode("utf-8"),
+            # Where the chunk itself sits in ``text``, in characters
+            "chunk_start": len(data[start:chunk_start].decode("utf-8")),
+            "chunk_end": len(data[start:chunk_end].decode("utf-8")),
+            "first_chunk_id": first,
+            "last_chunk_id": last,
+        }
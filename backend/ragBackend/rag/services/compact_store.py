@@ -0,0 +1,711 @@
+# rag/services/compact_store.py
+import json
+import mmap
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from .locks import file_lock
+from .mmr import maximal_marginal_relevance
+
+PRECISIONS = ("int8", "float16")
+
+# Rows converted to float32 at a time when scoring quantized codes; small
+# enough for the converted block to stay in cache
+SCORE_BLOCK = 1024
+
+MANIFEST = "manifest.json"
+# Held by writers, across processes, see CompactCollection
+LOCK = ".lock"
+
+
+def _file_version(path: str) -> Optional[Tuple[int, int]]:
+    """Changes whenever ``path`` is replaced, even within the mtime granularity"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _quantize(vectors: np.ndarray, precision: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Codes for the first scoring pass, and the per-row scale of int8 codes"""
+    if precision == "float16":
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _save(path: str, array: np.ndarray) -> None:
+    """Write an .npy file under a temporary name, then swap it in"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+class Segment:
+    """One immutable batch of vectors with their ids, texts and metadata
+
+    Files, all prefixed with the segment name: ``codes.npy`` (int8 or
+    float16, scored first), ``scales.npy`` (per-row scale of int8 codes),
+    ``vectors.npy`` (float32, only read to rescore the best candidates),
+    ``docs`` and ``docs.npy`` (texts and their byte offsets), ``meta.jsonl``
+    (id and metadata per row) and ``deleted.npy`` (tombstones). Arrays and
+    texts are memory-mapped; only ids and metadata are held in memory.
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self.codes = np.load(self._path("codes.npy"), mmap_mode="r")
+        self.scales = (
+            np.load(self._path("scales.npy")) if os.path.exists(self._path("scales.npy")) else None
+        )
+        self.vectors = np.load(self._path("vectors.npy"), mmap_mode="r")
+        if hasattr(mmap, "MADV_RANDOM"):
+            # Rescoring reads scattered rows: don't page in their neighbours
+            self.vectors._mmap.madvise(mmap.MADV_RANDOM)
+        self.offsets = np.load(self._path("docs.npy"))
+        # An empty file can't be mapped
+        self._docs = (
+            np.memmap(self._path("docs"), dtype=np.uint8, mode="r") if self.offsets[-1] else b""
+        )
+        self.ids: List[str] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        with open(self._path("meta.jsonl"), encoding="utf-8") as f:
+            for line in f:
+                chunk_id, metadata = json.loads(line)
+                self.ids.append(chunk_id)
+                self.metadatas.append(metadata)
+        self.deleted = (
+            np.load(self._path("deleted.npy"))
+            if os.path.exists(self._path("deleted.npy"))
+            else np.zeros(len(self.ids), dtype=bool)
+        )
+        self._columns: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def _path(self, part: str) -> str:
+        return os.path.join(self.directory, f"{self.name}.{part}")
+
+    @classmethod
+    def write(
+        cls,
+        directory: str,
+        name: str,
+        ids: Sequence[str],
+        vectors: np.ndarray,
+        documents: Sequence[str],
+        metadatas: Sequence[Dict[str, Any]],
+        precision: str,
+    ) -> "Segment":
+        """Write normalized float32 ``vectors`` and their rows as a new segment"""
+        codes, scales = _quantize(vectors, precision)
+        path = os.path.join(directory, name)
+        np.save(f"{path}.codes.npy", codes)
+        if scales is not None:
+            np.save(f"{path}.scales.npy", scales)
+        np.save(f"{path}.vectors.npy", vectors)
+
+        encoded = [(text or "").encode("utf-8") for text in documents]
+        with open(f"{path}.docs", "wb") as f:
+            f.writelines(encoded)
+        np.save(f"{path}.docs.npy", np.cumsum([0] + [len(text) for text in encoded]))
+        with open(f"{path}.meta.jsonl", "w", encoding="utf-8") as f:
+            for chunk_id, metadata in zip(ids, metadatas):
+                f.write(json.dumps([chunk_id, metadata or {}]) + "\n")
+        return cls(directory, name)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def live_count(self) -> int:
+        return len(self.ids) - int(self.deleted.sum())
+
+    def document(self, row: int) -> str:
+        return bytes(self._docs[self.offsets[row] : self.offsets[row + 1]]).decode("utf-8")
+
+    def save_deleted(self) -> None:
+        _save(self._path("deleted.npy"), self.deleted)
+
+    def load_deleted(self) -> None:
+        """Pick up tombstones another process saved"""
+        if os.path.exists(self._path("deleted.npy")):
+            self.deleted = np.load(self._path("deleted.npy"))
+
+    def remove_files(self) -> None:
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith(f"{self.name}."):
+                os.remove(os.path.join(self.directory, file_name))
+
+    def _column(self, key: str) -> Tuple[np.ndarray, np.ndarray]:
+        """A metadata field as (values, numeric values with NaN where not a number)"""
+        column = self._columns.get(key)
+        if column is None:
+            values = np.empty(len(self.ids), dtype=object)
+            values[:] = [metadata.get(key) for metadata in self.metadatas]
+            numbers = np.array(
+                [
+                    v if isinstance(v, (int, float)) and not isinstance(v, bool) else np.nan
+                    for v in values
+                ],
+                dtype=np.float64,
+            )
+            column = self._columns[key] = (values, numbers)
+        return column
+
+    def _compare(self, key: str, operator: str, value: Any) -> np.ndarray:
+        values, numbers = self._column(key)
+        if operator == "$eq":
+            return values == value
+        if operator == "$ne":
+            return values != value
+        if operator in ("$in", "$nin"):
+            allowed = set(value)
+            found = np.fromiter((v in allowed for v in values), dtype=bool, count=len(values))
+            return found if operator == "$in" else ~found
+        with np.errstate(invalid="ignore"):
+            if operator == "$gt":
+                return numbers > value
+            if operator == "$gte":
+                return numbers >= value
+            if operator == "$lt":
+                return numbers < value
+            if operator == "$lte":
+                return numbers <= value
+        raise ValueError(f"Unsupported where operator: {operator}")
+
+    def match(self, where: Optional[Dict[str, Any]]) -> np.ndarray:
+        """Rows a Chroma-style where clause selects"""
+        masks = []
+        for key, condition in (where or {}).items():
+            if key in ("$and", "$or"):
+                parts = [self.match(part) for part in condition]
+                reduce = np.logical_and if key == "$and" else np.logical_or
+                masks.append(reduce.reduce(parts))
+            elif isinstance(condition, dict):
+                masks.extend(self._compare(key, op, value) for op, value in condition.items())
+            else:
+                masks.append(self._compare(key, "$eq", condition))
+        if not masks:
+            return np.ones(len(self.ids), dtype=bool)
+        return np.logical_and.reduce(masks)
+
+    def live(self, where: Optional[Dict[str, Any]] = None) -> np.ndarray:
+        return ~self.deleted & self.match(where) if where else ~self.deleted
+
+    def approximate_scores(self, queries: np.ndarray) -> np.ndarray:
+        """Dot products of the quantized rows with normalized queries, (rows, queries)
+
+        Each block of codes is converted once and scored against every query
+        in one matrix product.
+        """
+        scores = np.empty((len(self.ids), len(queries)), dtype=np.float32)
+        codes = np.asarray(self.codes)
+        buffer = np.empty((min(SCORE_BLOCK, len(codes)), codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_BLOCK):
+            block = codes[start : start + SCORE_BLOCK]
+            np.copyto(buffer[: len(block)], block, casting="unsafe")
+            np.dot(buffer[: len(block)], queries.T, out=scores[start : start + len(block)])
+        if self.scales is not None:
+            scores *= self.scales[:, None]
+        return scores
+
+
+class CompactCollection:
+    """Append-only vector collection on memory-mapped, quantized segments
+
+    Implements the part of Chroma's collection API the services use
+    (``upsert``, ``get``, ``delete``, ``count``, where clauses), so it can
+    stand in for ``Chroma._collection``. Every upsert writes a new segment;
+    replaced and deleted rows are tombstoned. Searches score int8/float16
+    codes and rescore the best ``rescore`` x k candidates in float32. Once
+    there are more than ``max_segments``, the smaller half is merged in a
+    background thread, dropping tombstoned rows.
+
+    Several processes may open the same directory (web workers, the
+    rebuild and rechunk commands). Writers hold a file lock on it and
+    start from the latest manifest; every write rewrites the manifest, and
+    readers reload when it changes, reusing segments they already
+    have open.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        precision: str = "int8",
+        rescore: int = 4,
+        max_segments: int = 8,
+    ):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown vector precision: {precision}")
+        self.directory = directory
+        self.precision = precision
+        self.rescore = rescore
+        self.max_segments = max_segments
+        self._lock = threading.RLock()
+        self._merge_lock = threading.Lock()
+        self._merge_thread: Optional[threading.Thread] = None
+        self._load()
+
+    def _load(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._next = 0
+        self._segments: Tuple[Segment, ...] = ()
+        self._rows: Dict[str, Tuple[Segment, int]] = {}
+        self._manifest_version: Optional[Tuple[int, int]] = (-1, -1)
+        with file_lock(self._lock_path):
+            self._refresh()
+            # Leftovers of a write or merge that never made it into the manifest;
+            # writers hold the lock, so none is in progress
+            names = {segment.name for segment in self._segments}
+            for file_name in os.listdir(self.directory):
+                if file_name in (MANIFEST, LOCK):
+                    continue
+                if file_name.split(".", 1)[0] not in names:
+                    os.remove(os.path.join(self.directory, file_name))
+
+    @property
+    def _lock_path(self) -> str:
+        return os.path.join(self.directory, LOCK)
+
+    def _refresh(self) -> None:
+        """Reload the segments and tombstones if another process changed them"""
+        path = os.path.join(self.directory, MANIFEST)
+        for _ in range(3):
+            version = _file_version(path)
+            if version == self._manifest_version:
+                return
+            manifest = {"segments": [], "next": 0}
+            if version is not None:
+                with open(path) as f:
+                    manifest = json.load(f)
+
+            with self._lock:
+                known = {segment.name: segment for segment in self._segments}
+                try:
+                    segments = tuple(
+                        known.get(name) or Segment(self.directory, name)
+                        for name in manifest["segments"]
+                    )
+                except FileNotFoundError:
+                    # A merge removed them after we read the manifest: read it again
+                    continue
+                for segment in segments:
+                    if segment.name in known:
+                        segment.load_deleted()
+                rows = {}
+                for segment in segments:
+                    for row in np.flatnonzero(~segment.deleted):
+                        rows[segment.ids[row]] = (segment, int(row))
+                self._segments, self._rows = segments, rows
+                self._next = max(self._next, manifest["next"])
+                self._manifest_version = version
+            return
+
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        """Hold the directory lock on top of the latest version, then publish the change"""
+        with file_lock(self._lock_path), self._lock:
+            self._refresh()
+            yield
+            self._write_manifest()
+
+    def _write_manifest(self) -> None:
+        path = os.path.join(self.directory, MANIFEST)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump({"segments": [s.name for s in self._segments], "next": self._next}, f)
+        os.replace(f"{path}.tmp", path)
+        self._manifest_version = _file_version(path)
+
+    def _new_name(self) -> str:
+        self._next += 1
+        return f"{self._next:08d}"
+
+    @property
+    def dimension(self) -> Optional[int]:
+        segments = self._segments
+        return segments[0].vectors.shape[1] if segments else None
+
+    def count(self) -> int:
+        self._refresh()
+        return len(self._rows)
+
+    def _tombstone(self, ids: Iterable[str]) -> None:
+        changed = set()
+        for chunk_id in ids:
+            found = self._rows.pop(chunk_id, None)
+            if found is not None:
+                segment, row = found
+                segment.deleted[row] = True
+                changed.add(segment)
+        for segment in changed:
+            segment.save_deleted()
+
+    def upsert(
+        self,
+        ids: List[str],
+        embeddings: Sequence[Sequence[float]],
+        documents: List[str] = None,
+        metadatas: List[Dict[str, Any]] = None,
+    ) -> None:
+        if not ids:
+            return
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+        with self._writing():
+            if self.dimension not in (None, vectors.shape[1]):
+                raise ValueError(
+                    f"Embedding dimension {vectors.shape[1]} doesn't match the "
+                    f"collection's {self.dimension}"
+                )
+            segment = Segment.write(
+                self.directory,
+                self._new_name(),
+                ids,
+                vectors,
+                documents or [""] * len(ids),
+                metadatas or [{}] * len(ids),
+                self.precision,
+            )
+            self._tombstone(ids)
+            self._segments = self._segments + (segment,)
+            for row, chunk_id in enumerate(ids):
+                self._rows[chunk_id] = (segment, row)
+        self._maybe_merge()
+
+    add = upsert
+
+    def delete(self, ids: List[str] = None, where: Dict[str, Any] = None) -> None:
+        with self._writing():
+            if where is not None:
+                found = self.get(ids=ids, where=where, include=[])["ids"]
+                self._tombstone(found)
+            else:
+                self._tombstone(ids or [])
+
+    def _select(self, ids: List[str] = None, where: Dict[str, Any] = None):
+        """(segment, row) of every live row matching the ids and where clause"""
+        if ids is not None:
+            found = [self._rows[chunk_id] for chunk_id in ids if chunk_id in self._rows]
+            if where:
+                masks = {segment: segment.match(where) for segment, _ in found}
+                found = [(segment, row) for segment, row in found if masks[segment][row]]
+            return found
+        return [
+            (segment, int(row))
+            for segment in self._segments
+            for row in np.flatnonzero(segment.live(where))
+        ]
+
+    def get(
+        self,
+        ids: List[str] = None,
+        where: Dict[str, Any] = None,
+        limit: int = None,
+        offset: int = None,
+        include: Sequence[str] = ("metadatas", "documents"),
+    ) -> Dict[str, Any]:
+        self._refresh()
+        rows = self._select(ids, where)
+        rows = rows[offset or 0 :]
+        if limit is not None:
+            rows = rows[:limit]
+        return {
+            "ids": [segment.ids[row] for segment, row in rows],
+            "documents": [segment.document(row) for segment, row in rows]
+            if "documents" in include
+            else None,
+            "metadatas": [segment.metadatas[row] for segment, row in rows]
+            if "metadatas" in include
+            else None,
+            "embeddings": [np.array(segment.vectors[row]) for segment, row in rows]
+            if "embeddings" in include
+            else None,
+        }
+
+    def search(
+        self, query: Sequence[float], k: int, where: Dict[str, Any] = None
+    ) -> List[Tuple[Segment, int, float]]:
+        """Top ``k`` live rows by cosine similarity, as (segment, row, score)"""
+        return self.search_many([query], k, where)[0]
+
+    def search_many(
+        self, queries: Sequence[Sequence[float]], k: int, where: Dict[str, Any] = None
+    ) -> List[List[Tuple[Segment, int, float]]]:
+        """``search`` for several queries at once
+
+        Every segment is scored on its quantized codes against all queries in
+        one pass; only the best ``rescore`` x k rows per query are then read
+        back in float32.
+        """
+        if not len(queries):
+            return []
+        self._refresh()
+        queries = _normalize(np.asarray(queries, dtype=np.float32).reshape(len(queries), -1))
+        segments, scores = [], []
+        for segment in self._segments:
+            live = segment.live(where)
+            if live.any():
+                segment_scores = segment.approximate_scores(queries)
+                segment_scores[~live] = -np.inf
+                segments.append(segment)
+                scores.append(segment_scores)
+        if not segments:
+            return [[] for _ in queries]
+
+        scores = np.concatenate(scores)
+        starts = np.cumsum([0] + [len(segment) for segment in segments])
+        take = min(max(k, k * self.rescore), int(np.isfinite(scores[:, 0]).sum()))
+        results = []
+        for column, query in enumerate(queries):
+            candidates = np.sort(np.argpartition(-scores[:, column], take - 1)[:take])
+            found = []
+            owners = np.searchsorted(starts, candidates, side="right") - 1
+            for i in np.unique(owners):
+                rows = candidates[owners == i] - starts[i]
+                # Rescore in float32; sorted rows keep the mmap reads in order
+                exact = segments[i].vectors[rows] @ query
+                found.extend(zip([segments[i]] * len(rows), rows.tolist(), exact.tolist()))
+            found.sort(key=lambda hit: hit[2], reverse=True)
+            results.append(found[:k])
+        return results
+
+    def query(
+        self,
+        query_embeddings: Sequence[Sequence[float]],
+        n_results: int = 10,
+        where: Dict[str, Any] = None,
+        include: Sequence[str] = ("metadatas", "documents", "distances"),
+    ) -> Dict[str, Any]:
+        """Nearest rows per query embedding, in the shape of Chroma's ``query``
+
+        Distances are cosine distances.
+        """
+        results = {"ids": [], "documents": [], "metadatas": [], "embeddings": [], "distances": []}
+        for hits in self.search_many(query_embeddings, n_results, where):
+            results["ids"].append([segment.ids[row] for segment, row, _ in hits])
+            results["documents"].append([segment.document(row) for segment, row, _ in hits])
+            results["metadatas"].append([segment.metadatas[row] for segment, row, _ in hits])
+            results["embeddings"].append(
+                np.array([segment.vectors[row] for segment, row, _ in hits], dtype=np.float32)
+            )
+            results["distances"].append([1 - score for _, _, score in hits])
+        return {
+            key: value if key == "ids" or key in include else None
+            for key, value in results.items()
+        }
+
+    def _maybe_merge(self) -> None:
+        with self._lock:
+            if len(self._segments) <= self.max_segments:
+                return
+            if self._merge_thread is not None and self._merge_thread.is_alive():
+                return
+            self._merge_thread = threading.Thread(
+                target=self.merge, name="compact-merge", daemon=True
+            )
+            self._merge_thread.start()
+
+    def merge(self, segments: List[Segment] = None) -> None:
+        """Rewrite segments (by default the smaller half) into one, dropping deleted rows
+
+        Segments grow geometrically this way, so each row is rewritten a
+        logarithmic number of times. Searches keep using the old segments
+        until the merged one is swapped in; writes, from any process, wait
+        for it.
+        """
+        with self._merge_lock:
+            with self._writing():
+                if segments is None:
+                    by_size = sorted(self._segments, key=len)
+                    segments = by_size[: max(2, len(by_size) // 2)]
+                else:
+                    # Another process may have merged some of them already
+                    names = {segment.name for segment in segments}
+                    segments = [s for s in self._segments if s.name in names]
+                if len(segments) < 2:
+                    return
+                self._merge(segments)
+            # Only once the manifest no longer lists them
+            for segment in segments:
+                segment.remove_files()
+
+    def _merge(self, segments: List[Segment]) -> None:
+        """Rewrite ``segments`` as one; the caller holds the write lock"""
+        sources = [(s, int(row)) for s in segments for row in np.flatnonzero(~s.deleted)]
+        merged = Segment.write(
+            self.directory,
+            self._new_name(),
+            [s.ids[row] for s, row in sources],
+            np.array([s.vectors[row] for s, row in sources], dtype=np.float32).reshape(
+                len(sources), -1
+            ),
+            [s.document(row) for s, row in sources],
+            [s.metadatas[row] for s, row in sources],
+            self.precision,
+        )
+
+        for i, (segment, row) in enumerate(sources):
+            self._rows[segment.ids[row]] = (merged, i)
+        self._segments = tuple(s for s in self._segments if s not in segments) + (merged,)
+
+    def reset(self) -> None:
+        """Delete every vector"""
+        self.close()
+        with file_lock(self._lock_path), self._lock:
+            for file_name in os.listdir(self.directory):
+                if file_name != LOCK:
+                    os.remove(os.path.join(self.directory, file_name))
+            self._segments, self._rows = (), {}
+            self._write_manifest()
+
+    def close(self) -> None:
+        """Wait for a running merge"""
+        thread = self._merge_thread
+        if thread is not None:
+            thread.join()
+
+
+class CompactVectorStore(VectorStore):
+    """LangChain vector store over a ``CompactCollection``
+
+    ``_collection`` mirrors ``Chroma._collection``, so code that writes
+    precomputed embeddings or reads chunks by id works on either store.
+    """
+
+    def __init__(self, collection: CompactCollection, embedding_function: Embeddings):
+        self._collection = collection
+        self._embedding_function = embedding_function
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: List[Dict[str, Any]] = None,
+        ids: List[str] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        self._collection.upsert(
+            ids, self._embedding_function.embed_documents(texts), texts, metadatas
+        )
+        return ids
+
+    def delete(self, ids: List[str] = None, **kwargs: Any) -> Optional[bool]:
+        self._collection.delete(ids=ids)
+        return True
+
+    def get_by_ids(self, ids: Sequence[str]) -> List[Document]:
+        found = self._collection.get(ids=list(ids))
+        return [
+            Document(page_content=text, metadata=metadata, id=chunk_id)
+            for chunk_id, text, metadata in zip(
+                found["ids"], found["documents"], found["metadatas"]
+            )
+        ]
+
+    def _documents(self, hits: List[Tuple[Segment, int, float]]) -> List[Tuple[Document, float]]:
+        return [
+            (
+                Document(
+                    page_content=segment.document(row),
+                    metadata=segment.metadatas[row],
+                    id=segment.ids[row],
+                ),
+                score,
+            )
+            for segment, row, score in hits
+        ]
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4, filter: Dict[str, Any] = None
+    ) -> List[Tuple[Document, float]]:
+        """Best matches with their cosine similarity"""
+        return self._documents(self._collection.search(embedding, k, filter))
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Dict[str, Any] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Dict[str, Any] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, filter)
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Dict[str, Any] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        # Scores are already cosine similarities
+        return lambda score: score
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Dict[str, Any] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        hits = self._collection.search(embedding, fetch_k, filter)
+        if not hits:
+            return []
+        vectors = np.array([segment.vectors[row] for segment, row, _ in hits], dtype=np.float32)
+        selected = maximal_marginal_relevance(embedding, vectors, k, lambda_mult)
+        docs = self._documents(hits)
+        # In relevance order, like Chroma's MMR search
+        return [docs[i][0] for i in sorted(selected)]
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Dict[str, Any] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.max_marginal_relevance_search_by_vector(
+            embedding, k, fetch_k, lambda_mult, filter
+        )
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: List[Dict[str, Any]] = None,
+        ids: List[str] = None,
+        directory: str = None,
+        **kwargs: Any,
+    ) -> "CompactVectorStore":
+        if directory is None:
+            raise ValueError("CompactVectorStore.from_texts needs a directory")
+        store = cls(CompactCollection(directory, **kwargs), embedding)
+        store.add_texts(texts, metadatas, ids)
+        return store
@@ -0,0 +1,71 @@
+# rag/services/context.py
+from typing import Callable, List, NamedTuple
+
+from langchain.schema import Document
+
+SEPARATOR = "\n\n"
+
+# Overlaps shorter than this are treated as coincidence; longer than this
+# can't come from the splitter's 200-char chunk overlap
+MIN_OVERLAP = 32
+MAX_OVERLAP = 400
+
+
+class PackedContext(NamedTuple):
+    docs: List[Document]
+    context: str
+    tokens: int
+
+
+def _overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of ``left`` that is also a prefix of ``right``"""
+    probe = right[:MIN_OVERLAP]
+    if len(probe) < MIN_OVERLAP:
+        return 0
+    start = left.find(probe, max(0, len(left) - MAX_OVERLAP))
+    while start != -1:
+        if right.startswith(left[start:]):
+            return len(left) - start
+        start = left.find(probe, start + 1)
+    return 0
+
+
+class ContextAssembler:
+    """Pack ranked chunks into a token budget
+
+    Chunks are taken in rank order and measured with the model's own
+    tokenizer; a chunk that doesn't fit is skipped in favour of smaller,
+    lower-ranked ones. Text a chunk shares with one already packed (the
+    splitter's overlap between neighbouring chunks, or a duplicate upload)
+    is cut before it is counted.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int]):
+        self.count_tokens = count_tokens
+
+    def dedupe(self, text: str, packed: List[str]) -> str:
+        """Strip the parts of ``text`` already present in packed passages"""
+        for other in packed:
+            if text in other:
+                return ""
+            text = text[_overlap(other, text) :]
+            overlap = _overlap(text, other)
+            if overlap:
+                text = text[:-overlap]
+        return text.strip()
+
+    def pack(self, docs: List[Document], budget: int) -> PackedContext:
+        """Select and trim chunks so the joined context stays within ``budget`` tokens"""
+        separator_tokens = self.count_tokens(SEPARATOR)
+        selected, passages, used = [], [], 0
+        for doc in docs:
+            text = self.dedupe(doc.page_content, passages)
+            if not text:
+                continue
+            tokens = self.count_tokens(text) + (separator_tokens if passages else 0)
+            if used + tokens > budget:
+                continue
+            selected.append(doc)
+            passages.append(text)
+            used += tokens
+        return PackedContext(selected, SEPARATOR.join(passages), used)
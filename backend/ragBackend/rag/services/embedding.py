@@ -1,9 +1,272 @@
-from langchain_huggingface import HuggingFaceEmbeddings
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from langchain_core.embeddings import Embeddings
+
+from . import tracing
+from .embedding_cache import EmbeddingCache, chunk_hash
+
+
+def _resolve_device() -> str:
+    """Pick the embedding device, falling back to CPU when CUDA is unavailable"""
+    device = getattr(settings, "RAG_EMBEDDING_DEVICE", "auto")
+    try:
+        import torch
+    except ImportError:
+        return "cpu"
+
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if device == "cpu":
+        # Respect the configured thread count instead of grabbing every core
+        threads = getattr(settings, "RAG_EMBEDDING_CPU_THREADS", 0) or os.cpu_count()
+        torch.set_num_threads(threads)
+    return device
 
 
 def get_embeddings():
     """Create and configure the embeddings model"""
+    from langchain_huggingface import HuggingFaceEmbeddings
+
     return HuggingFaceEmbeddings(
         model_name="sentence-transformers/all-MiniLM-L6-v2",
-        model_kwargs={"device": "cuda"},
+        model_kwargs={"device": _resolve_device()},
+        encode_kwargs={"batch_size": getattr(settings, "RAG_EMBEDDING_BATCH_SIZE", 32)},
     )
+
+
+def model_id(model: Embeddings) -> str:
+    """Identify a model for cache keys, e.g. the HuggingFace model name"""
+    name = getattr(model, "model_name", None)
+    if name:
+        return name
+    size = getattr(model, "size", None)
+    return f"{type(model).__name__}-{size}" if size else type(model).__name__
+
+
+def _query_key(text: str) -> str:
+    """Whitespace never changes the tokens, so it doesn't change the key"""
+    return " ".join(text.split())
+
+
+class QueryMicroBatcher:
+    """Merge query embeddings that arrive within a few milliseconds of each other
+
+    Callers block on a future while a single background thread collects
+    requests for up to ``window_ms`` (or until ``max_batch`` are waiting)
+    and embeds them in one model call.
+    """
+
+    def __init__(self, model: Embeddings, window_ms: float = 5, max_batch: int = 64):
+        self.model = model
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._loop, name="rag-query-embedder", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text: str) -> List[float]:
+        return self.submit(text).result()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=1)
+
+    def _loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Serve what we have, then stop on the next loop
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+
+            texts = [text for text, _ in batch]
+            try:
+                vectors = self.model.embed_documents(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+
+class EmbeddingService(Embeddings):
+    """Batched embedding engine shared across ingestion and queries
+
+    Documents are sorted by length and embedded in fixed-size batches so
+    each batch pads to a similar length; single queries go through a
+    micro-batching queue so concurrent requests share one model call.
+    With a cache, only chunks never embedded by this model reach it; the
+    last ``query_cache_size`` query embeddings are kept in memory.
+    """
+
+    def __init__(
+        self,
+        model: Embeddings,
+        batch_size: int = 32,
+        bucket_by_length: bool = True,
+        micro_batch_window_ms: float = 5,
+        micro_batch_max: int = 64,
+        cache: EmbeddingCache = None,
+        query_cache_size: int = 0,
+    ):
+        self.model = model
+        self.model_id = model_id(model)
+        self.cache = cache
+        self.batch_size = batch_size
+        self.bucket_by_length = bucket_by_length
+        self.batcher = (
+            QueryMicroBatcher(model, micro_batch_window_ms, micro_batch_max)
+            if micro_batch_window_ms > 0
+            else None
+        )
+        self.query_cache_size = query_cache_size
+        self._query_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, model: Embeddings) -> "EmbeddingService":
+        cache_dir = getattr(settings, "RAG_EMBEDDING_CACHE_DIR", None)
+        return cls(
+            model,
+            batch_size=getattr(settings, "RAG_EMBEDDING_BATCH_SIZE", 32),
+            micro_batch_window_ms=getattr(settings, "RAG_EMBEDDING_MICRO_BATCH_MS", 5),
+            query_cache_size=getattr(settings, "RAG_QUERY_EMBEDDING_CACHE_SIZE", 1024),
+            cache=EmbeddingCache(
+                cache_dir, getattr(settings, "RAG_EMBEDDING_CACHE_MAX_ENTRIES", 500_000)
+            )
+            if cache_dir
+            else None,
+        )
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, serving previously embedded chunks from the cache"""
+        with tracing.span("embed_documents"):
+            return self._embed_documents(texts)
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.cache is None:
+            return self._embed_batched(texts)
+
+        vectors = self.cache.get_many(self.model_id, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if not missing:
+            return vectors
+
+        # Embed each distinct chunk once, even if it repeats within the call
+        unique: dict = {}
+        for i in missing:
+            unique.setdefault(chunk_hash(texts[i]), texts[i])
+        fresh = dict(zip(unique, self._embed_batched(list(unique.values()))))
+        self.cache.put_many(self.model_id, list(unique.values()), list(fresh.values()))
+
+        for i in missing:
+            vectors[i] = fresh[chunk_hash(texts[i])]
+        return vectors
+
+    def _embed_batched(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in length-bucketed batches, preserving input order"""
+        order = list(range(len(texts)))
+        if self.bucket_by_length:
+            order.sort(key=lambda i: len(texts[i]))
+
+        vectors: List[Optional[List[float]]] = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            for i, vector in zip(batch, self.model.embed_documents([texts[i] for i in batch])):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        with tracing.span("embed_query"):
+            if not self.query_cache_size:
+                return self._embed_query(text)
+
+            key = _query_key(text)
+            vector = self._cached_queries([key]).get(key)
+            result = "miss" if vector is None else "hit"
+            tracing.count("rag_query_embedding_cache_total", result=result)
+            if vector is None:
+                vector = self._embed_query(text)
+                self._cache_queries({key: vector})
+            # Callers get their own copy to modify
+            return list(vector)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed many queries at once, e.g. a batch of questions
+
+        Queries in the cache and repeats within the call are served without
+        the model; the rest go through the length-bucketed document batches
+        (the query micro-batcher embeds with ``embed_documents`` too).
+        """
+        with tracing.span("embed_queries"):
+            keys = [_query_key(text) for text in texts]
+            vectors = self._cached_queries(keys) if self.query_cache_size else {}
+            missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+            if self.query_cache_size:
+                tracing.count("rag_query_embedding_cache_total", len(missing), result="miss")
+                tracing.count(
+                    "rag_query_embedding_cache_total", len(keys) - len(missing), result="hit"
+                )
+            if missing:
+                fresh = dict(zip(missing, self._embed_batched(missing)))
+                if self.query_cache_size:
+                    self._cache_queries(fresh)
+                vectors.update(fresh)
+            return [list(vectors[key]) for key in keys]
+
+    def _cached_queries(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._query_cache_lock:
+            for key in keys:
+                vector = self._query_cache.get(key)
+                if vector is not None:
+                    self._query_cache.move_to_end(key)
+                    found[key] = vector
+        return found
+
+    def _cache_queries(self, vectors: Dict[str, List[float]]) -> None:
+        with self._query_cache_lock:
+            self._query_cache.update(vectors)
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+
+    def _embed_query(self, text: str) -> List[float]:
+        if self.batcher is None:
+            return self.model.embed_query(text)
+        return self.batcher.embed(text)
+
+    def close(self) -> None:
+        if self.batcher is not None:
+            self.batcher.close()
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,252 @@
+# rag/services/embedding_cache.py
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so re-extracted chunks map to the same key"""
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def chunk_hash(text: str) -> str:
+    """Content hash of a chunk's normalized text"""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent embedding cache keyed by (model id, chunk text hash)
+
+    Vectors live in one float32 array file per model, opened with
+    ``np.memmap`` so lookups only page in the rows they touch. A SQLite
+    index maps each key to its row ("slot") and last-use time, which drives
+    LRU eviction once a model holds more than ``max_entries`` vectors.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 500_000):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._arrays: Dict[str, np.memmap] = {}
+        self._db = sqlite3.connect(
+            os.path.join(directory, "index.sqlite3"),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS models (
+                model TEXT PRIMARY KEY,
+                dim INTEGER NOT NULL,
+                capacity INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, hash)
+            );
+            CREATE INDEX IF NOT EXISTS entries_lru ON entries (model, last_used);
+            CREATE TABLE IF NOT EXISTS free_slots (
+                model TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                PRIMARY KEY (model, slot)
+            );
+            """
+        )
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _array_path(self, model: str) -> str:
+        safe = re.sub(r"[^A-Za-z0-9_.-]", "_", model)
+        return os.path.join(self.directory, f"{safe}.f32")
+
+    def _model_info(self, model: str):
+        return self._db.execute(
+            "SELECT dim, capacity FROM models WHERE model = ?", (model,)
+        ).fetchone()
+
+    def _array(self, model: str, dim: int, capacity: int) -> np.memmap:
+        """Map the model's vector file, remapping if another process grew it"""
+        array = self._arrays.get(model)
+        if array is None or array.shape[0] < capacity:
+            path = self._array_path(model)
+            needed = capacity * dim * 4
+            if not os.path.exists(path) or os.path.getsize(path) < needed:
+                with open(path, "ab") as f:
+                    f.truncate(needed)
+            array = np.memmap(path, dtype=np.float32, mode="r+", shape=(capacity, dim))
+            self._arrays[model] = array
+        return array
+
+    def _lookup(self, model: str, hashes: List[str]) -> Dict[str, int]:
+        """Map the cached hashes among ``hashes`` to their slots"""
+        slots = {}
+        unique = list(set(hashes))
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(unique), 500):
+            batch = unique[start : start + 500]
+            placeholders = ",".join("?" * len(batch))
+            slots.update(
+                self._db.execute(
+                    f"SELECT hash, slot FROM entries WHERE model = ? AND hash IN ({placeholders})",
+                    [model, *batch],
+                ).fetchall()
+            )
+        return slots
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Look up cached vectors; misses come back as ``None``"""
+        hashes = [chunk_hash(text) for text in texts]
+        results: List[Optional[List[float]]] = [None] * len(texts)
+
+        with self._lock:
+            info = self._model_info(model)
+            if info is None:
+                self.misses += len(texts)
+                return results
+            dim, capacity = info
+
+            slots = self._lookup(model, hashes)
+            if slots:
+                array = self._array(model, dim, capacity)
+                for i, h in enumerate(hashes):
+                    if h in slots:
+                        results[i] = array[slots[h]].tolist()
+
+                now = time.time()
+                self._db.executemany(
+                    "UPDATE entries SET last_used = ? WHERE model = ? AND hash = ?",
+                    [(now, model, h) for h in slots],
+                )
+
+            hit_count = sum(1 for r in results if r is not None)
+            self.hits += hit_count
+            self.misses += len(texts) - hit_count
+        return results
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]) -> None:
+        """Store vectors for texts, evicting least recently used entries if full"""
+        if not texts:
+            return
+        pending = {chunk_hash(t): v for t, v in zip(texts, vectors)}
+        dim = len(next(iter(pending.values())))
+
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                info = self._model_info(model)
+                if info is None:
+                    capacity = max(1024, len(pending))
+                    self._db.execute(
+                        "INSERT INTO models (model, dim, capacity) VALUES (?, ?, ?)",
+                        (model, dim, capacity),
+                    )
+                else:
+                    dim, capacity = info
+
+                # Skip texts another writer already cached
+                known = self._lookup(model, list(pending))
+                new = [h for h in pending if h not in known]
+                slots, capacity = self._allocate(model, len(new), capacity)
+
+                array = self._array(model, dim, capacity)
+                now = time.time()
+                for h, slot in zip(new, slots):
+                    array[slot] = np.asarray(pending[h], dtype=np.float32)
+                array.flush()
+                self._db.executemany(
+                    "INSERT INTO entries (model, hash, slot, last_used) VALUES (?, ?, ?, ?)",
+                    [(model, h, slot, now) for h, slot in zip(new, slots)],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _allocate(self, model: str, count: int, capacity: int) -> Tuple[List[int], int]:
+        """Hand out free rows, evicting LRU entries once the model is at its limit
+
+        Returns the slots and the (possibly grown) array capacity.
+        """
+        if count == 0:
+            return [], capacity
+
+        size = self._db.execute(
+            "SELECT COUNT(*) FROM entries WHERE model = ?", (model,)
+        ).fetchone()[0]
+        overflow = size + count - self.max_entries
+        if overflow > 0:
+            evicted = self._db.execute(
+                "SELECT hash, slot FROM entries WHERE model = ? ORDER BY last_used LIMIT ?",
+                (model, overflow),
+            ).fetchall()
+            self._db.executemany(
+                "DELETE FROM entries WHERE model = ? AND hash = ?",
+                [(model, h) for h, _ in evicted],
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO free_slots (model, slot) VALUES (?, ?)",
+                [(model, slot) for _, slot in evicted],
+            )
+            self.evictions += len(evicted)
+
+        free = [
+            row[0]
+            for row in self._db.execute(
+                "SELECT slot FROM free_slots WHERE model = ? LIMIT ?", (model, count)
+            ).fetchall()
+        ]
+        self._db.executemany(
+            "DELETE FROM free_slots WHERE model = ? AND slot = ?",
+            [(model, slot) for slot in free],
+        )
+
+        # Fresh rows continue after the highest slot ever handed out
+        next_slot = self._db.execute(
+            "SELECT COALESCE(MAX(slot) + 1, 0) FROM ("
+            "SELECT slot FROM entries WHERE model = ? "
+            "UNION ALL SELECT slot FROM free_slots WHERE model = ?)",
+            (model, model),
+        ).fetchone()[0]
+        next_slot = max(next_slot, max(free, default=-1) + 1)
+        fresh = list(range(next_slot, next_slot + count - len(free)))
+
+        # Grow the array file geometrically
+        if fresh and fresh[-1] >= capacity:
+            capacity = max(capacity * 2, fresh[-1] + 1)
+            self._db.execute(
+                "UPDATE models SET capacity = ? WHERE model = ?", (capacity, model)
+            )
+        return free + fresh, capacity
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            for array in self._arrays.values():
+                array.flush()
+            self._arrays = {}
+            self._db.close()
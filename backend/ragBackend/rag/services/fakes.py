@@ -0,0 +1,160 @@
+import hashlib
+import threading
+import time
+import zlib
+from typing import Any, Iterator, List, Optional, Sequence
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+# Shared by every fake model that simulates a single accelerator
+_DEVICE_LOCK = threading.Lock()
+
+
+class FakeEmbeddings(DeterministicFakeEmbedding):
+    """Deterministic embeddings for tests and benchmarks (no model download, no GPU)"""
+
+    size: int = 384
+
+
+class FakeLlamaClient:
+    """Stand-in for ``llama_cpp.Llama``'s tokenizer and KV cache
+
+    Tokens are whitespace-separated words. Evaluating a token costs
+    ``prefill_delay``; like llama.cpp, ``prefill`` only evaluates the part
+    of a prompt that isn't already cached.
+    """
+
+    def __init__(self, prefill_delay: float = 0.0):
+        self.prefill_delay = prefill_delay
+        self.input_ids: List[int] = []
+        self.evaluated = 0
+
+    @property
+    def _input_ids(self) -> List[int]:
+        return self.input_ids
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        return ([1] if add_bos else []) + [zlib.crc32(word) for word in text.split()]
+
+    def reset(self) -> None:
+        self.input_ids = []
+
+    def eval(self, tokens: Sequence[int]) -> None:
+        if self.prefill_delay:
+            time.sleep(self.prefill_delay * len(tokens))
+        self.evaluated += len(tokens)
+        self.input_ids.extend(tokens)
+
+    def save_state(self) -> List[int]:
+        return list(self.input_ids)
+
+    def load_state(self, state: List[int]) -> None:
+        self.input_ids = list(state)
+
+    def prefill(self, prompt: str) -> None:
+        tokens = self.tokenize(prompt.encode("utf-8"))
+        cached = 0
+        for a, b in zip(self.input_ids, tokens[:-1]):
+            if a != b:
+                break
+            cached += 1
+        self.input_ids = self.input_ids[:cached]
+        self.eval(tokens[cached:])
+
+
+class FakeLLM(LLM):
+    """Deterministic LLM that answers from the prompt it was given
+
+    The answer is derived from a hash of the prompt so identical prompts
+    always produce identical answers. ``token_delay`` simulates decode time
+    and an optional ``client`` simulates prompt prefill.
+    """
+
+    max_tokens: int = 32
+    n_ctx: int = 4096
+    token_delay: float = 0.0
+    client: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _tokens(self, prompt: str) -> List[str]:
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        words = [digest[i : i + 4] for i in range(0, len(digest), 4)]
+        return [f"{word} " for word in (words * 4)[: self.max_tokens]]
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> str:
+        return "".join(chunk.text for chunk in self._stream(prompt, stop, run_manager))
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        if self.client is not None:
+            self.client.prefill(prompt)
+        for token in self._tokens(prompt):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+class PaddedFakeEmbeddings(FakeEmbeddings):
+    """Fake embeddings whose latency models a padded transformer batch
+
+    Each call costs ``call_overhead`` plus ``cost_per_token`` for every
+    (batch size x longest text) token slot, so short texts batched with
+    long ones pay for padding just like a real model does. Calls are
+    serialised, like kernels queued on a single GPU.
+    """
+
+    call_overhead: float = 0.002
+    cost_per_token: float = 1e-6
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if texts:
+            longest = max(len(text.split()) for text in texts)
+            with _DEVICE_LOCK:
+                time.sleep(self.call_overhead + self.cost_per_token * len(texts) * longest)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class StubScorer:
+    """Deterministic offline stand-in for a cross-encoder
+
+    A passage scores the share of the query's terms it contains; each
+    scored pair costs ``delay`` seconds, to exercise latency budgets.
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+
+    def score(self, query_text: str, texts: List[str]) -> List[float]:
+        from .keyword_index import tokenize
+
+        if self.delay:
+            time.sleep(self.delay * len(texts))
+        terms = set(tokenize(query_text))
+        if not terms:
+            return [0.0] * len(texts)
+        return [len(terms & set(tokenize(text))) / len(terms) for text in texts]
@@ -0,0 +1,143 @@
+# rag/services/filters.py
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ..models import Document as DocumentModel
+
+# Chroma where clause, None when a collection is searched unrestricted
+Where = Optional[Dict[str, Any]]
+
+
+def _strings(data: Dict[str, Any], key: str) -> Tuple[str, ...]:
+    values = data.get(key) or []
+    if isinstance(values, str):
+        values = [values]
+    if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+        raise ValueError(f"{key} must be a list of strings")
+    return tuple(values)
+
+
+def _page(data: Dict[str, Any], key: str) -> Optional[int]:
+    value = data.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError(f"{key} must be a non-negative integer")
+    return value
+
+
+def _datetime(data: Dict[str, Any], key: str) -> Optional[datetime]:
+    value = data.get(key)
+    if value is None:
+        return None
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    if parsed is None:
+        raise ValueError(f"{key} must be an ISO 8601 date and time")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class RetrievalFilter(NamedTuple):
+    """Restrict retrieval to some documents and pages
+
+    Document conditions (ids, names, upload time) are resolved against the
+    Document table into the source paths of the matching documents; the
+    page range applies to each chunk's ``page`` (the page it starts on, as
+    reported in the sources). Both are pushed down into the Chroma where
+    clause, so only the matching chunks are searched.
+    """
+
+    document_ids: Tuple[str, ...] = ()
+    document_names: Tuple[str, ...] = ()
+    page_min: Optional[int] = None
+    page_max: Optional[int] = None
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> Optional["RetrievalFilter"]:
+        """Parse request filters; None if there are none. Raises ValueError"""
+        if not data:
+            return None
+        if not isinstance(data, dict):
+            raise ValueError("filters must be an object")
+        unknown = set(data) - set(cls._fields)
+        if unknown:
+            raise ValueError(f"Unknown filters: {', '.join(sorted(unknown))}")
+
+        document_ids = _strings(data, "document_ids")
+        for document_id in document_ids:
+            try:
+                uuid.UUID(document_id)
+            except ValueError:
+                raise ValueError(f"Invalid document id: {document_id}")
+
+        filters = cls(
+            document_ids=document_ids,
+            document_names=_strings(data, "document_names"),
+            page_min=_page(data, "page_min"),
+            page_max=_page(data, "page_max"),
+            created_after=_datetime(data, "created_after"),
+            created_before=_datetime(data, "created_before"),
+        )
+        return filters if filters != cls() else None
+
+    @property
+    def selects_documents(self) -> bool:
+        return bool(
+            self.document_ids or self.document_names or self.created_after or self.created_before
+        )
+
+    def scope(self) -> Dict[str, Any]:
+        """The filters as plain values, for the answer cache scope"""
+        return {key: value for key, value in self._asdict().items() if value not in (None, ())}
+
+    def _page_conditions(self) -> List[Dict[str, Any]]:
+        conditions = []
+        if self.page_min is not None:
+            conditions.append({"page": {"$gte": self.page_min}})
+        if self.page_max is not None:
+            conditions.append({"page": {"$lte": self.page_max}})
+        return conditions
+
+    def resolve(self, collections: List[str]) -> Dict[str, Where]:
+        """Where clause per collection that can match at all
+
+        Collections without a matching document are left out, so they are
+        not searched.
+        """
+        pages = self._page_conditions()
+        if not self.selects_documents:
+            where = _combine(pages)
+            return {name: where for name in collections}
+
+        documents = DocumentModel.objects.filter(collection__in=collections)
+        if self.document_ids:
+            documents = documents.filter(id__in=self.document_ids)
+        if self.document_names:
+            documents = documents.filter(name__in=self.document_names)
+        if self.created_after:
+            documents = documents.filter(created_at__gte=self.created_after)
+        if self.created_before:
+            documents = documents.filter(created_at__lte=self.created_before)
+
+        paths: Dict[str, List[str]] = {}
+        for collection, file_path in documents.values_list("collection", "file_path"):
+            paths.setdefault(collection, []).append(file_path)
+        return {
+            name: _combine([{"source": {"$in": sources}}] + pages)
+            for name, sources in paths.items()
+        }
+
+
+def _combine(conditions: List[Dict[str, Any]]) -> Where:
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
@@ -0,0 +1,275 @@
+# rag/services/ingestion.py
+import itertools
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List
+
+from langchain.schema import Document
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from . import tracing
+from .answer_cache import get_answer_cache
+from .chroma_db import ChromaDBService
+from .pdf import PDFProcessor, file_fingerprint
+from ..models import Document as DocumentModel, IngestionJob
+
+logger = logging.getLogger(__name__)
+
+# Number of chunks embedded (and, when streaming, upserted) between two
+# progress updates
+EMBED_BATCH_SIZE = 64
+
+
+class IngestionQueueFull(Exception):
+    """Raised when too many ingestion jobs are already waiting"""
+
+
+class IngestionPipeline:
+    """Local worker pool running parse -> split -> embed -> upsert for uploads
+
+    Parsing and splitting run on up to ``RAG_INGEST_WORKERS`` threads, while
+    the embed stage (the GPU-bound one) is capped at
+    ``RAG_MAX_CONCURRENT_EMBED_JOBS`` jobs at a time.
+    """
+
+    def __init__(
+        self, max_workers: int = None, max_embed_jobs: int = None, max_pending: int = None
+    ):
+        self.max_workers = max_workers or getattr(settings, "RAG_INGEST_WORKERS", 2)
+        self.max_pending = max_pending or getattr(settings, "RAG_INGEST_QUEUE_LIMIT", 100)
+        self.embed_slots = threading.BoundedSemaphore(
+            max_embed_jobs or getattr(settings, "RAG_MAX_CONCURRENT_EMBED_JOBS", 1)
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="rag-ingest"
+        )
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _reserve(self, count: int) -> None:
+        with self._pending_lock:
+            if self._pending + count > self.max_pending:
+                raise IngestionQueueFull(
+                    f"{self._pending} ingestion jobs already pending, try again later"
+                )
+            self._pending += count
+
+    def _release(self, count: int = 1) -> None:
+        with self._pending_lock:
+            self._pending -= count
+
+    def submit(self, document: DocumentModel) -> IngestionJob:
+        """Queue a document for indexing and return its job"""
+        self._reserve(1)
+        job = IngestionJob.objects.create(document=document)
+        self.executor.submit(self._run, job.id)
+        return job
+
+    def submit_bulk(self, documents: List[DocumentModel]) -> List[IngestionJob]:
+        """Queue many documents whose parsing fans out over a process pool"""
+        self._reserve(len(documents))
+        jobs = [IngestionJob.objects.create(document=document) for document in documents]
+        self.executor.submit(self._run_bulk, [job.id for job in jobs])
+        return jobs
+
+    def _update(self, job_id, **fields) -> None:
+        # QuerySet.update() skips auto_now, so stamp updated_at explicitly
+        IngestionJob.objects.filter(pk=job_id).update(updated_at=timezone.now(), **fields)
+        if fields.get("status") in (IngestionJob.STATUS_COMPLETED, IngestionJob.STATUS_FAILED):
+            tracing.count("rag_ingestion_jobs_total", status=fields["status"])
+
+    def _run(self, job_id) -> None:
+        try:
+            job = IngestionJob.objects.select_related("document").get(pk=job_id)
+            self._update(job_id, status=IngestionJob.STATUS_RUNNING)
+            self.process(job)
+        except Exception:
+            logger.exception("Error processing ingestion job %s", job_id)
+            self._update(
+                job_id, status=IngestionJob.STATUS_FAILED, error=traceback.format_exc()
+            )
+        finally:
+            self._release()
+            close_old_connections()
+
+    def _run_bulk(self, job_ids: List) -> None:
+        jobs = {
+            job.document.file_path: job
+            for job in IngestionJob.objects.select_related("document").filter(pk__in=job_ids)
+        }
+        IngestionJob.objects.filter(pk__in=job_ids).update(
+            status=IngestionJob.STATUS_RUNNING,
+            stage=IngestionJob.STAGE_PARSE,
+            updated_at=timezone.now(),
+        )
+        try:
+            # Files come back as soon as they are parsed and split, so the
+            # first ones are embedded while the rest are still being parsed
+            hashes = {
+                file_path: job.document.file_hash
+                for file_path, job in jobs.items()
+                if job.document.file_hash
+            }
+            for result in PDFProcessor().process_many(list(jobs), file_hashes=hashes):
+                job = jobs.pop(result["file_path"])
+                try:
+                    if "error" in result:
+                        raise RuntimeError(result["error"])
+                    self._update(
+                        job.id,
+                        stage=IngestionJob.STAGE_SPLIT,
+                        pages_parsed=result["page_count"],
+                        chunks_total=len(result["chunks"]),
+                    )
+                    self.index(job, result["chunks"])
+                except Exception:
+                    logger.exception("Error processing ingestion job %s", job.id)
+                    self._update(
+                        job.id, status=IngestionJob.STATUS_FAILED, error=traceback.format_exc()
+                    )
+                finally:
+                    self._release()
+        except Exception:
+            # The pool itself failed: fail whatever was still waiting
+            for job in jobs.values():
+                self._update(
+                    job.id, status=IngestionJob.STATUS_FAILED, error=traceback.format_exc()
+                )
+            self._release(len(jobs))
+        finally:
+            close_old_connections()
+
+    def process(self, job: IngestionJob) -> List[str]:
+        """Stream a job's document through every stage in the calling thread
+
+        Pages are parsed and split lazily and chunks are embedded and
+        upserted ``RAG_INGEST_WINDOW`` at a time, so memory use stays flat
+        however long the document is.
+        """
+        document = job.document
+        chroma = ChromaDBService(collection_name=document.collection)
+        window_size = getattr(settings, "RAG_INGEST_WINDOW", EMBED_BATCH_SIZE)
+        chunks = PDFProcessor().iter_chunks(
+            document.file_path, document.name, document.file_hash or None
+        )
+
+        # Vectors from any earlier upload of this file keep answering queries
+        # until the new ones are all in; chunk ids are stable, so most are
+        # overwritten in place and the rest are deleted at the end
+        self._update(job.id, stage=IngestionJob.STAGE_PARSE)
+        old_ids = chroma.document_vector_ids(document)
+
+        ids = []
+        try:
+            # The store file is only published once every window is in
+            with chroma.chunk_store.writer(document.id) as stored:
+                for window in _windows(chunks, window_size):
+                    page = window[-1].metadata
+                    self._update(
+                        job.id,
+                        stage=IngestionJob.STAGE_EMBED,
+                        pages_parsed=page.get("page", 0) + 1,
+                        pages_total=page.get("total_pages", 0),
+                    )
+                    with self.embed_slots:
+                        embeddings = chroma.embeddings.embed_documents(
+                            [c.page_content for c in window]
+                        )
+
+                    self._update(job.id, stage=IngestionJob.STAGE_UPSERT)
+                    ids.extend(
+                        chroma.upsert_embeddings(
+                            window, embeddings, chroma.document_chunk_ids(document, window)
+                        )
+                    )
+                    stored.add(window)
+                    self._update(job.id, chunks_embedded=len(ids))
+        except Exception:
+            # Don't leave a half-replaced document behind
+            chroma.discard_document(document, old_ids + ids)
+            raise
+
+        # Chunks the earlier version had beyond the new one's
+        chroma.delete_stale_vectors(old_ids, ids)
+        chroma.commit()
+        self._update(job.id, pages_parsed=F("pages_total"), chunks_total=len(ids))
+        return self._finish(job, ids)
+
+    def index(self, job: IngestionJob, chunks: List[Document]) -> List[str]:
+        """Embed and upsert a job's chunks, then mark its document indexed"""
+        document = job.document
+        chroma = ChromaDBService(collection_name=document.collection)
+
+        # Embed, holding one of the limited embedding slots
+        self._update(job.id, stage=IngestionJob.STAGE_EMBED)
+        embeddings = []
+        with self.embed_slots:
+            for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+                batch = chunks[start : start + EMBED_BATCH_SIZE]
+                embeddings.extend(
+                    chroma.embeddings.embed_documents([c.page_content for c in batch])
+                )
+                self._update(job.id, chunks_embedded=len(embeddings))
+
+        # Upsert, replacing vectors from any earlier upload of this file once
+        # the new ones are in
+        self._update(job.id, stage=IngestionJob.STAGE_UPSERT)
+        ids = chroma.replace_document(document, chunks, embeddings)
+        chroma.commit()
+        return self._finish(job, ids)
+
+    def _finish(self, job: IngestionJob, ids: List[str]) -> List[str]:
+        """Record the indexed vectors on the document and complete the job"""
+        document = job.document
+        if document.file_hash:
+            # Hashed while the upload was written
+            stat = os.stat(document.file_path)
+            file_hash, file_size, file_mtime = document.file_hash, stat.st_size, stat.st_mtime
+        else:
+            file_hash, file_size, file_mtime = file_fingerprint(document.file_path)
+        DocumentModel.objects.filter(pk=document.pk).update(
+            chunk_count=len(ids),
+            chunk_ids=ids,
+            file_hash=file_hash,
+            file_size=file_size,
+            file_mtime=file_mtime,
+            indexed=True,
+        )
+        get_answer_cache().invalidate()
+        self._update(job.id, status=IngestionJob.STATUS_COMPLETED)
+        return ids
+
+
+def _windows(items: Iterable, size: int) -> Iterator[List]:
+    """Group an iterable into lists of at most ``size`` items"""
+    iterator = iter(items)
+    while True:
+        window = list(itertools.islice(iterator, size))
+        if not window:
+            return
+        yield window
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline() -> IngestionPipeline:
+    """Get the process-wide ingestion pipeline"""
+    global _pipeline
+    if _pipeline is None:
+        with _pipeline_lock:
+            if _pipeline is None:
+                _pipeline = IngestionPipeline()
+    return _pipeline
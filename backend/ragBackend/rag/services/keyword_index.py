@@ -0,0 +1,293 @@
+# rag/services/keyword_index.py
+import json
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .locks import file_lock
+
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+_SEPARATORS = re.compile(r"[-_./]")
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i in is it its of on or "
+    "that the their there this to was were what when where which who why will with you".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase terms; compound codes (ERR-4012, v1.2) are kept whole and split"""
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        if token not in STOPWORDS:
+            tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(
+                part for part in _SEPARATORS.split(token) if part and part not in STOPWORDS
+            )
+    return tokens
+
+
+class KeywordIndex:
+    """BM25 inverted index over chunk text, kept alongside a Chroma collection
+
+    Postings live in flat NumPy arrays in CSR layout: the chunks containing
+    term ``t`` are ``docs[offsets[t]:offsets[t + 1]]``, with term frequencies
+    in ``freqs`` at the same positions. New chunks go to a small unsorted
+    tail that is merged in before the next search; deleted chunks are
+    tombstoned and dropped once they make up a quarter of the index.
+
+    Several processes may share the directory (web workers, management
+    commands). Changes are applied on top of the newest saved version, and
+    ``save`` holds a file lock while it folds in what another process saved
+    since and writes, so neither side's postings are lost.
+    """
+
+    FILENAME = "postings.npz"
+
+    def __init__(self, directory: str, k1: float = 1.2, b: float = 0.75):
+        self.directory = directory
+        self.path = os.path.join(directory, self.FILENAME)
+        self.lock_path = f"{self.path}.lock"
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._loaded_mtime: Optional[int] = None
+        self._clear()
+        self._load()
+
+    def _clear(self) -> None:
+        self._vocab: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._lengths = np.zeros(0, dtype=np.int32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._docs = np.zeros(0, dtype=np.int32)
+        self._freqs = np.zeros(0, dtype=np.uint16)
+        self._tail: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._norms: Optional[np.ndarray] = None
+        self._dirty = False
+        # Changes not saved yet, replayed onto a newer version at save time
+        self._pending: List[Tuple[List[str], Optional[List[str]]]] = []
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def __len__(self) -> int:
+        return int(self._alive.sum())
+
+    def add(self, ids: List[str], texts: List[str]) -> None:
+        """Index chunk texts under their vector ids, replacing earlier versions"""
+        with self._lock:
+            if not self._dirty:
+                self._load()
+            self._add(ids, texts)
+            self._pending.append((list(ids), list(texts)))
+
+    def delete(self, ids: List[str]) -> None:
+        """Tombstone chunks by vector id"""
+        with self._lock:
+            if not self._dirty:
+                self._load()
+            self._delete(ids)
+            if ids:
+                # Saved even if we don't have them: another process may have added them
+                self._pending.append((list(ids), None))
+                self._dirty = True
+
+    def _add(self, ids: List[str], texts: List[str]) -> None:
+        self._delete(ids)
+        terms, rows, freqs, lengths = [], [], [], []
+        for chunk_id, text in zip(ids, texts):
+            tokens = tokenize(text)
+            term_ids = np.fromiter(
+                (self._vocab.setdefault(t, len(self._vocab)) for t in tokens),
+                dtype=np.int32,
+                count=len(tokens),
+            )
+            unique, counts = np.unique(term_ids, return_counts=True)
+            row = len(self._ids)
+            self._ids.append(chunk_id)
+            self._rows[chunk_id] = row
+            lengths.append(len(tokens))
+            terms.append(unique)
+            rows.append(np.full(len(unique), row, dtype=np.int32))
+            freqs.append(np.minimum(counts, np.iinfo(np.uint16).max).astype(np.uint16))
+
+        if not lengths:
+            return
+        self._lengths = np.concatenate([self._lengths, np.asarray(lengths, dtype=np.int32)])
+        self._alive = np.concatenate([self._alive, np.ones(len(lengths), dtype=bool)])
+        self._tail.append((np.concatenate(terms), np.concatenate(rows), np.concatenate(freqs)))
+        self._norms = None
+        self._dirty = True
+
+    def _delete(self, ids: List[str]) -> None:
+        rows = [self._rows.pop(chunk_id) for chunk_id in ids if chunk_id in self._rows]
+        if rows:
+            self._alive[rows] = False
+            self._norms = None
+            self._dirty = True
+
+    def reset(self) -> None:
+        """Drop every chunk, on disk too"""
+        with self._lock, file_lock(self.lock_path):
+            self._clear()
+            if self.exists():
+                os.remove(self.path)
+            self._loaded_mtime = None
+
+    def _merge(self) -> None:
+        """Fold the tail into the CSR arrays, compacting tombstones if there are many"""
+        dead = len(self._alive) - int(self._alive.sum())
+        compact = dead and dead * 4 >= len(self._alive)
+        if not self._tail and not compact:
+            return
+
+        counts = np.diff(self._offsets)
+        terms = np.concatenate(
+            [np.repeat(np.arange(len(counts), dtype=np.int32), counts)]
+            + [t for t, _, _ in self._tail]
+        )
+        docs = np.concatenate([self._docs] + [r for _, r, _ in self._tail])
+        freqs = np.concatenate([self._freqs] + [f for _, _, f in self._tail])
+        self._tail = []
+
+        if compact:
+            keep = np.flatnonzero(self._alive)
+            remap = np.full(len(self._alive), -1, dtype=np.int32)
+            remap[keep] = np.arange(len(keep), dtype=np.int32)
+            live = self._alive[docs]
+            terms, docs, freqs = terms[live], remap[docs[live]], freqs[live]
+            self._ids = [self._ids[i] for i in keep]
+            self._rows = {chunk_id: row for row, chunk_id in enumerate(self._ids)}
+            self._lengths = self._lengths[keep]
+            self._alive = np.ones(len(keep), dtype=bool)
+
+        order = np.lexsort((docs, terms))
+        self._docs = docs[order]
+        self._freqs = freqs[order]
+        self._offsets = np.zeros(len(self._vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self._vocab)), out=self._offsets[1:])
+        self._norms = None
+
+    def search(
+        self, query_text: str, k: int = 10, allowed: Iterable[str] = None
+    ) -> List[Tuple[str, float]]:
+        """Return up to ``k`` ``(vector id, BM25 score)`` pairs, best first
+
+        :param allowed: Only score these vector ids (e.g. a metadata filter's
+            matches); the term statistics still cover the whole index
+        """
+        with self._lock:
+            if not self._dirty:
+                self._load()
+            self._merge()
+
+            total = len(self)
+            term_ids = {self._vocab[t] for t in tokenize(query_text) if t in self._vocab}
+            if not total or not term_ids:
+                return []
+
+            if self._norms is None:
+                average = self._lengths[self._alive].mean() or 1.0
+                self._norms = self.k1 * (1 - self.b + self.b * self._lengths / average)
+
+            scores = np.zeros(len(self._ids), dtype=np.float32)
+            for term_id in term_ids:
+                start, stop = self._offsets[term_id], self._offsets[term_id + 1]
+                docs = self._docs[start:stop]
+                live = self._alive[docs]
+                df = int(live.sum())
+                if not df:
+                    continue
+                idf = np.log(1 + (total - df + 0.5) / (df + 0.5))
+                tf = self._freqs[start:stop].astype(np.float32)
+                scores[docs] += live * idf * tf * (self.k1 + 1) / (tf + self._norms[docs])
+
+            if allowed is not None:
+                mask = np.zeros(len(self._ids), dtype=bool)
+                mask[[self._rows[i] for i in allowed if i in self._rows]] = True
+                scores[~mask] = 0
+
+            candidates = np.flatnonzero(scores)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            return [(self._ids[row], float(scores[row])) for row in candidates]
+
+    def save(self) -> None:
+        """Persist the index if it changed, atomically replacing the previous file"""
+        with self._lock:
+            if not self._dirty:
+                return
+            with file_lock(self.lock_path):
+                if self._saved_mtime() != self._loaded_mtime:
+                    # Another process saved since we loaded: apply our changes to its version
+                    pending = self._pending
+                    self._clear()
+                    self._loaded_mtime = None
+                    self._load()
+                    for ids, texts in pending:
+                        if texts is None:
+                            self._delete(ids)
+                        else:
+                            self._add(ids, texts)
+                self._write()
+
+    def _write(self) -> None:
+        self._merge()
+        os.makedirs(self.directory, exist_ok=True)
+        terms = sorted(self._vocab, key=self._vocab.get)
+        header = json.dumps({"terms": terms, "ids": self._ids}).encode("utf-8")
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                header=np.frombuffer(header, dtype=np.uint8),
+                lengths=self._lengths,
+                alive=self._alive,
+                offsets=self._offsets,
+                docs=self._docs,
+                freqs=self._freqs,
+            )
+        os.replace(tmp_path, self.path)
+        self._loaded_mtime = os.stat(self.path).st_mtime_ns
+        self._dirty = False
+        self._pending = []
+
+    def _saved_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self) -> None:
+        """(Re)load the index when another process saved a newer version"""
+        mtime = self._saved_mtime()
+        if mtime == self._loaded_mtime:
+            return
+        if mtime is None:
+            # Another process reset the index
+            self._clear()
+            self._loaded_mtime = None
+            return
+
+        with np.load(self.path, allow_pickle=False) as data:
+            header = json.loads(data["header"].tobytes().decode("utf-8"))
+            self._clear()
+            self._vocab = {term: i for i, term in enumerate(header["terms"])}
+            self._ids = header["ids"]
+            self._lengths = data["lengths"]
+            self._alive = data["alive"]
+            self._offsets = data["offsets"]
+            self._docs = data["docs"]
+            self._freqs = data["freqs"]
+        self._rows = {
+            chunk_id: row for row, chunk_id in enumerate(self._ids) if self._alive[row]
+        }
+        self._loaded_mtime = mtime
@@ -1,16 +1,31 @@
 from langchain_community.llms import LlamaCpp
+import asyncio
+import heapq
+import itertools
+import math
 import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence
+
+from . import tracing
+
+DEFAULT_MODEL_PATH = "/home/sred/models/DeepSeek-R1-Distill-Qwen-7B-Q6_K.gguf"
 
 
 class CustomLLM:
     """LLM service using llama.cpp"""
 
-    def __init__(self):
+    def __init__(self, model_path: str = None):
         # Set environment variable to prefer the discrete GPU
         os.environ["CUDA_VISIBLE_DEVICES"] = "0"  # Use first GPU (RTX 4070)
 
         self.llm = LlamaCpp(
-            model_path="/home/sred/models/DeepSeek-R1-Distill-Qwen-7B-Q6_K.gguf",
+            model_path=model_path or DEFAULT_MODEL_PATH,
             temperature=0.4,
             max_tokens=512,
             n_ctx=4096,
@@ -26,3 +41,425 @@ class CustomLLM:
 
     def get_llm(self):
         return self.llm
+
+
+def _common_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class PromptPrefixCache:
+    """Keep llama.cpp's KV state for a fixed prompt prefix
+
+    The prefix is evaluated once and its KV state saved. Before each
+    generation the state is restored if the context holds anything else,
+    so llama.cpp's prefix matching only evaluates the rest of the prompt.
+    ``session`` also serialises generations, since a llama.cpp context
+    serves one sequence at a time.
+    """
+
+    REQUIRED = ("tokenize", "eval", "reset", "save_state", "load_state")
+
+    def __init__(self, client: Any, prefix: str):
+        self.client = client
+        self.prefix = prefix
+        self.lock = threading.RLock()
+        self.tokens: List[int] = []
+        self.state = None
+        self.ms_per_token = 0.0
+
+    @classmethod
+    def supports(cls, llm: Any) -> bool:
+        """Whether the LLM exposes a llama.cpp-style client with KV state access"""
+        client = getattr(llm, "client", None)
+        return client is not None and all(hasattr(client, name) for name in cls.REQUIRED)
+
+    def _tokenize(self, text: str) -> List[int]:
+        # Same tokenization llama.cpp applies to completion prompts
+        return self.client.tokenize(text.encode("utf-8"), add_bos=True, special=True)
+
+    def warm_up(self) -> None:
+        """Evaluate the prefix and save its KV state"""
+        with self.lock:
+            tokens = self._tokenize(self.prefix)
+            start = time.perf_counter()
+            self.client.reset()
+            self.client.eval(tokens)
+            self.ms_per_token = (time.perf_counter() - start) * 1000 / max(1, len(tokens))
+            self.state = self.client.save_state()
+            self.tokens = list(tokens)
+
+    @contextmanager
+    def session(self, prompt: str) -> Iterator[Dict[str, int]]:
+        """Hold the model for one generation with the prefix KV state in place
+
+        Yields the number of prompt tokens served from the cache and the
+        prefill time that saves, estimated from the warm-up prefill rate.
+        """
+        with self.lock:
+            if self.state is None:
+                self.warm_up()
+
+            cached = _common_prefix(self.tokens, self._tokenize(prompt))
+            current = self.client._input_ids[: len(self.tokens)]
+            if _common_prefix(current, self.tokens) < cached:
+                # Something else ran since: bring the prefix back
+                self.client.load_state(self.state)
+
+            yield {
+                "prefix_cached_tokens": cached,
+                "prefill_saved_ms": int(cached * self.ms_per_token),
+            }
+
+
+# Lower values are served first; FIFO within a priority
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+
+class LLMQueueFull(Exception):
+    """Raised when too many generations are already waiting for a model slot"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GenerationCancelled(Exception):
+    """Raised to callers whose generation was cancelled before it finished"""
+
+
+_DONE = object()
+
+
+class GenerationRequest:
+    """A queued generation; wait on ``result()`` or iterate ``tokens()``
+
+    Async callers await ``asyncio.wrap_future(request.future)`` or iterate
+    ``atokens()`` instead, which never block the event loop.
+
+    ``stats`` is filled in once the generation finishes (queue wait,
+    completion tokens, tokens/sec and prefix cache stats).
+    """
+
+    def __init__(self, scheduler: "LLMScheduler", prompt: str, priority: int, prefix: str):
+        self.scheduler = scheduler
+        self.prompt = prompt
+        self.priority = priority
+        self.prefix = prefix
+        self.enqueued_at = time.perf_counter()
+        self.stats: Dict[str, Any] = {}
+        self.future: Future = Future()
+        self._tokens: "queue.Queue[Any]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._wake: Optional[Callable[[], None]] = None
+
+    def cancel(self) -> None:
+        """Give up on the generation; a no-op once it has finished"""
+        self.scheduler._cancel(self)
+
+    def result(self, timeout: float = None) -> str:
+        return self.future.result(timeout)
+
+    def tokens(self) -> Iterator[str]:
+        """Yield tokens as the model produces them"""
+        while True:
+            token = self._tokens.get()
+            if token is _DONE:
+                break
+            yield token
+        # Surface errors and cancellation
+        self.future.result()
+
+    async def atokens(self) -> AsyncIterator[str]:
+        """Yield tokens as the model produces them, from an event loop"""
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self._wake = lambda: loop.call_soon_threadsafe(ready.set)
+        while True:
+            try:
+                token = self._tokens.get_nowait()
+            except queue.Empty:
+                await ready.wait()
+                ready.clear()
+                continue
+            if token is _DONE:
+                break
+            yield token
+        self.future.result()
+
+    def _notify(self) -> None:
+        if self._wake is not None:
+            try:
+                self._wake()
+            except RuntimeError:
+                # The caller's event loop has already shut down
+                pass
+
+    def _put(self, token: str) -> None:
+        self._tokens.put(token)
+        self._notify()
+
+    def _finish(self, answer: str = None, error: BaseException = None) -> bool:
+        with self._lock:
+            if self.future.done():
+                return False
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(answer)
+            self._tokens.put(_DONE)
+            self._notify()
+            return True
+
+
+class LLMSlot:
+    """One model instance and the KV prefix caches of its llama.cpp context"""
+
+    def __init__(self, llm: Any):
+        self.llm = llm
+        self._prefix_caches: Dict[str, Optional[PromptPrefixCache]] = {}
+        self._lock = threading.Lock()
+
+    def prefix_cache(self, prefix: str) -> Optional[PromptPrefixCache]:
+        with self._lock:
+            if prefix not in self._prefix_caches:
+                self._prefix_caches[prefix] = (
+                    PromptPrefixCache(self.llm.client, prefix)
+                    if PromptPrefixCache.supports(self.llm)
+                    else None
+                )
+            return self._prefix_caches[prefix]
+
+    def session(self, prompt: str, prefix: str = None):
+        cache = self.prefix_cache(prefix) if prefix else None
+        return cache.session(prompt) if cache is not None else nullcontext({})
+
+
+class LLMScheduler:
+    """Share a fixed set of model slots between concurrent requests
+
+    Generations wait in a bounded priority queue and one worker thread per
+    slot takes them in turn, so each llama.cpp context only ever runs one
+    sequence at a time. Queued requests with the same prompt are batched
+    into a single generation. Once ``max_queue`` requests are waiting, new
+    ones are rejected with ``LLMQueueFull`` and an estimate of when to retry.
+    """
+
+    def __init__(self, llms: List[Any], max_queue: int = 16):
+        self.slots = [LLMSlot(llm) for llm in llms]
+        self.max_queue = max_queue
+        self._heap: List[tuple] = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._busy = 0
+
+        # Metrics
+        self._completed = 0
+        self._generations = 0
+        self._rejected = 0
+        self._cancelled = 0
+        self._waits_ms: "deque[int]" = deque(maxlen=1000)
+        self._completion_tokens = 0
+        self._generation_s = 0.0
+        self._service_s = 0.0
+
+        self._threads = [
+            threading.Thread(target=self._work, args=(slot,), name=f"rag-llm-{i}", daemon=True)
+            for i, slot in enumerate(self.slots)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._heap)
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely free for a new request"""
+        per_slot = (len(self._heap) + self._busy) / len(self.slots)
+        return max(1, math.ceil(per_slot * self._service_s))
+
+    def _full(self) -> LLMQueueFull:
+        self._rejected += 1
+        return LLMQueueFull(
+            f"{len(self._heap)} generations already queued, try again later",
+            self.retry_after(),
+        )
+
+    def check_capacity(self) -> None:
+        """Raise ``LLMQueueFull`` if a new request would be rejected right now"""
+        with self._cond:
+            if len(self._heap) >= self.max_queue:
+                raise self._full()
+
+    def submit(
+        self, prompt: str, priority: int = PRIORITY_INTERACTIVE, prefix: str = None
+    ) -> GenerationRequest:
+        """
+        Queue a generation
+
+        :param prefix: Static start of the prompt whose KV state each slot
+            keeps, see ``PromptPrefixCache``
+        """
+        request = GenerationRequest(self, prompt, priority, prefix)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("LLM scheduler is closed")
+            if len(self._heap) >= self.max_queue:
+                raise self._full()
+            heapq.heappush(self._heap, (priority, next(self._sequence), request))
+            self._cond.notify()
+        return request
+
+    def generate(
+        self, prompt: str, priority: int = PRIORITY_INTERACTIVE, prefix: str = None
+    ) -> str:
+        """Queue a generation and wait for the answer"""
+        request = self.submit(prompt, priority, prefix)
+        try:
+            return request.result()
+        finally:
+            request.cancel()
+
+    def warm_up(self, prefix: str) -> None:
+        """Evaluate a prompt prefix on every slot"""
+        for slot in self.slots:
+            cache = slot.prefix_cache(prefix)
+            if cache is not None:
+                cache.warm_up()
+
+    def _cancel(self, request: GenerationRequest) -> None:
+        with self._cond:
+            for i, entry in enumerate(self._heap):
+                if entry[2] is request:
+                    self._heap.pop(i)
+                    heapq.heapify(self._heap)
+                    break
+            if request._finish(error=GenerationCancelled("Generation cancelled")):
+                self._cancelled += 1
+
+    def _take(self) -> List[GenerationRequest]:
+        """Pop the next request plus every queued request with the same prompt"""
+        _, _, request = heapq.heappop(self._heap)
+        key = (request.prompt, request.prefix)
+        batch = [request] + [
+            entry[2] for entry in self._heap if (entry[2].prompt, entry[2].prefix) == key
+        ]
+        if len(batch) > 1:
+            self._heap = [entry for entry in self._heap if entry[2] not in batch]
+            heapq.heapify(self._heap)
+        return batch
+
+    def _work(self, slot: LLMSlot) -> None:
+        while True:
+            with self._cond:
+                while not self._heap and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                batch = self._take()
+                self._busy += 1
+            try:
+                self._generate(slot, batch)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+
+    def _generate(self, slot: LLMSlot, batch: List[GenerationRequest]) -> None:
+        start = time.perf_counter()
+        waits = {id(r): int((start - r.enqueued_at) * 1000) for r in batch}
+        with self._cond:
+            self._waits_ms.extend(waits.values())
+
+        tokens = []
+        first_token = None
+        try:
+            with slot.session(batch[0].prompt, batch[0].prefix) as prefill:
+                stream = slot.llm.stream(batch[0].prompt)
+                try:
+                    for token in stream:
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        live = [r for r in batch if not r.future.done()]
+                        if not live:
+                            # Every caller went away: stop decoding
+                            break
+                        tokens.append(token)
+                        for request in live:
+                            request._put(token)
+                finally:
+                    stream.close()
+        except Exception as e:
+            for request in batch:
+                request._finish(error=e)
+            return
+
+        end = time.perf_counter()
+        elapsed = end - start
+        # Prompt evaluation runs until the first token, decoding after it
+        first_token = first_token or end
+        prefill_ms = round((first_token - start) * 1000, 2)
+        decode_ms = round((end - first_token) * 1000, 2)
+        for wait_ms in waits.values():
+            tracing.observe("llm_queue", wait_ms)
+        tracing.observe("llm_prefill", prefill_ms)
+        tracing.observe("llm_decode", decode_ms)
+
+        stats = {
+            "prefill_ms": prefill_ms,
+            "decode_ms": decode_ms,
+            "completion_tokens": len(tokens),
+            "tokens_per_s": round(len(tokens) / elapsed, 1) if elapsed else 0.0,
+            **prefill,
+        }
+        answer = "".join(tokens)
+        finished = 0
+        for request in batch:
+            request.stats = {"queue_wait_ms": waits[id(request)], **stats}
+            finished += request._finish(answer)
+
+        with self._cond:
+            self._completed += finished
+            self._generations += 1
+            self._completion_tokens += len(tokens)
+            self._generation_s += elapsed
+            # Smoothed time per generation, for Retry-After estimates
+            self._service_s = elapsed if not self._service_s else 0.8 * self._service_s + 0.2 * elapsed
+
+    def metrics(self) -> Dict[str, Any]:
+        """Queue depth, wait times and throughput since start-up"""
+        with self._cond:
+            waits = sorted(self._waits_ms)
+            return {
+                "slots": len(self.slots),
+                "busy_slots": self._busy,
+                "queue_depth": len(self._heap),
+                "queue_limit": self.max_queue,
+                "completed": self._completed,
+                "generations": self._generations,
+                "rejected": self._rejected,
+                "cancelled": self._cancelled,
+                "wait_ms_avg": round(sum(waits) / len(waits), 1) if waits else 0.0,
+                "wait_ms_p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0,
+                "tokens_per_s": round(self._completion_tokens / self._generation_s, 1)
+                if self._generation_s
+                else 0.0,
+            }
+
+    def close(self) -> None:
+        """Cancel queued requests and stop the workers once running ones finish"""
+        with self._cond:
+            self._closed = True
+            pending = [entry[2] for entry in self._heap]
+            self._heap = []
+            self._cond.notify_all()
+        for request in pending:
+            request._finish(error=GenerationCancelled("LLM scheduler shut down"))
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,21 @@
+# rag/services/locks.py
+import fcntl
+import os
+from contextlib import contextmanager
+from typing import Iterator
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False) -> Iterator[None]:
+    """Hold an advisory lock on ``path`` (created if missing) across processes
+
+    Web workers and the management commands share the index directories;
+    writers take the lock exclusively around read-modify-write cycles.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,83 @@
+# rag/services/mmr.py
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from django.conf import settings
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def maximal_marginal_relevance(
+    query: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float = 0.5
+) -> List[int]:
+    """Indices of ``k`` candidate rows picked by MMR, in pick order
+
+    Cosine similarities between all candidates come from one matrix
+    product; each row's similarity to the rows picked so far is kept as a
+    running maximum, so every pick is one vectorized pass.
+    """
+    if not len(vectors) or k <= 0:
+        return []
+    vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+    relevance = vectors @ _normalize(np.asarray(query, dtype=np.float32))
+    similarity = vectors @ vectors.T
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    while len(selected) < min(k, len(vectors)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
+
+
+def _positive_int(data: Dict[str, Any], key: str, maximum: int) -> Optional[int]:
+    value = data.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= maximum:
+        raise ValueError(f"{key} must be an integer between 1 and {maximum}")
+    return value
+
+
+class MMRParams(NamedTuple):
+    """Per-request overrides of how many chunks are retrieved and how MMR picks them
+
+    ``k`` chunks are picked out of the ``fetch_k`` nearest; ``lambda_mult``
+    weighs relevance (1) against diversity (0). Unset fields fall back to
+    ``settings.RAG_RETRIEVAL_K``, ``RAG_MMR_FETCH_K`` and ``RAG_MMR_LAMBDA``.
+    """
+
+    k: Optional[int] = None
+    fetch_k: Optional[int] = None
+    lambda_mult: Optional[float] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> Optional["MMRParams"]:
+        """Read ``k``, ``fetch_k`` and ``lambda_mult`` from a request; None if unset
+
+        Raises ValueError.
+        """
+        limit = getattr(settings, "RAG_MMR_MAX_FETCH_K", 200)
+        lambda_mult = data.get("lambda_mult")
+        if lambda_mult is not None:
+            if isinstance(lambda_mult, bool) or not isinstance(lambda_mult, (int, float)):
+                raise ValueError("lambda_mult must be a number between 0 and 1")
+            if not 0 <= lambda_mult <= 1:
+                raise ValueError("lambda_mult must be a number between 0 and 1")
+        params = cls(
+            k=_positive_int(data, "k", limit),
+            fetch_k=_positive_int(data, "fetch_k", limit),
+            lambda_mult=None if lambda_mult is None else float(lambda_mult),
+        )
+        if params.k and params.fetch_k and params.fetch_k < params.k:
+            raise ValueError("fetch_k must be at least k")
+        return params if params != cls() else None
+
+    def scope(self) -> Dict[str, Any]:
+        """The overrides as plain values, for the answer cache scope"""
+        return {key: value for key, value in self._asdict().items() if value is not None}
@@ -1,44 +1,452 @@
+import hashlib
+import itertools
+import logging
+import multiprocessing
 import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 
+import pypdf
+from django.conf import settings
+
+from langchain.schema import Document
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from . import tracing
+from .text_cache import PageTextCache, read_pages
+
+logger = logging.getLogger(__name__)
+
+
+def file_fingerprint(file_path: str) -> Tuple[str, int, float]:
+    """Return the SHA-256, size and mtime of a file"""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    stat = os.stat(file_path)
+    return sha256.hexdigest(), stat.st_size, stat.st_mtime
+
+
+def _plan_file(
+    file_path: str, file_hash: str = None, text_cache: PageTextCache = None
+) -> Tuple[Optional[str], int, Optional[str]]:
+    """Hash a PDF and count its pages (runs in a worker process)
+
+    Returns (SHA-256, page count, path of its cached text or None). The
+    file is only hashed when there is a text cache to look it up in and
+    ``file_hash`` isn't already known.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"PDF file not found: {file_path}")
+    if text_cache is not None:
+        file_hash = file_hash or file_fingerprint(file_path)[0]
+        if text_cache.has(file_hash):
+            return file_hash, text_cache.page_count(file_hash), text_cache.path(file_hash)
+    return file_hash, len(pypdf.PdfReader(file_path).pages), None
+
+
+def _load_pdf_pages(file_path: str, start: int = 0, stop: int = None) -> Iterator[Document]:
+    """Lazily load pages [start, stop) of a PDF the way PyPDFLoader loads them
+
+    Uploads and the page-range workers both parse through here, so a file's
+    pages carry the same metadata (the PDF's own included) whichever path
+    indexed it. PyPDFLoader only reads from the first page: a later range
+    takes the document metadata from that page and extracts its own pages
+    with the loader's settings.
+    """
+    loader = PyPDFLoader(file_path)
+    pages = loader.lazy_load()
+    if start == 0:
+        yield from itertools.islice(pages, stop)
+        return
+
+    first = next(pages, None)
+    pages.close()
+    if first is None:
+        return
+    reader = pypdf.PdfReader(file_path)
+    total_pages = len(reader.pages)
+    stop = total_pages if stop is None else min(stop, total_pages)
+    for i in range(start, stop):
+        text = reader.pages[i].extract_text(
+            extraction_mode=loader.parser.extraction_mode, **loader.parser.extraction_kwargs
+        )
+        yield Document(
+            page_content=text.strip(),
+            metadata={**first.metadata, "page": i, "page_label": reader.page_labels[i]},
+        )
+
+
+def _split_page_range(
+    file_path: str,
+    start: int,
+    stop: int,
+    chunk_size: int,
+    chunk_overlap: int,
+    cache_path: str = None,
+) -> Tuple[List[Document], Optional[List[Document]], float, float]:
+    """Extract and split pages [start, stop) of a PDF (runs in a worker process)
+
+    Pages are read from ``cache_path`` when the text is cached; otherwise
+    the PDF is parsed and the pages are returned too, for the parent to
+    cache. Also returns the parse and split times in milliseconds: spans
+    recorded in the worker process would never reach the parent's metrics.
+    """
+    parse_start = time.perf_counter()
+    if cache_path:
+        pages = list(read_pages(cache_path, file_path, start, stop))
+        parsed = None
+    else:
+        pages = parsed = list(_load_pdf_pages(file_path, start, stop))
+    split_start = time.perf_counter()
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=len
+    )
+    chunks = splitter.split_documents(pages)
+    end = time.perf_counter()
+    return chunks, parsed, (split_start - parse_start) * 1000, (end - split_start) * 1000
+
+
+_pools: Dict[int, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(max_workers: int) -> ProcessPoolExecutor:
+    """The process-wide parsing pool with ``max_workers`` workers
+
+    Created on first use and kept, so batches don't each pay for spawning
+    workers and importing pypdf and LangChain in them.
+    """
+    with _pools_lock:
+        pool = _pools.get(max_workers)
+        if pool is None:
+            # Spawn rather than fork: the parent may hold CUDA and model threads
+            context = multiprocessing.get_context("spawn")
+            pool = _pools[max_workers] = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=context
+            )
+        return pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken pool so the next batch starts a fresh one"""
+    with _pools_lock:
+        for max_workers, existing in list(_pools.items()):
+            if existing is pool:
+                del _pools[max_workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
 
 class PDFProcessor:
-    """Process PDF documents for indexing"""
+    """Process PDF documents for indexing
+
+    Splitter parameters default to ``settings.RAG_CHUNK_SIZE`` and
+    ``RAG_CHUNK_OVERLAP``. Extracted page text is cached by file content
+    (``RAG_TEXT_CACHE_DIR``), so each PDF is only parsed once.
+    """
 
-    def __init__(self):
+    def __init__(self, chunk_size: int = None, chunk_overlap: int = None):
+        self.chunk_size = chunk_size or getattr(settings, "RAG_CHUNK_SIZE", 1000)
+        if chunk_overlap is None:
+            chunk_overlap = getattr(settings, "RAG_CHUNK_OVERLAP", 200)
+        self.chunk_overlap = chunk_overlap
+        self.text_cache = PageTextCache.from_settings()
         self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
             length_function=len,
         )
 
-    def process_pdf(self, file_path: str, document_name: str = None) -> dict:
-        """Process a PDF into chunks with metadata"""
+    def is_cached(self, file_hash: str) -> bool:
+        """Whether the text of the file with this SHA-256 is cached"""
+        return self.text_cache is not None and self.text_cache.has(file_hash)
+
+    def load_pages(self, file_path: str, file_hash: str = None) -> Iterator[Document]:
+        """Lazily load a PDF one page at a time
+
+        Pages come from the text cache if this content was parsed before
+        (``file_hash`` saves hashing the file again); otherwise they are
+        parsed, and cached once the last page has been read.
+        """
+        if self.text_cache is not None:
+            if file_hash is None and os.path.exists(file_path):
+                file_hash = file_fingerprint(file_path)[0]
+            if self.text_cache.has(file_hash):
+                return self.text_cache.pages(file_hash, file_path)
+
         # Check if file exists
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"PDF file not found: {file_path}")
 
-        # Load the PDF
-        loader = PyPDFLoader(file_path)
-        raw_docs = loader.load()
+        pages = _load_pdf_pages(file_path)
+        if self.text_cache is None:
+            return pages
+        return self._cache_pages(pages, file_hash)
+
+    def _cache_pages(self, pages: Iterator[Document], file_hash: str) -> Iterator[Document]:
+        """Pass pages through; a file only read part way isn't cached"""
+        with self.text_cache.writer(file_hash) as writer:
+            for page in pages:
+                writer.add(page)
+                yield page
 
+    def split_pages(
+        self, pages: List[Document], file_path: str, document_name: str = None
+    ) -> List[Document]:
+        """Split loaded pages into chunks with metadata"""
         # Set document name if not provided
         if not document_name:
             document_name = Path(file_path).name
 
         # Split into chunks
-        chunks = self.text_splitter.split_documents(raw_docs)
+        with tracing.span("pdf_split"):
+            chunks = self.text_splitter.split_documents(pages)
 
         # Add metadata to each chunk
+        return self._stamp_chunks(chunks, file_path, document_name)
+
+    def iter_chunks(
+        self, file_path: str, document_name: str = None, file_hash: str = None
+    ) -> Iterator[Document]:
+        """Lazily split a PDF into chunks, carrying overlap across page breaks
+
+        Only the current page and the unfinished tail of the text before it
+        are held in memory, so memory use does not grow with the page count.
+        A chunk may span a page break; its ``page`` is the page it starts on.
+        """
+        document_name = document_name or Path(file_path).name
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            length_function=len,
+            add_start_index=True,
+        )
+
+        chunk_id = 0
+        tail = ""
+        # (offset in the buffer, metadata) of every page starting in the buffer
+        page_starts: List[Tuple[int, Dict[str, Any]]] = []
+
+        pages = self.load_pages(file_path, file_hash)
+        while True:
+            with tracing.span("pdf_parse"):
+                page = next(pages, None)
+            if page is None:
+                break
+            if not page.page_content.strip():
+                continue
+            separator = "\n" if tail else ""
+            buffer = tail + separator + page.page_content
+            page_starts.append((len(tail) + len(separator), page.metadata))
+
+            with tracing.span("pdf_split"):
+                pieces = splitter.create_documents([buffer])
+            # The last piece may still grow with the next page's text
+            for piece in pieces[:-1]:
+                yield self._page_chunk(piece, page_starts, file_path, document_name, chunk_id)
+                chunk_id += 1
+
+            last = pieces[-1]
+            offset = max(0, last.metadata["start_index"])
+            tail = last.page_content
+            page_starts = [
+                (max(0, start - offset), metadata)
+                for i, (start, metadata) in enumerate(page_starts)
+                if i + 1 == len(page_starts) or page_starts[i + 1][0] > offset
+            ]
+
+        if tail:
+            last = Document(page_content=tail, metadata={"start_index": 0})
+            yield self._page_chunk(last, page_starts, file_path, document_name, chunk_id)
+
+    def _page_chunk(
+        self,
+        piece: Document,
+        page_starts: List[Tuple[int, Dict[str, Any]]],
+        file_path: str,
+        document_name: str,
+        chunk_id: int,
+    ) -> Document:
+        """Give a streamed chunk the metadata of the page it starts on"""
+        start = piece.metadata["start_index"]
+        metadata = page_starts[0][1]
+        for page_start, page_metadata in page_starts:
+            if page_start > start:
+                break
+            metadata = page_metadata
+        chunk = Document(page_content=piece.page_content, metadata=dict(metadata))
+        if not chunk.metadata.get("source"):
+            chunk.metadata["source"] = file_path
+        chunk.metadata["name"] = document_name
+        chunk.metadata["chunk_id"] = chunk_id
+        return chunk
+
+    def _page_ranges(self, page_count: int, pages_per_task: int) -> List[Tuple[int, int]]:
+        """Cut a file into page ranges so one large PDF spreads across workers"""
+        return [
+            (start, start + pages_per_task) for start in range(0, page_count, pages_per_task)
+        ] or [(0, 0)]
+
+    def process_many(
+        self,
+        file_paths: Iterable[str],
+        max_workers: int = None,
+        pages_per_task: int = None,
+        file_hashes: Dict[str, str] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Parse and split many PDFs on the process-wide pool
+
+        Large files are cut into page ranges of ``pages_per_task`` pages so
+        they spread across workers too. Hashing and counting pages happen in
+        the workers as well, a few files ahead, so results are yielded per
+        file, in completion order, while later files are still being
+        planned. A file that fails is yielded with an ``error`` and no
+        chunks instead of aborting the batch. Files whose text is cached are
+        split without being parsed; ``file_hashes`` (path -> SHA-256) saves
+        hashing them again.
+        """
+        file_hashes = dict(file_hashes or {})
+        max_workers = max_workers or getattr(settings, "RAG_PDF_WORKERS", None) or os.cpu_count()
+        pages_per_task = pages_per_task or getattr(settings, "RAG_PDF_PAGES_PER_TASK", 50)
+
+        pool = _get_pool(max_workers)
+        files = iter(file_paths)
+        plans = {}
+        tasks = {}
+        remaining: Dict[str, int] = {}
+        page_counts: Dict[str, int] = {}
+        parts: Dict[str, Dict[int, List[Document]]] = {}
+        # Pages parsed by the workers, cached once the whole file is in
+        parsed: Dict[str, Dict[int, List[Document]]] = {}
+        failed: Dict[str, str] = {}
+
+        def plan_more():
+            # Only a few files ahead, so their ranges don't queue behind
+            # every other file's planning
+            while len(plans) < max_workers:
+                file_path = next(files, None)
+                if file_path is None:
+                    return
+                future = pool.submit(
+                    _plan_file, file_path, file_hashes.get(file_path), self.text_cache
+                )
+                plans[future] = file_path
+
+        try:
+            plan_more()
+            while plans or tasks:
+                done, _ = wait([*plans, *tasks], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in plans:
+                        file_path = plans.pop(future)
+                        try:
+                            file_hash, page_count, cache_path = future.result()
+                        except Exception as e:
+                            yield self._result(file_path, [], error=str(e))
+                            continue
+                        file_hashes[file_path] = file_hash
+                        page_counts[file_path] = page_count
+                        ranges = self._page_ranges(page_count, pages_per_task)
+                        remaining[file_path] = len(ranges)
+                        parts[file_path] = {}
+                        parsed[file_path] = {}
+                        for start, stop in ranges:
+                            range_future = pool.submit(
+                                _split_page_range,
+                                file_path,
+                                start,
+                                stop,
+                                self.chunk_size,
+                                self.chunk_overlap,
+                                cache_path,
+                            )
+                            tasks[range_future] = (file_path, start)
+                        continue
+
+                    file_path, start = tasks.pop(future)
+                    try:
+                        parts[file_path][start], pages, parse_ms, split_ms = future.result()
+                        if pages is not None and self.text_cache is not None:
+                            parsed[file_path][start] = pages
+                        tracing.observe("pdf_parse", parse_ms)
+                        tracing.observe("pdf_split", split_ms)
+                    except Exception as e:
+                        failed.setdefault(file_path, str(e))
+
+                    remaining[file_path] -= 1
+                    if remaining[file_path]:
+                        continue
+
+                    # Every range of this file is done: reassemble in page order
+                    file_parts = parts.pop(file_path)
+                    file_pages = parsed.pop(file_path)
+                    if file_path in failed:
+                        yield self._result(file_path, [], error=failed.pop(file_path))
+                        continue
+                    if file_pages:
+                        self._cache_parsed(file_hashes[file_path], file_pages)
+                    chunks = [c for start in sorted(file_parts) for c in file_parts[start]]
+                    result = self._result(file_path, self._stamp_chunks(chunks, file_path))
+                    result["page_count"] = page_counts[file_path]
+                    yield result
+                plan_more()
+        except BrokenProcessPool:
+            _discard_pool(pool)
+            raise
+        finally:
+            # The pool outlives this batch: don't leave it work nobody will collect
+            for future in [*plans, *tasks]:
+                future.cancel()
+
+    def _cache_parsed(self, file_hash: str, pages: Dict[int, List[Document]]) -> None:
+        try:
+            self.text_cache.write(file_hash, (p for start in sorted(pages) for p in pages[start]))
+        except Exception:
+            # Only costs a re-parse next time
+            logger.exception("Error caching extracted text %s", file_hash)
+
+    def _stamp_chunks(
+        self, chunks: List[Document], file_path: str, document_name: str = None
+    ) -> List[Document]:
+        """Add name, source and sequential chunk ids to split chunks"""
+        document_name = document_name or Path(file_path).name
         for i, chunk in enumerate(chunks):
             if not chunk.metadata.get("source"):
                 chunk.metadata["source"] = file_path
             chunk.metadata["name"] = document_name
             chunk.metadata["chunk_id"] = i
+        return chunks
+
+    def _result(self, file_path: str, chunks: List[Document], error: str = None) -> dict:
+        result = {
+            "name": Path(file_path).name,
+            "file_path": file_path,
+            "file_type": "pdf",
+            "chunks": chunks,
+        }
+        if error:
+            result["error"] = error
+        return result
+
+    def process_pdf(
+        self, file_path: str, document_name: str = None, file_hash: str = None
+    ) -> dict:
+        """Process a PDF into chunks with metadata"""
+        # Load the PDF
+        with tracing.span("pdf_parse"):
+            raw_docs = list(self.load_pages(file_path, file_hash))
+
+        # Set document name if not provided
+        if not document_name:
+            document_name = Path(file_path).name
+
+        chunks = self.split_pages(raw_docs, file_path, document_name)
 
         return {
             "name": document_name,
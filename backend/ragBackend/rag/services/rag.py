@@ -1,158 +1,1154 @@
-import os
-import shutil
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Callable, Iterator, NamedTuple, Optional, Tuple
+import asyncio
 import time
-from langchain_chroma import Chroma
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from django.conf import settings
 from langchain.schema import Document
 from langchain.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
-from django.conf import settings
-from .embedding import get_embeddings
-from .llm import CustomLLM
+from . import tracing
+from .aio import RETRIEVAL, SEARCH, map_blocking, run_blocking
+from .answer_cache import CACHE_MISS, AnswerCache, get_answer_cache
+from .context import ContextAssembler
+from .filters import RetrievalFilter, Where
+from .llm import PRIORITY_BATCH, PRIORITY_INTERACTIVE, GenerationRequest, LLMQueueFull
+from .mmr import MMRParams, maximal_marginal_relevance
+from .registry import DEFAULT_COLLECTION, ModelRegistry, get_registry, validate_collection
+
+RETRIEVAL_VECTOR = "vector"
+RETRIEVAL_KEYWORD = "keyword"
+RETRIEVAL_HYBRID = "hybrid"
+RETRIEVAL_MODES = (RETRIEVAL_VECTOR, RETRIEVAL_KEYWORD, RETRIEVAL_HYBRID)
+
+# Rank offset of reciprocal-rank fusion; damps the weight of the top ranks
+RRF_K = 60
+
+# Filtered keyword search checks this many BM25 hits per wanted chunk against
+# the filter, widening up to KEYWORD_MAX_FETCH times when too few pass
+KEYWORD_OVERFETCH = 4
+KEYWORD_MAX_FETCH = 64
+
+# Tokens kept free on top of the answer budget, for tokenizer drift
+CONTEXT_MARGIN = 32
+
+# Per-request trace stages filled in from the generation stats
+LLM_STAGES = (
+    ("llm_queue", "queue_wait_ms"),
+    ("llm_prefill", "prefill_ms"),
+    ("llm_decode", "decode_ms"),
+)
+
+
+# Enhanced prompt template. Everything that never changes comes first, so
+# llama.cpp can reuse the KV cache of this prefix across queries.
+PROMPT_PREFIX = """You are an AI assistant synthesizing comprehensive information from multiple documents.
+
+CONTEXT GUIDELINES:
+- Carefully analyze ALL provided context chunks
+- Synthesize information from different sources
+- Identify and highlight key insights across documents
+- If sources contain conflicting information, discuss the discrepancies
+
+INSTRUCTIONS:
+1. Provide a thorough answer using information from ALL context chunks
+2. If no comprehensive answer is possible, explain what information is missing
+3. Cite sources for different pieces of information
+4. Demonstrate how information from multiple sources connects or provides a complete picture
+5. Be precise, informative, and transparent about the sources of your information
+"""
+
+PROMPT_TEMPLATE = (
+    PROMPT_PREFIX
+    + """
+CONTEXT:
+{context}
+
+QUESTION:
+{question}
+
+ANSWER:
+"""
+)
+
+
+class PreparedQuery(NamedTuple):
+    """A query up to the point of generation, see ``RAGService.prepare_query``"""
+
+    query_text: str
+    start_time: float
+    cache: Optional[AnswerCache]
+    scope: Dict[str, Any]
+    query_vector: List[float]
+    cached: Optional[Dict[str, Any]] = None
+    prompt: str = ""
+    sources: List[Dict[str, Any]] = []
+    stats: Dict[str, Any] = {}
+    retrieval_ms: int = 0
+
+
+def _elapsed_ms(start: float) -> int:
+    return int((time.time() - start) * 1000)  # Convert to milliseconds
+
+
+def _chunk_key(doc: Document):
+    return doc.id or (doc.metadata.get("source"), doc.metadata.get("chunk_id"))
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Document]], k: int) -> List[Document]:
+    """Merge ranked lists, scoring each chunk by the sum of 1 / (RRF_K + rank)"""
+    scores: Dict[Any, float] = {}
+    docs: Dict[Any, Document] = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = _chunk_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+            docs.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [docs[key] for key in ranked[:k]]
 
 
 class RAGService:
     """Main RAG service implementation using LangChain with MMR retrieval"""
 
-    def __init__(self, gpu_device=None):
+    def __init__(self, registry: ModelRegistry = None):
         """
         Initialize RAG Service with MMR retrieval configuration
 
-        :param gpu_device: Optional GPU device specification
+        :param registry: Model registry owning the shared embeddings, LLM and
+            vector store (defaults to the process-wide registry)
         """
-        self.persist_directory = os.path.join(settings.BASE_DIR, "chroma_db")
-        self.collection_name = "pdf_collection"
+        self.registry = registry or get_registry()
 
-        # Handle GPU device configuration if provided
-        model_kwargs = {}
-        if gpu_device is not None:
-            model_kwargs["gpu_device"] = gpu_device
+    @property
+    def embeddings(self):
+        """Shared embeddings model, loaded once per process"""
+        return self.registry.get_embeddings()
 
-        # Initialize embeddings and LLM
-        self.embeddings = get_embeddings()
-        self.llm = (
-            CustomLLM(**model_kwargs).get_llm()
-            if model_kwargs
-            else CustomLLM().get_llm()
-        )
+    @property
+    def llm(self):
+        """Shared LLM, loaded once per process"""
+        return self.registry.get_llm()
 
-    def get_vectorstore(self):
-        """Get or create the vector store"""
-        try:
-            return Chroma(
-                persist_directory=self.persist_directory,
-                embedding_function=self.embeddings,
-                collection_name=self.collection_name,
-            )
-        except Exception as e:
-            print(f"Error creating ChromaDB: {str(e)}")
-            # If there's an error, try to recreate the database
-            if os.path.exists(self.persist_directory):
-                print(f"Recreating ChromaDB directory")
-                shutil.rmtree(self.persist_directory, ignore_errors=True)
-            # Try again with a fresh database
-            return Chroma(
-                persist_directory=self.persist_directory,
-                embedding_function=self.embeddings,
-                collection_name=self.collection_name,
-            )
+    def get_vectorstore(self, collection_name: str = DEFAULT_COLLECTION):
+        """Get the shared vector store of a collection"""
+        return self.registry.get_vectorstore(collection_name)
 
-    def add_documents(self, chunks: List[Document]) -> List[str]:
-        """Add document chunks to the vector store"""
-        vectorstore = self.get_vectorstore()
+    @property
+    def scheduler(self):
+        """Queue in front of the LLM slots; every generation goes through it"""
+        return self.registry.get_scheduler()
+
+    def warm_up(self) -> None:
+        """Evaluate the static prompt prefix ahead of the first query"""
+        self.scheduler.warm_up(PROMPT_PREFIX)
+
+    def add_documents(
+        self, chunks: List[Document], collection_name: str = DEFAULT_COLLECTION
+    ) -> List[str]:
+        """Add document chunks to a collection's vector store"""
+        vectorstore = self.get_vectorstore(collection_name)
         ids = vectorstore.add_documents(chunks)
+        keyword_index = self.registry.get_keyword_index(collection_name)
+        keyword_index.add(ids, [chunk.page_content for chunk in chunks])
+        keyword_index.save()
         return ids
 
-    def query(self, query_text: str) -> Dict[str, Any]:
+    def retrieve(
+        self,
+        query_text: str,
+        query_vector: List[float] = None,
+        mode: str = None,
+        k: int = 10,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        fetch_k: int = None,
+        lambda_mult: float = None,
+    ) -> List[Document]:
         """
-        Process a query using Maximal Marginal Relevance (MMR) retrieval
+        Retrieve context chunks
 
-        :param query_text: User's query string
-        :return: Dictionary containing answer, sources, and timing information
+        :param mode: ``"vector"`` (MMR over embeddings), ``"keyword"`` (BM25)
+            or ``"hybrid"`` (both, merged with reciprocal-rank fusion);
+            defaults to ``settings.RAG_RETRIEVAL_MODE``
+        :param k: Number of chunks to return
+        :param collections: Collections to search, ``DEFAULT_COLLECTION`` if
+            not given. Several are searched in parallel and their results
+            merged with reciprocal-rank fusion
+        :param filters: Only search chunks of the matching documents and pages
+        :param fetch_k: Nearest chunks MMR picks from (defaults to
+            ``settings.RAG_MMR_FETCH_K`` or 2 x k, whichever is larger)
+        :param lambda_mult: MMR balance of relevance (1) against diversity (0),
+            defaults to ``settings.RAG_MMR_LAMBDA``
         """
-        start_time = time.time()
+        query_vectors = None if query_vector is None else [query_vector]
+        return self.retrieve_many(
+            [query_text], query_vectors, mode, k, collections, filters, fetch_k, lambda_mult
+        )[0]
 
-        # Get the vector store
-        vectorstore = self.get_vectorstore()
-
-        # Configure MMR retriever
-        retriever = vectorstore.as_retriever(
-            search_type="mmr",  # Maximal Marginal Relevance
-            search_kwargs={
-                "k": 10,  # Number of chunks to retrieve
-                "fetch_k": 20,  # Number of documents to fetch before filtering
-                "lambda_mult": 0.5,  # Balance between diversity and relevance
-                # 0 = pure relevance, 1 = pure diversity
-            },
+    def retrieve_many(
+        self,
+        query_texts: List[str],
+        query_vectors: List[List[float]] = None,
+        mode: str = None,
+        k: int = 10,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        fetch_k: int = None,
+        lambda_mult: float = None,
+    ) -> List[List[Document]]:
+        """
+        ``retrieve`` for several queries with the same options
+
+        Each collection is searched once for all of them: one vector query
+        carrying every query embedding, one fetch of the BM25 matches, and a
+        chunk found by several queries is built once and shared.
+        """
+        mode = mode or getattr(settings, "RAG_RETRIEVAL_MODE", RETRIEVAL_HYBRID)
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode: {mode}")
+        collections = [
+            validate_collection(name) for name in dict.fromkeys(collections or [DEFAULT_COLLECTION])
+        ]
+
+        # Where clause per collection; collections the filters rule out are skipped
+        wheres = filters.resolve(collections) if filters else dict.fromkeys(collections)
+        collections = [name for name in collections if name in wheres]
+        if not collections or not query_texts:
+            return [[] for _ in query_texts]
+
+        if mode != RETRIEVAL_KEYWORD and query_vectors is None:
+            query_vectors = self.embeddings.embed_queries(query_texts)
+
+        def search(name):
+            return self._retrieve_collection(
+                name, query_texts, query_vectors, mode, k, wheres[name], fetch_k, lambda_mult
+            )
+
+        if len(collections) == 1:
+            return search(collections[0])
+        per_collection = map_blocking(SEARCH, search, collections)
+        return [
+            reciprocal_rank_fusion(list(results), k=k) for results in zip(*per_collection)
+        ]
+
+    def _retrieve_collection(
+        self,
+        collection_name: str,
+        query_texts: List[str],
+        query_vectors: List[List[float]],
+        mode: str,
+        k: int,
+        where: Where = None,
+        fetch_k: int = None,
+        lambda_mult: float = None,
+    ) -> List[List[Document]]:
+        """Retrieve from one collection for every query, tagging each chunk with it"""
+        if mode == RETRIEVAL_KEYWORD:
+            results = self._keyword_search_many(query_texts, k, collection_name, where)
+        else:
+            results = self._vector_search(
+                collection_name, query_texts, query_vectors, mode, k, where, fetch_k, lambda_mult
+            )
+        for docs in results:
+            for doc in docs:
+                doc.metadata["collection"] = collection_name
+        return results
+
+    def _vector_search(
+        self,
+        collection_name: str,
+        query_texts: List[str],
+        query_vectors: List[List[float]],
+        mode: str,
+        k: int,
+        where: Where = None,
+        fetch_k: int = None,
+        lambda_mult: float = None,
+    ) -> List[List[Document]]:
+        if fetch_k:
+            fetch_k = max(fetch_k, k)
+        else:
+            fetch_k = max(getattr(settings, "RAG_MMR_FETCH_K", 20), 2 * k)
+        if lambda_mult is None:
+            lambda_mult = getattr(settings, "RAG_MMR_LAMBDA", 0.5)
+        collection = self.get_vectorstore(collection_name)._collection
+
+        with tracing.span("vector_search"):
+            # Candidates come with their embeddings, so MMR needs no second fetch
+            found = collection.query(
+                query_embeddings=list(query_vectors),
+                n_results=fetch_k,
+                where=where,
+                include=["documents", "metadatas", "embeddings"],
+            )
+
+        chunks: Dict[str, Document] = {}
+        results = []
+        for row, query_vector in enumerate(query_vectors):
+            with tracing.span("mmr"):
+                selected = maximal_marginal_relevance(
+                    query_vector, found["embeddings"][row], k, lambda_mult
+                )
+            # The picked chunks in relevance order
+            docs = []
+            for i in sorted(selected):
+                chunk_id = found["ids"][row][i]
+                if chunk_id not in chunks:
+                    chunks[chunk_id] = Document(
+                        page_content=found["documents"][row][i],
+                        metadata=found["metadatas"][row][i] or {},
+                        id=chunk_id,
+                    )
+                docs.append(chunks[chunk_id])
+            results.append(docs)
+        if mode == RETRIEVAL_VECTOR:
+            return results
+
+        keyword_results = self._keyword_search_many(
+            query_texts, max(20, 2 * k), collection_name, where
         )
+        return [
+            reciprocal_rank_fusion([docs, keyword_docs], k=k)
+            for docs, keyword_docs in zip(results, keyword_results)
+        ]
+
+    def keyword_search(
+        self,
+        query_text: str,
+        k: int = 10,
+        collection_name: str = DEFAULT_COLLECTION,
+        where: Where = None,
+    ) -> List[Document]:
+        """Retrieve the best BM25 matches for exact terms (codes, acronyms, names)"""
+        return self._keyword_search_many([query_text], k, collection_name, where)[0]
+
+    def _keyword_search_many(
+        self,
+        query_texts: List[str],
+        k: int = 10,
+        collection_name: str = DEFAULT_COLLECTION,
+        where: Where = None,
+    ) -> List[List[Document]]:
+        """BM25 matches of every query, fetched from Chroma together
+
+        With a filter, each query's best ``KEYWORD_OVERFETCH * k`` BM25 hits
+        are fetched through the where clause and the first ``k`` that pass
+        are kept. Queries that come up short are searched wider, up to
+        ``KEYWORD_MAX_FETCH * k`` hits, so the cost follows ``k`` rather
+        than how many chunks the filter matches. A filter stricter than
+        that may leave a query with fewer than ``k`` keyword matches.
+        """
+        collection = self.get_vectorstore(collection_name)._collection
+        keyword_index = self.registry.get_keyword_index(collection_name)
+        fetch_k = k if where is None else KEYWORD_OVERFETCH * k
+        chunks: Dict[str, Document] = {}
+        fetched = set()
+        ranked: List[List[str]] = [[] for _ in query_texts]
+        pending = list(range(len(query_texts)))
+        with tracing.span("keyword_search"):
+            while pending:
+                hits = {
+                    i: [
+                        chunk_id
+                        for chunk_id, _ in keyword_index.search(query_texts[i], k=fetch_k)
+                    ]
+                    for i in pending
+                }
+                ids = list(
+                    dict.fromkeys(
+                        chunk_id
+                        for query_hits in hits.values()
+                        for chunk_id in query_hits
+                        if chunk_id not in fetched
+                    )
+                )
+                if ids:
+                    # Chunks the filter rejects don't come back
+                    found = collection.get(
+                        ids=ids, where=where, include=["documents", "metadatas"]
+                    )
+                    fetched.update(ids)
+                    for chunk_id, text, metadata in zip(
+                        found["ids"], found["documents"], found["metadatas"]
+                    ):
+                        chunks[chunk_id] = Document(
+                            page_content=text, metadata=metadata or {}, id=chunk_id
+                        )
+                # Chroma returns ids in storage order: keep the BM25 ranking
+                for i, query_hits in hits.items():
+                    ranked[i] = [chunk_id for chunk_id in query_hits if chunk_id in chunks][:k]
+
+                # Widen the queries the filter left short while BM25 has more hits
+                fetch_k *= 2
+                if where is None or fetch_k > KEYWORD_MAX_FETCH * k:
+                    break
+                pending = [
+                    i for i in pending if len(ranked[i]) < k and len(hits[i]) == fetch_k // 2
+                ]
+        return [[chunks[chunk_id] for chunk_id in ids] for ids in ranked]
+
+    def prepare_prompt(
+        self,
+        query_text: str,
+        query_vector: List[float],
+        mode: str,
+        context_tokens: int = None,
+        rerank: bool = False,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        mmr: MMRParams = None,
+    ) -> Tuple[str, List[Document], Dict[str, Any]]:
+        """
+        Retrieve chunks, optionally rerank them, and pack them into the prompt
+
+        With ``rerank`` a wider candidate set (``settings.RAG_RERANK_CANDIDATES``)
+        is retrieved and the cross-encoder keeps the best
+        ``settings.RAG_RERANK_TOP_N`` of them (or ``mmr.k``).
+
+        :return: The prompt, the chunks it contains and timing stats
+        """
+        return self.prepare_prompts(
+            [query_text], [query_vector], mode, context_tokens, rerank, collections, filters, mmr
+        )[0]
+
+    def prepare_prompts(
+        self,
+        query_texts: List[str],
+        query_vectors: List[List[float]],
+        mode: str,
+        context_tokens: int = None,
+        rerank: bool = False,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        mmr: MMRParams = None,
+    ) -> List[Tuple[str, List[Document], Dict[str, Any]]]:
+        """``prepare_prompt`` for several queries, retrieving for all of them at once
 
-        # Create an enhanced prompt template
-        template = """
-        You are an AI assistant synthesizing comprehensive information from multiple documents.
-        
-        CONTEXT GUIDELINES:
-        - Carefully analyze ALL provided context chunks
-        - Synthesize information from different sources
-        - Identify and highlight key insights across documents
-        - If sources contain conflicting information, discuss the discrepancies
-        
-        CONTEXT:
-        {context}
-        
-        QUESTION:
-        {question}
-        
-        INSTRUCTIONS:
-        1. Provide a thorough answer using information from ALL context chunks
-        2. If no comprehensive answer is possible, explain what information is missing
-        3. Cite sources for different pieces of information
-        4. Demonstrate how information from multiple sources connects or provides a complete picture
-        5. Be precise, informative, and transparent about the sources of your information
-        
-        ANSWER:
-        """
-
-        # Create prompt
-        prompt = PromptTemplate.from_template(template)
-
-        # Create the QA chain with MMR retrieval
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=self.llm,
-            chain_type="stuff",
-            retriever=retriever,
-            return_source_documents=True,
-            chain_type_kwargs={"prompt": prompt},
+        Chunks shared between the queries are tokenized once.
+        """
+        mmr = mmr or MMRParams()
+        if rerank:
+            k = getattr(settings, "RAG_RERANK_CANDIDATES", 40)
+        else:
+            k = mmr.k or getattr(settings, "RAG_RETRIEVAL_K", 10)
+        results = self.retrieve_many(
+            query_texts,
+            query_vectors,
+            mode,
+            k=k,
+            collections=collections,
+            filters=filters,
+            fetch_k=mmr.fetch_k,
+            lambda_mult=mmr.lambda_mult,
         )
 
-        # Run the chain
-        result = qa_chain({"query": query_text})
+        count_tokens = self.llm.get_num_tokens
+        if len(query_texts) > 1:
+            token_counts: Dict[str, int] = {}
+
+            def count_tokens(text: str) -> int:
+                if text not in token_counts:
+                    token_counts[text] = self.llm.get_num_tokens(text)
+                return token_counts[text]
+
+        prepared = []
+        for query_text, docs in zip(query_texts, results):
+            stats = {}
+            if rerank:
+                with tracing.span("rerank"):
+                    docs, stats = self.registry.get_reranker().rerank(
+                        query_text, docs, mmr.k or getattr(settings, "RAG_RERANK_TOP_N", 10)
+                    )
+            with tracing.span("prompt_assembly"):
+                prompt, docs, prompt_tokens = self.pack_context(
+                    query_text, docs, context_tokens, count_tokens
+                )
+            prepared.append((prompt, docs, {"prompt_tokens": prompt_tokens, **stats}))
+        return prepared
+
+    def build_prompt(self, query_text: str, context: str) -> str:
+        """Put the packed context and the question into the prompt template"""
+        prompt = PromptTemplate.from_template(PROMPT_TEMPLATE)
+        return prompt.format(context=context, question=query_text)
+
+    def pack_context(
+        self,
+        query_text: str,
+        docs: List[Document],
+        context_tokens: int = None,
+        count_tokens: Callable[[str], int] = None,
+    ) -> Tuple[str, List[Document], int]:
+        """
+        Build the prompt from as many top-ranked chunks as the token budget allows
 
-        # Process sources with enhanced metadata
-        sources = []
-        unique_documents = set()
-        for doc in result["source_documents"]:
-            source = {
+        :param context_tokens: Token budget for the retrieved chunks (defaults
+            to ``settings.RAG_CONTEXT_TOKENS``); always capped so the prompt
+            leaves room for the answer in the model's context window
+        :param count_tokens: Token counter, the LLM's own by default
+        :return: The prompt, the chunks it contains and its token count
+        """
+        llm = self.llm
+        count_tokens = count_tokens or llm.get_num_tokens
+        overhead = count_tokens(self.build_prompt(query_text, ""))
+        available = (
+            getattr(llm, "n_ctx", 4096)
+            - (getattr(llm, "max_tokens", None) or 0)
+            - overhead
+            - CONTEXT_MARGIN
+        )
+        budget = min(context_tokens or getattr(settings, "RAG_CONTEXT_TOKENS", 2048), available)
+
+        packed = ContextAssembler(count_tokens).pack(docs, max(0, budget))
+        prompt = self.build_prompt(query_text, packed.context)
+        return prompt, packed.docs, count_tokens(prompt)
+
+    def format_sources(self, docs: List[Document]) -> List[Dict[str, Any]]:
+        """Process sources with enhanced metadata
+
+        One source per document; ``chunks`` lists every chunk of it that was
+        used, so its full text can be fetched from the citation endpoint.
+        """
+        sources = {}
+        for doc in docs:
+            chunk = {
                 "id": doc.metadata.get("chunk_id", "unknown"),
-                "document_name": doc.metadata.get("name", "unknown"),
                 "page": doc.metadata.get("page", 0),
+            }
+
+            # Ensure unique documents are added
+            key = (doc.metadata.get("collection", DEFAULT_COLLECTION), doc.metadata.get("name"))
+            if key in sources:
+                sources[key]["chunks"].append(chunk)
+                continue
+            sources[key] = {
+                "id": chunk["id"],
+                "document_id": doc.metadata.get("document_id"),
+                "document_name": doc.metadata.get("name", "unknown"),
+                "page": chunk["page"],
                 "source": doc.metadata.get("source", "unknown"),
+                "collection": key[0],
                 "content_preview": doc.page_content[:200] + "..."
                 if len(doc.page_content) > 200
                 else doc.page_content,
+                "chunks": [chunk],
             }
+        return list(sources.values())
 
-            # Ensure unique documents are added
-            if source["document_name"] not in unique_documents:
-                sources.append(source)
-                unique_documents.add(source["document_name"])
+    def _query_scope(
+        self,
+        mode: str,
+        context_tokens: int,
+        rerank: bool,
+        collections: List[str],
+        filters: RetrievalFilter,
+        mmr: MMRParams,
+    ) -> Tuple[str, bool, List[str], Dict[str, Any]]:
+        """Resolve the query defaults; returns them with the answer cache scope"""
+        mode = mode or getattr(settings, "RAG_RETRIEVAL_MODE", RETRIEVAL_HYBRID)
+        if rerank is None:
+            rerank = getattr(settings, "RAG_RERANK", False)
+        collections = sorted(set(collections or [DEFAULT_COLLECTION]))
+        scope = {
+            "mode": mode,
+            "context_tokens": context_tokens,
+            "rerank": rerank,
+            "collections": collections,
+            "filters": filters.scope() if filters else None,
+            "mmr": mmr.scope() if mmr else None,
+        }
+        return mode, rerank, collections, scope
+
+    def prepare_query(
+        self,
+        query_text: str,
+        use_cache: bool = True,
+        mode: str = None,
+        context_tokens: int = None,
+        rerank: bool = None,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        mmr: MMRParams = None,
+    ) -> PreparedQuery:
+        """
+        Run everything that precedes generation: answer cache lookup,
+        retrieval and prompt packing
+
+        Blocking (embedding, Chroma, the database); the async query path
+        runs it on an executor. ``cached`` is set on a cache hit.
+        """
+        start_time = time.time()
+        cache = get_answer_cache() if use_cache else None
+        mode, rerank, collections, scope = self._query_scope(
+            mode, context_tokens, rerank, collections, filters, mmr
+        )
 
-        # Calculate timing information
-        end_time = time.time()
-        total_time = int((end_time - start_time) * 1000)  # Convert to milliseconds
+        # The query embedding serves both the semantic cache and retrieval
+        query_vector = self.embeddings.embed_query(query_text)
+        if cache is not None:
+            cached, cache_status = cache.get(query_text, query_vector, scope)
+            if cached is not None:
+                cached["cache"] = cache_status
+                cached["timing"] = {"total_ms": _elapsed_ms(start_time)}
+                return PreparedQuery(query_text, start_time, cache, scope, query_vector, cached)
 
-        # Return response
+        prompt, docs, stats = self.prepare_prompt(
+            query_text, query_vector, mode, context_tokens, rerank, collections, filters, mmr
+        )
+        return PreparedQuery(
+            query_text,
+            start_time,
+            cache,
+            scope,
+            query_vector,
+            prompt=prompt,
+            sources=self.format_sources(docs),
+            stats=stats,
+            retrieval_ms=_elapsed_ms(start_time),
+        )
+
+    def prepare_queries(
+        self,
+        query_texts: List[str],
+        use_cache: bool = True,
+        mode: str = None,
+        context_tokens: int = None,
+        rerank: bool = None,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        mmr: MMRParams = None,
+    ) -> List[PreparedQuery]:
+        """
+        ``prepare_query`` for many questions with the same options
+
+        The questions are embedded in one batch and the ones the answer
+        cache can't serve are retrieved for together, see ``retrieve_many``.
+        """
+        start_time = time.time()
+        cache = get_answer_cache() if use_cache else None
+        mode, rerank, collections, scope = self._query_scope(
+            mode, context_tokens, rerank, collections, filters, mmr
+        )
+
+        query_vectors = self.embeddings.embed_queries(query_texts)
+        prepared: List[Optional[PreparedQuery]] = [None] * len(query_texts)
+        misses = []
+        for i, (query_text, query_vector) in enumerate(zip(query_texts, query_vectors)):
+            if cache is not None:
+                cached, cache_status = cache.get(query_text, query_vector, scope)
+                if cached is not None:
+                    cached["cache"] = cache_status
+                    cached["timing"] = {"total_ms": _elapsed_ms(start_time)}
+                    prepared[i] = PreparedQuery(
+                        query_text, start_time, cache, scope, query_vector, cached
+                    )
+                    continue
+            misses.append(i)
+
+        prompts = self.prepare_prompts(
+            [query_texts[i] for i in misses],
+            [query_vectors[i] for i in misses],
+            mode,
+            context_tokens,
+            rerank,
+            collections,
+            filters,
+            mmr,
+        )
+        retrieval_ms = _elapsed_ms(start_time)
+        for i, (prompt, docs, stats) in zip(misses, prompts):
+            prepared[i] = PreparedQuery(
+                query_texts[i],
+                start_time,
+                cache,
+                scope,
+                query_vectors[i],
+                prompt=prompt,
+                sources=self.format_sources(docs),
+                stats=stats,
+                retrieval_ms=retrieval_ms,
+            )
+        return prepared
+
+    def finish_query(
+        self, prepared: PreparedQuery, answer: str, timing: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Cache a generated answer and build the response (touches the database)"""
+        result = {"answer": answer, "sources": prepared.sources}
+        if prepared.cache is not None:
+            prepared.cache.put(prepared.query_text, result, prepared.query_vector, prepared.scope)
+
+        return {
+            **result,
+            "cache": CACHE_MISS,
+            "timing": {
+                "retrieval_ms": prepared.retrieval_ms,
+                **timing,
+                "total_ms": _elapsed_ms(prepared.start_time),
+                **prepared.stats,
+            },
+        }
+
+    def _complete(
+        self,
+        result: Dict[str, Any],
+        breakdown: Optional[Dict[str, float]],
+        generation: Dict[str, Any] = None,
+    ) -> Dict[str, Any]:
+        """Count a finished query and attach its stage breakdown, if one was collected"""
+        tracing.count("rag_queries_total", cache=result["cache"])
+        tracing.observe("query", result["timing"]["total_ms"])
+        if breakdown is not None:
+            # The LLM stages ran on a scheduler thread, outside the trace
+            for stage, key in LLM_STAGES:
+                if key in (generation or {}):
+                    breakdown[stage] = generation[key]
+            result["trace"] = breakdown
+        return result
+
+    def submit_generation(
+        self, prepared: PreparedQuery, priority: int = PRIORITY_INTERACTIVE
+    ) -> GenerationRequest:
+        """Queue the prompt for a free LLM slot; raises LLMQueueFull when the queue is full"""
+        return self.scheduler.submit(prepared.prompt, priority, prefix=PROMPT_PREFIX)
+
+    def query(
+        self,
+        query_text: str,
+        use_cache: bool = True,
+        mode: str = None,
+        context_tokens: int = None,
+        rerank: bool = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        trace: bool = False,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        mmr: MMRParams = None,
+    ) -> Dict[str, Any]:
+        """
+        Process a query using Maximal Marginal Relevance (MMR) retrieval
+
+        :param query_text: User's query string
+        :param use_cache: Serve repeated and near-duplicate questions from the
+            answer cache
+        :param mode: Retrieval mode, see ``retrieve``
+        :param context_tokens: Token budget for retrieved context, see
+            ``pack_context``
+        :param rerank: Rerank a wider candidate set with the cross-encoder;
+            defaults to ``settings.RAG_RERANK``
+        :param priority: Queue priority of the generation, lower first
+        :param trace: Add a ``trace`` with the milliseconds spent per pipeline
+            stage (embedding, search, reranking, prompt assembly, LLM queue,
+            prefill and decode)
+        :param collections: Collections to search, see ``retrieve``
+        :param filters: Document and page filters, see ``RetrievalFilter``
+        :param mmr: Overrides of k, fetch_k and lambda, see ``MMRParams``
+        :return: Dictionary containing answer, sources, cache status and
+            timing information
+        """
+        with tracing.collect(trace) as breakdown:
+            prepared = self.prepare_query(
+                query_text, use_cache, mode, context_tokens, rerank, collections, filters, mmr
+            )
+        if prepared.cached is not None:
+            return self._complete(prepared.cached, breakdown)
+
+        generation_start = time.time()
+        request = self.submit_generation(prepared, priority)
+        try:
+            answer = request.result()
+        finally:
+            request.cancel()
+        timing = {"generation_ms": _elapsed_ms(generation_start), **request.stats}
+        result = self.finish_query(prepared, answer, timing)
+        return self._complete(result, breakdown, request.stats)
+
+    async def aquery(
+        self,
+        query_text: str,
+        use_cache: bool = True,
+        mode: str = None,
+        context_tokens: int = None,
+        rerank: bool = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        trace: bool = False,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        mmr: MMRParams = None,
+    ) -> Dict[str, Any]:
+        """Async ``query``: blocking stages run on executors, generation is awaited"""
+        with tracing.collect(trace) as breakdown:
+            prepared = await run_blocking(
+                RETRIEVAL,
+                self.prepare_query,
+                query_text,
+                use_cache,
+                mode,
+                context_tokens,
+                rerank,
+                collections,
+                filters,
+                mmr,
+            )
+        if prepared.cached is not None:
+            return self._complete(prepared.cached, breakdown)
+
+        generation_start = time.time()
+        request = self.submit_generation(prepared, priority)
+        try:
+            answer = await asyncio.wrap_future(request.future)
+        finally:
+            # Also runs when the client disconnects and the task is cancelled
+            request.cancel()
+        timing = {"generation_ms": _elapsed_ms(generation_start), **request.stats}
+        result = await run_blocking(RETRIEVAL, self.finish_query, prepared, answer, timing)
+        return self._complete(result, breakdown, request.stats)
+
+    def _cached_events(self, cached: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return [
+            {
+                "event": "sources",
+                "data": {"sources": cached["sources"], "timing": cached["timing"]},
+            },
+            {"event": "token", "data": {"text": cached["answer"]}},
+            self._done_event(cached),
+        ]
+
+    def _sources_event(self, prepared: PreparedQuery) -> Dict[str, Any]:
+        return {
+            "event": "sources",
+            "data": {
+                "sources": prepared.sources,
+                "timing": {"retrieval_ms": prepared.retrieval_ms, **prepared.stats},
+            },
+        }
+
+    def _done_event(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        data = {"answer": result["answer"], "cache": result["cache"], "timing": result["timing"]}
+        if "trace" in result:
+            data["trace"] = result["trace"]
+        return {"event": "done", "data": data}
+
+    def stream_query(
+        self,
+        query_text: str,
+        use_cache: bool = True,
+        mode: str = None,
+        context_tokens: int = None,
+        rerank: bool = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        trace: bool = False,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        mmr: MMRParams = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Process a query, yielding events as soon as each stage produces output
+
+        Yields ``{"event": "sources", ...}`` once retrieval finishes, one
+        ``{"event": "token", ...}`` per generated token and a final
+        ``{"event": "done", ...}`` carrying the full answer, the cache status
+        and the timing breakdown (``retrieval_ms``, ``queue_wait_ms``,
+        ``ttft_ms``, ``generation_ms``, ``prompt_tokens`` and, when
+        reranking, ``rerank_ms``), plus the ``trace`` when asked for. A
+        cached answer arrives as a single token.
+        """
+        with tracing.collect(trace) as breakdown:
+            prepared = self.prepare_query(
+                query_text, use_cache, mode, context_tokens, rerank, collections, filters, mmr
+            )
+        if prepared.cached is not None:
+            yield from self._cached_events(self._complete(prepared.cached, breakdown))
+            return
+        yield self._sources_event(prepared)
+
+        generation_start = time.time()
+        ttft_ms = None
+        tokens = []
+        request = self.submit_generation(prepared, priority)
+        try:
+            for token in request.tokens():
+                if ttft_ms is None:
+                    ttft_ms = _elapsed_ms(generation_start)
+                tokens.append(token)
+                yield {"event": "token", "data": {"text": token}}
+        finally:
+            # Frees the slot early if the client disconnected mid-stream
+            request.cancel()
+
+        timing = {
+            "ttft_ms": ttft_ms if ttft_ms is not None else 0,
+            "generation_ms": _elapsed_ms(generation_start),
+            **request.stats,
+        }
+        result = self.finish_query(prepared, "".join(tokens), timing)
+        yield self._done_event(self._complete(result, breakdown, request.stats))
+
+    async def astream_query(
+        self,
+        query_text: str,
+        use_cache: bool = True,
+        mode: str = None,
+        context_tokens: int = None,
+        rerank: bool = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        trace: bool = False,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        mmr: MMRParams = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Async ``stream_query``: tokens are relayed without holding a thread"""
+        with tracing.collect(trace) as breakdown:
+            prepared = await run_blocking(
+                RETRIEVAL,
+                self.prepare_query,
+                query_text,
+                use_cache,
+                mode,
+                context_tokens,
+                rerank,
+                collections,
+                filters,
+                mmr,
+            )
+        if prepared.cached is not None:
+            for event in self._cached_events(self._complete(prepared.cached, breakdown)):
+                yield event
+            return
+        yield self._sources_event(prepared)
+
+        generation_start = time.time()
+        ttft_ms = None
+        tokens = []
+        request = self.submit_generation(prepared, priority)
+        try:
+            async for token in request.atokens():
+                if ttft_ms is None:
+                    ttft_ms = _elapsed_ms(generation_start)
+                tokens.append(token)
+                yield {"event": "token", "data": {"text": token}}
+        finally:
+            request.cancel()
+
+        timing = {
+            "ttft_ms": ttft_ms if ttft_ms is not None else 0,
+            "generation_ms": _elapsed_ms(generation_start),
+            **request.stats,
+        }
+        result = await run_blocking(
+            RETRIEVAL, self.finish_query, prepared, "".join(tokens), timing
+        )
+        yield self._done_event(self._complete(result, breakdown, request.stats))
+
+    def query_batch(
+        self,
+        query_texts: List[str],
+        use_cache: bool = True,
+        mode: str = None,
+        context_tokens: int = None,
+        rerank: bool = None,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        mmr: MMRParams = None,
+        concurrency: int = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Answer many questions, yielding each answer as soon as it is ready
+
+        The questions share the work in front of the LLM (see
+        ``prepare_queries``) and a question repeated in the batch is answered
+        once. Generations are queued at ``PRIORITY_BATCH``, so interactive
+        queries go first, and at most ``concurrency`` at a time (defaults to
+        ``settings.RAG_BATCH_CONCURRENCY``, capped at half the LLM queue).
+
+        Yields ``{"event": "answer", ...}`` per question, in the order the
+        answers finish (cached ones first), with its ``index`` in the batch;
+        ``{"event": "error", ...}`` for a question whose generation failed;
+        then ``{"event": "stats", ...}`` with the throughput of the batch.
+        """
+        batch = QueryBatch(self, query_texts, concurrency)
+        yield from batch.prepare(use_cache, mode, context_tokens, rerank, collections, filters, mmr)
+        try:
+            while batch.pending or batch.running:
+                try:
+                    batch.submit()
+                except LLMQueueFull as e:
+                    time.sleep(e.retry_after)
+                    continue
+                done, _ = wait(batch.running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from batch.finish(future)
+        finally:
+            # Also runs when the client disconnects and the generator is closed
+            batch.cancel()
+        yield batch.stats_event()
+
+    async def aquery_batch(
+        self,
+        query_texts: List[str],
+        use_cache: bool = True,
+        mode: str = None,
+        context_tokens: int = None,
+        rerank: bool = None,
+        collections: List[str] = None,
+        filters: RetrievalFilter = None,
+        mmr: MMRParams = None,
+        concurrency: int = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Async ``query_batch``: generations are awaited without holding a thread"""
+        batch = QueryBatch(self, query_texts, concurrency)
+        events = await run_blocking(
+            RETRIEVAL,
+            lambda: list(
+                batch.prepare(use_cache, mode, context_tokens, rerank, collections, filters, mmr)
+            ),
+        )
+        for event in events:
+            yield event
+
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def wake(_):
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                # The event loop has already shut down
+                pass
+
+        try:
+            while batch.pending or batch.running:
+                try:
+                    for future in batch.submit():
+                        future.add_done_callback(wake)
+                except LLMQueueFull as e:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                await ready.wait()
+                ready.clear()
+                for future in [future for future in batch.running if future.done()]:
+                    for event in await run_blocking(
+                        RETRIEVAL, lambda: list(batch.finish(future))
+                    ):
+                        yield event
+        finally:
+            batch.cancel()
+        yield batch.stats_event()
+
+
+class QueryBatch:
+    """Bookkeeping of one ``RAGService.query_batch`` run
+
+    Holds the prepared questions, the generations in flight and the
+    counters of the final stats; the sync and async loops only wait.
+    """
+
+    def __init__(self, service: RAGService, query_texts: List[str], concurrency: int = None):
+        self.service = service
+        self.query_texts = query_texts
+        self.start_time = time.time()
+        concurrency = concurrency or getattr(settings, "RAG_BATCH_CONCURRENCY", 4)
+        # Leave half the LLM queue to interactive queries
+        self.concurrency = max(1, min(concurrency, service.scheduler.max_queue // 2))
+
+        # Indexes of each distinct question
+        groups: Dict[str, List[int]] = {}
+        for index, query_text in enumerate(query_texts):
+            groups.setdefault(" ".join(query_text.split()), []).append(index)
+        self.indexes = list(groups.values())
+
+        self.prepared: List[PreparedQuery] = []
+        self.pending: "deque[int]" = deque()
+        self.running: Dict[Future, Tuple[int, GenerationRequest, float]] = {}
+        self.counts = {"answered": 0, "failed": 0, "cache_hits": 0, "completion_tokens": 0}
+
+    def prepare(self, *options) -> Iterator[Dict[str, Any]]:
+        """Retrieve for every distinct question; yields the cached answers
+
+        Blocking, takes ``prepare_queries``' options after the questions.
+        """
+        self.prepared = self.service.prepare_queries(
+            [self.query_texts[group[0]] for group in self.indexes], *options
+        )
+        for i, query in enumerate(self.prepared):
+            if query.cached is None:
+                self.pending.append(i)
+            else:
+                self.counts["cache_hits"] += len(self.indexes[i])
+                yield from self._answers(i, self.service._complete(query.cached, None))
+
+    def submit(self) -> List[Future]:
+        """Queue generations up to the concurrency limit; returns their futures
+
+        Raises ``LLMQueueFull`` only when none of the batch's generations is
+        running: otherwise the caller waits for one of those instead.
+        """
+        futures = []
+        while self.pending and len(self.running) < self.concurrency:
+            try:
+                request = self.service.submit_generation(
+                    self.prepared[self.pending[0]], PRIORITY_BATCH
+                )
+            except LLMQueueFull:
+                if self.running:
+                    break
+                raise
+            self.running[request.future] = (self.pending.popleft(), request, time.time())
+            futures.append(request.future)
+        return futures
+
+    def finish(self, future: Future) -> Iterator[Dict[str, Any]]:
+        """Cache and yield a finished generation (touches the database)"""
+        i, request, generation_start = self.running.pop(future)
+        try:
+            answer = future.result()
+        except Exception as e:
+            self.counts["failed"] += len(self.indexes[i])
+            for index in self.indexes[i]:
+                yield {
+                    "event": "error",
+                    "data": {"index": index, "query": self.query_texts[index], "error": str(e)},
+                }
+            return
+        timing = {"generation_ms": _elapsed_ms(generation_start), **request.stats}
+        result = self.service.finish_query(self.prepared[i], answer, timing)
+        self.counts["completion_tokens"] += request.stats.get("completion_tokens", 0)
+        yield from self._answers(i, self.service._complete(result, None, request.stats))
+
+    def cancel(self) -> None:
+        for _, request, _ in self.running.values():
+            request.cancel()
+
+    def _answers(self, i: int, result: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        self.counts["answered"] += len(self.indexes[i])
+        for index in self.indexes[i]:
+            yield {
+                "event": "answer",
+                "data": {"index": index, "query": self.query_texts[index], **result},
+            }
+
+    def stats_event(self) -> Dict[str, Any]:
+        """Throughput of the batch, and how much retrieval the questions shared"""
+        chunks = [
+            (source["collection"], source["document_id"], chunk["id"])
+            for query in self.prepared
+            for source in query.sources
+            for chunk in source["chunks"]
+        ]
+        seconds = time.time() - self.start_time
+        counts = self.counts
         return {
-            "answer": result["result"],
-            "sources": sources,
-            "timing": {"total_ms": total_time},
+            "event": "stats",
+            "data": {
+                "questions": len(self.query_texts),
+                "unique_questions": len(self.indexes),
+                **counts,
+                "context_chunks": len(chunks),
+                "unique_context_chunks": len(set(chunks)),
+                "retrieval_ms": max((query.retrieval_ms for query in self.prepared), default=0),
+                "total_ms": int(seconds * 1000),
+                "questions_per_s": round(counts["answered"] / seconds, 2) if seconds else 0.0,
+                "tokens_per_s": round(counts["completion_tokens"] / seconds, 1)
+                if seconds
+                else 0.0,
+            },
         }
@@ -0,0 +1,402 @@
+# rag/services/registry.py
+import gc
+import logging
+import os
+import re
+import shutil
+import threading
+from typing import Dict, Optional, Type, Union
+
+import chromadb
+from django.conf import settings
+from langchain_chroma import Chroma
+
+from .chunk_store import ChunkStore
+from .compact_store import CompactCollection, CompactVectorStore
+from .embedding import EmbeddingService
+from .keyword_index import KeywordIndex
+from .llm import LLMScheduler
+
+DEFAULT_COLLECTION = "pdf_collection"
+
+VECTOR_BACKENDS = ("chroma", "compact")
+
+logger = logging.getLogger(__name__)
+
+# Chroma's rule for collection names; also keeps them safe as directory names
+_COLLECTION_NAME = re.compile(r"^[A-Za-z0-9](?:[A-Za-z0-9._-]{1,61})[A-Za-z0-9]$")
+
+
+def validate_collection(name: str) -> str:
+    """Return ``name`` if it can name a collection, else raise ValueError"""
+    if not isinstance(name, str) or not _COLLECTION_NAME.match(name) or ".." in name:
+        raise ValueError(
+            f"Invalid collection name: {name!r} (3-63 letters, digits, '.', '_' or '-', "
+            "starting and ending with a letter or digit)"
+        )
+    return name
+
+
+class ModelBackend:
+    """Factory for the models owned by the registry"""
+
+    name = "base"
+
+    def create_embeddings(self):
+        raise NotImplementedError
+
+    def create_llm(self):
+        raise NotImplementedError
+
+    def create_reranker(self):
+        raise NotImplementedError
+
+
+class DefaultBackend(ModelBackend):
+    """HuggingFace embeddings and the llama.cpp LLM"""
+
+    name = "default"
+
+    def create_embeddings(self):
+        from .embedding import get_embeddings
+
+        return get_embeddings()
+
+    def create_llm(self):
+        from .llm import CustomLLM
+
+        return CustomLLM(model_path=getattr(settings, "RAG_LLM_MODEL_PATH", None)).get_llm()
+
+    def create_reranker(self):
+        from .rerank import CrossEncoderScorer
+
+        return CrossEncoderScorer(
+            getattr(settings, "RAG_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+        )
+
+
+class FakeBackend(ModelBackend):
+    """Deterministic embedder and LLM for tests and benchmarks (no GPU)"""
+
+    name = "fake"
+
+    def create_embeddings(self):
+        from .fakes import FakeEmbeddings
+
+        return FakeEmbeddings()
+
+    def create_llm(self):
+        from .fakes import FakeLlamaClient, FakeLLM
+
+        return FakeLLM(
+            client=FakeLlamaClient(),
+            token_delay=getattr(settings, "RAG_FAKE_LLM_TOKEN_MS", 0) / 1000,
+        )
+
+    def create_reranker(self):
+        from .fakes import StubScorer
+
+        return StubScorer()
+
+
+_BACKENDS: Dict[str, Type[ModelBackend]] = {
+    DefaultBackend.name: DefaultBackend,
+    FakeBackend.name: FakeBackend,
+}
+
+
+def register_backend(name: str, backend_class: Type[ModelBackend]) -> None:
+    """Make a backend selectable through ``settings.RAG_MODEL_BACKEND``"""
+    _BACKENDS[name] = backend_class
+
+
+class ModelRegistry:
+    """Process-wide owner of the embedder, the LLM, the Chroma client and
+    the keyword indexes
+
+    Every model is created lazily on first use and then shared by all
+    requests served by this worker process. ``base_dir`` overrides where
+    indexes are stored (defaults to ``settings.BASE_DIR``).
+    """
+
+    def __init__(self, base_dir: str = None):
+        self.base_dir = base_dir
+        self._lock = threading.RLock()
+        self._backend: Optional[ModelBackend] = None
+        self._embeddings = None
+        self._llm = None
+        self._reranker = None
+        self._client = None
+        self._vectorstores: Dict[str, Chroma] = {}
+        self._keyword_indexes: Dict[str, KeywordIndex] = {}
+        self._chunk_store: Optional[ChunkStore] = None
+        self._scheduler: Optional[LLMScheduler] = None
+
+    @property
+    def persist_directory(self) -> str:
+        return os.path.join(self.base_dir or settings.BASE_DIR, "chroma_db")
+
+    @property
+    def keyword_index_directory(self) -> str:
+        return os.path.join(self.base_dir or settings.BASE_DIR, "keyword_index")
+
+    @property
+    def compact_index_directory(self) -> str:
+        return os.path.join(self.base_dir or settings.BASE_DIR, "compact_index")
+
+    @property
+    def vector_backend(self) -> str:
+        backend = getattr(settings, "RAG_VECTOR_BACKEND", "chroma")
+        if backend not in VECTOR_BACKENDS:
+            raise ValueError(f"Unknown vector backend: {backend}")
+        return backend
+
+    @property
+    def chunk_store_directory(self) -> str:
+        return os.path.join(self.base_dir or settings.BASE_DIR, "chunk_store")
+
+    @property
+    def backend(self) -> ModelBackend:
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    name = getattr(settings, "RAG_MODEL_BACKEND", DefaultBackend.name)
+                    if name not in _BACKENDS:
+                        raise ValueError(f"Unknown RAG model backend: {name}")
+                    self._backend = _BACKENDS[name]()
+        return self._backend
+
+    def set_backend(self, backend: Union[str, ModelBackend]) -> None:
+        """Swap the backend, dropping every model created by the previous one"""
+        if isinstance(backend, str):
+            if backend not in _BACKENDS:
+                raise ValueError(f"Unknown RAG model backend: {backend}")
+            backend = _BACKENDS[backend]()
+
+        with self._lock:
+            self.teardown()
+            self._backend = backend
+
+    def get_embeddings(self):
+        """Get the shared embeddings model"""
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    self._embeddings = EmbeddingService.from_settings(
+                        self.backend.create_embeddings()
+                    )
+        return self._embeddings
+
+    def get_llm(self):
+        """Get the shared LLM"""
+        if self._llm is None:
+            with self._lock:
+                if self._llm is None:
+                    self._llm = self.backend.create_llm()
+        return self._llm
+
+    def get_reranker(self):
+        """Get the shared cross-encoder reranker"""
+        if self._reranker is None:
+            with self._lock:
+                if self._reranker is None:
+                    from .rerank import Reranker
+
+                    try:
+                        scorer = self.backend.create_reranker()
+                    except (ImportError, OSError):
+                        # Missing sentence-transformers or model files: rerank
+                        # requests keep the retrieval order instead of failing
+                        logger.exception("Cross-encoder unavailable, reranking disabled")
+                        scorer = None
+                    self._reranker = Reranker(
+                        scorer,
+                        batch_size=getattr(settings, "RAG_RERANK_BATCH_SIZE", 16),
+                        budget_ms=getattr(settings, "RAG_RERANK_BUDGET_MS", 200),
+                    )
+        return self._reranker
+
+    def get_scheduler(self) -> LLMScheduler:
+        """Get the scheduler sharing the LLM slots between requests
+
+        The first slot is the shared LLM; ``RAG_LLM_SLOTS`` above one loads
+        an extra model instance per slot.
+        """
+        if self._scheduler is None:
+            with self._lock:
+                if self._scheduler is None:
+                    slots = max(1, getattr(settings, "RAG_LLM_SLOTS", 1))
+                    llms = [self.get_llm()] + [
+                        self.backend.create_llm() for _ in range(slots - 1)
+                    ]
+                    self._scheduler = LLMScheduler(
+                        llms, max_queue=getattr(settings, "RAG_LLM_QUEUE_LIMIT", 16)
+                    )
+        return self._scheduler
+
+    def loaded_scheduler(self) -> Optional[LLMScheduler]:
+        """The scheduler if something already created it; never loads a model"""
+        return self._scheduler
+
+    def get_client(self):
+        """Get the shared Chroma client"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    def _create_client(self):
+        try:
+            return chromadb.PersistentClient(path=self.persist_directory)
+        except Exception:
+            logger.exception("Error creating ChromaDB")
+            # If there's an error, try to recreate the database
+            if os.path.exists(self.persist_directory):
+                logger.warning("Recreating ChromaDB directory %s", self.persist_directory)
+                shutil.rmtree(self.persist_directory, ignore_errors=True)
+            # Try again with a fresh database
+            return chromadb.PersistentClient(path=self.persist_directory)
+
+    def get_vectorstore(
+        self, collection_name: str = DEFAULT_COLLECTION
+    ) -> Union[Chroma, CompactVectorStore]:
+        """Get or create the vector store for a collection
+
+        ``settings.RAG_VECTOR_BACKEND`` picks Chroma or the compact engine.
+        """
+        vectorstore = self._vectorstores.get(collection_name)
+        if vectorstore is None:
+            with self._lock:
+                vectorstore = self._vectorstores.get(collection_name)
+                if vectorstore is None:
+                    if self.vector_backend == "compact":
+                        vectorstore = CompactVectorStore(
+                            self._create_compact_collection(collection_name),
+                            embedding_function=self.get_embeddings(),
+                        )
+                    else:
+                        vectorstore = Chroma(
+                            client=self.get_client(),
+                            embedding_function=self.get_embeddings(),
+                            collection_name=collection_name,
+                        )
+                    self._vectorstores[collection_name] = vectorstore
+        return vectorstore
+
+    def _create_compact_collection(self, collection_name: str) -> CompactCollection:
+        return CompactCollection(
+            os.path.join(self.compact_index_directory, collection_name),
+            precision=getattr(settings, "RAG_COMPACT_PRECISION", "int8"),
+            rescore=getattr(settings, "RAG_COMPACT_RESCORE", 4),
+            max_segments=getattr(settings, "RAG_COMPACT_MAX_SEGMENTS", 8),
+        )
+
+    def get_keyword_index(self, collection_name: str = DEFAULT_COLLECTION) -> KeywordIndex:
+        """Get the BM25 index kept alongside a collection"""
+        index = self._keyword_indexes.get(collection_name)
+        if index is None:
+            with self._lock:
+                index = self._keyword_indexes.get(collection_name)
+                if index is None:
+                    index = KeywordIndex(
+                        os.path.join(self.keyword_index_directory, collection_name)
+                    )
+                    if not index.exists():
+                        self._backfill_keyword_index(index, collection_name)
+                    self._keyword_indexes[collection_name] = index
+        return index
+
+    def get_chunk_store(self) -> ChunkStore:
+        """Get the extracted text and chunk offsets of every document"""
+        if self._chunk_store is None:
+            with self._lock:
+                if self._chunk_store is None:
+                    self._chunk_store = ChunkStore(self.chunk_store_directory)
+        return self._chunk_store
+
+    def _backfill_keyword_index(self, index: KeywordIndex, collection_name: str) -> None:
+        """Index chunks that were written to Chroma before the keyword index existed"""
+        collection = self.get_vectorstore(collection_name)._collection
+        total = collection.count()
+        for offset in range(0, total, 1000):
+            batch = collection.get(include=["documents"], limit=1000, offset=offset)
+            index.add(batch["ids"], batch["documents"])
+        if total:
+            index.save()
+
+    def reset_collection(self, collection_name: str = DEFAULT_COLLECTION) -> None:
+        """Delete every vector in a collection, and its keyword index"""
+        with self._lock:
+            vectorstore = self._vectorstores.pop(collection_name, None)
+            # Reset in place: services may hold on to the index object
+            index = self._keyword_indexes.setdefault(
+                collection_name,
+                KeywordIndex(os.path.join(self.keyword_index_directory, collection_name)),
+            )
+            index.reset()
+            if self.vector_backend == "compact":
+                if isinstance(vectorstore, CompactVectorStore):
+                    vectorstore._collection.close()
+                shutil.rmtree(
+                    os.path.join(self.compact_index_directory, collection_name),
+                    ignore_errors=True,
+                )
+                return
+            try:
+                self.get_client().delete_collection(collection_name)
+            except Exception:
+                # Nothing to delete yet
+                pass
+
+    def warm_up(self) -> None:
+        """Load every model up front so the first request doesn't pay for it"""
+        self.get_embeddings()
+        self.get_scheduler()
+        self.get_vectorstore()
+        self.get_keyword_index()
+
+    def teardown(self) -> None:
+        """Release every model held by this process"""
+        with self._lock:
+            llms = [self._llm]
+            if self._scheduler is not None:
+                # Lets running generations finish before their models go
+                self._scheduler.close()
+                llms = [slot.llm for slot in self._scheduler.slots]
+            if self._embeddings is not None:
+                self._embeddings.close()
+            for index in self._keyword_indexes.values():
+                index.save()
+            for vectorstore in self._vectorstores.values():
+                if isinstance(vectorstore, CompactVectorStore):
+                    # Let a background segment merge finish
+                    vectorstore._collection.close()
+            self._keyword_indexes = {}
+            self._chunk_store = None
+            self._scheduler = None
+            self._vectorstores = {}
+            self._client = None
+            self._embeddings = None
+            self._llm = None
+            self._reranker = None
+
+            # llama.cpp keeps the weights alive until the client is closed
+            for llm in llms:
+                client = getattr(llm, "client", None)
+                if client is not None and hasattr(client, "close"):
+                    client.close()
+            gc.collect()
+
+    def reload(self) -> None:
+        """Drop and reload every model, e.g. after swapping the GGUF on disk"""
+        with self._lock:
+            self.teardown()
+            self.warm_up()
+
+
+registry = ModelRegistry()
+
+
+def get_registry() -> ModelRegistry:
+    return registry
@@ -0,0 +1,126 @@
+# rag/services/rerank.py
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+from langchain.schema import Document
+
+from .answer_cache import normalize_query
+
+# Pairs scored first when the reranker has no measured cost to go by yet
+PROBE_SIZE = 2
+
+
+class CrossEncoderScorer:
+    """Score (query, passage) pairs with a sentence-transformers cross-encoder"""
+
+    def __init__(self, model_name: str):
+        # Imported lazily: sentence-transformers pulls in torch
+        from sentence_transformers import CrossEncoder
+
+        from .embedding import _resolve_device
+
+        self.model = CrossEncoder(model_name, device=_resolve_device())
+
+    def score(self, query_text: str, texts: List[str]) -> List[float]:
+        pairs = [(query_text, text) for text in texts]
+        scores = self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+        return [float(score) for score in scores]
+
+
+class Reranker:
+    """Rerank retrieved chunks with a cross-encoder inside a time budget
+
+    Candidates are scored in batches of up to ``batch_size``, each cut to
+    what fits in the rest of ``budget_ms`` at the per-pair cost measured
+    on the last batch (across queries). Until a cost has been measured, a
+    ``PROBE_SIZE`` batch goes first. Candidates left unscored when the
+    budget runs out keep their retrieval order, and the scored ones are
+    reordered among themselves. Scores are cached per (query, chunk), so
+    a repeated query or an overlapping candidate set only scores what's
+    new. Without a ``scorer`` (the cross-encoder couldn't be loaded) every
+    query keeps the retrieval order.
+    """
+
+    def __init__(
+        self,
+        scorer: Any,
+        batch_size: int = 16,
+        budget_ms: float = 200,
+        cache_size: int = 10_000,
+    ):
+        self.scorer = scorer
+        self.batch_size = batch_size
+        self.budget_ms = budget_ms
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, Any, int], float]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Milliseconds per scored pair on the last batch; None until measured
+        self._pair_ms = None
+
+    def _key(self, query: str, doc: Document) -> Tuple[str, Any, int]:
+        # The content checksum keeps re-indexed chunks that reuse an id apart
+        chunk_id = doc.id or (doc.metadata.get("source"), doc.metadata.get("chunk_id"))
+        return (query, chunk_id, zlib.crc32(doc.page_content.encode("utf-8")))
+
+    def rerank(
+        self, query_text: str, docs: List[Document], top_n: int
+    ) -> Tuple[List[Document], Dict[str, Any]]:
+        """Return the ``top_n`` best chunks and timing stats
+
+        If the budget runs out before every candidate is scored, the scored
+        ones are reordered within the places they hold in the retrieval
+        order and the rest stay where they are.
+        """
+        start = time.perf_counter()
+        query = normalize_query(query_text)
+        keys = [self._key(query, doc) for doc in docs]
+
+        with self._lock:
+            scores = {key: self._cache[key] for key in keys if key in self._cache}
+            for key in scores:
+                self._cache.move_to_end(key)
+        cached = len(scores)
+
+        pending = [(key, doc) for key, doc in zip(keys, docs) if key not in scores]
+        offset = 0
+        while self.scorer is not None and offset < len(pending):
+            pair_ms = self._pair_ms
+            if pair_ms is None:
+                size = min(self.batch_size, PROBE_SIZE)
+            else:
+                remaining_ms = self.budget_ms - (time.perf_counter() - start) * 1000
+                size = min(self.batch_size, int(remaining_ms / max(pair_ms, 1e-3)))
+                if size <= 0:
+                    break
+
+            batch_start = time.perf_counter()
+            batch = pending[offset : offset + size]
+            batch_scores = self.scorer.score(query_text, [doc.page_content for _, doc in batch])
+            self._pair_ms = (time.perf_counter() - batch_start) * 1000 / len(batch)
+            offset += len(batch)
+
+            with self._lock:
+                for (key, _), score in zip(batch, batch_scores):
+                    scores[key] = score
+                    self._cache[key] = score
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        fallback = len(scores) < len(set(keys))
+        order = list(range(len(docs)))
+        scored = [i for i in order if keys[i] in scores]
+        # Unscored candidates keep their places; scored ones swap between theirs
+        by_score = sorted(scored, key=lambda i: scores[keys[i]], reverse=True)
+        for place, i in zip(scored, by_score):
+            order[place] = i
+        ranked = [docs[i] for i in order[:top_n]]
+
+        return ranked, {
+            "rerank_ms": int((time.perf_counter() - start) * 1000),
+            "rerank_cached": cached,
+            "rerank_scored": len(scored),
+            "rerank_fallback": fallback,
+        }
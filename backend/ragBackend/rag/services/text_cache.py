@@ -0,0 +1,165 @@
+# rag/services/text_cache.py
+import json
+import os
+import threading
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+from django.conf import settings
+from langchain.schema import Document
+
+_TRAILER = np.dtype("<i8")
+_OFFSET = np.dtype("<i8")
+
+# Per page fields kept in the header column rather than copied per page
+_PAGE_FIELDS = ("source", "page", "page_label")
+
+
+class PageTextWriter:
+    """Stream a file's pages, in page order, into its cache file
+
+    The file is written under a temporary name and swapped in on ``close``;
+    an exception inside the ``with`` block discards it instead.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._file = open(self.tmp_path, "wb")
+        self._offsets: List[int] = [0]
+        self._labels: List[Any] = []
+        self._metadata: Optional[Dict[str, Any]] = None
+
+    def add(self, page: Document) -> None:
+        if self._metadata is None:
+            self._metadata = {
+                key: value for key, value in page.metadata.items() if key not in _PAGE_FIELDS
+            }
+        block = zlib.compress(page.page_content.encode("utf-8"))
+        self._file.write(block)
+        self._offsets.append(self._offsets[-1] + len(block))
+        self._labels.append(page.metadata.get("page_label"))
+
+    def close(self) -> None:
+        """Append the header (metadata, page labels), block offsets and page count"""
+        header = zlib.compress(
+            json.dumps(
+                {"metadata": self._metadata or {}, "labels": self._labels}, default=str
+            ).encode()
+        )
+        self._file.write(header)
+        self._offsets.append(self._offsets[-1] + len(header))
+        self._file.write(np.array(self._offsets, dtype=_OFFSET).tobytes())
+        self._file.write(np.array([len(self._labels)], dtype=_TRAILER).tobytes())
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self._file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self) -> "PageTextWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def page_count(path: str) -> int:
+    with open(path, "rb") as f:
+        f.seek(-_TRAILER.itemsize, os.SEEK_END)
+        return int(np.frombuffer(f.read(_TRAILER.itemsize), dtype=_TRAILER)[0])
+
+
+def read_pages(
+    path: str, file_path: str, start: int = 0, stop: int = None
+) -> Iterator[Document]:
+    """Pages [start, stop) of a cache file, as the PDF loader would yield them
+
+    Only the requested blocks are read and decompressed, one page at a
+    time. Runs in PDF worker processes too, hence a plain function.
+    """
+    with open(path, "rb") as f:
+        f.seek(-_TRAILER.itemsize, os.SEEK_END)
+        count = int(np.frombuffer(f.read(_TRAILER.itemsize), dtype=_TRAILER)[0])
+        table = (count + 2) * _OFFSET.itemsize
+        f.seek(-(_TRAILER.itemsize + table), os.SEEK_END)
+        offsets = np.frombuffer(f.read(table), dtype=_OFFSET)
+
+        f.seek(int(offsets[count]))
+        header = json.loads(zlib.decompress(f.read(int(offsets[-1] - offsets[count]))))
+        metadata, labels = header["metadata"], header["labels"]
+
+        for i in range(start, count if stop is None else min(stop, count)):
+            f.seek(int(offsets[i]))
+            text = zlib.decompress(f.read(int(offsets[i + 1] - offsets[i])))
+            yield Document(
+                page_content=text.decode("utf-8"),
+                metadata={**metadata, "source": file_path, "page": i, "page_label": labels[i]},
+            )
+
+
+class PageTextCache:
+    """Extracted text of every parsed PDF, keyed by the file's SHA-256
+
+    Parsing is the slowest ingestion stage, so each file is parsed once:
+    re-chunking, rebuilds and re-uploads of the same bytes read the text
+    from here. A file holds one zlib block per page, then a header with
+    the document metadata and page labels, then the block offsets and the
+    page count, so any page range is read without decompressing the rest.
+    """
+
+    SUFFIX = ".pages"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    @classmethod
+    def from_settings(cls) -> Optional["PageTextCache"]:
+        """The configured cache, or None when ``RAG_TEXT_CACHE_DIR`` is empty"""
+        directory = getattr(settings, "RAG_TEXT_CACHE_DIR", None)
+        return cls(directory) if directory else None
+
+    def path(self, file_hash: str) -> str:
+        return os.path.join(self.directory, f"{file_hash}{self.SUFFIX}")
+
+    def has(self, file_hash: str) -> bool:
+        return bool(file_hash) and os.path.exists(self.path(file_hash))
+
+    def writer(self, file_hash: str) -> PageTextWriter:
+        os.makedirs(self.directory, exist_ok=True)
+        return PageTextWriter(self.path(file_hash))
+
+    def write(self, file_hash: str, pages: Iterable[Document]) -> None:
+        with self.writer(file_hash) as writer:
+            for page in pages:
+                writer.add(page)
+
+    def page_count(self, file_hash: str) -> int:
+        return page_count(self.path(file_hash))
+
+    def pages(
+        self, file_hash: str, file_path: str, start: int = 0, stop: int = None
+    ) -> Iterator[Document]:
+        return read_pages(self.path(file_hash), file_path, start, stop)
+
+    def prune(self, keep: Iterable[str]) -> int:
+        """Delete the text of files no longer indexed; returns how many went"""
+        keep = {f"{file_hash}{self.SUFFIX}" for file_hash in keep if file_hash}
+        removed = 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            if name.endswith(self.SUFFIX) and name not in keep:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
@@ -0,0 +1,165 @@
+# rag/services/tracing.py
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+# Histogram bucket bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Per-request breakdown collected by ``collect()``: stage -> milliseconds
+_trace: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "rag_trace", default=None
+)
+
+_NOOP = nullcontext()
+
+
+class Histogram:
+    """Cumulative latency histogram in Prometheus layout"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class Metrics:
+    """Process-wide stage histograms and labelled counters
+
+    Every worker process keeps its own metrics; a scraper sees the process
+    that answers it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+
+    def render(self, gauges: Dict[str, float] = None) -> str:
+        """Prometheus text exposition format"""
+        lines: List[str] = []
+        with self._lock:
+            if self.stages:
+                lines.append("# HELP rag_stage_duration_seconds Time spent per pipeline stage")
+                lines.append("# TYPE rag_stage_duration_seconds histogram")
+            for stage, histogram in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}'
+                    )
+                lines.append(f'rag_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.total}')
+                lines.append(f'rag_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+            seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                rendered = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"{name}{{{rendered}}} {value}" if rendered else f"{name} {value}")
+
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def enabled() -> bool:
+    return getattr(settings, "RAG_METRICS", True)
+
+
+class _Span:
+    __slots__ = ("stage", "trace", "start")
+
+    def __init__(self, stage: str, trace: Optional[Dict[str, float]]):
+        self.stage = stage
+        self.trace = trace
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        _record(self.stage, time.perf_counter() - self.start, self.trace)
+
+
+def _record(stage: str, seconds: float, trace: Optional[Dict[str, float]]) -> None:
+    if enabled():
+        metrics.observe(stage, seconds)
+    if trace is not None:
+        # Stages that run several times per request (e.g. per page) add up
+        trace[stage] = round(trace.get(stage, 0.0) + seconds * 1000, 2)
+
+
+def span(stage: str):
+    """Time a block as one pipeline stage
+
+    A no-op context manager unless metrics are on (``RAG_METRICS``) or a
+    per-request breakdown is being collected.
+    """
+    trace = _trace.get()
+    if trace is None and not enabled():
+        return _NOOP
+    return _Span(stage, trace)
+
+
+def observe(stage: str, milliseconds: float) -> None:
+    """Record a stage timed elsewhere, e.g. on the LLM scheduler's threads"""
+    trace = _trace.get()
+    if trace is not None or enabled():
+        _record(stage, milliseconds / 1000, trace)
+
+
+def count(name: str, value: float = 1, **labels: str) -> None:
+    if enabled():
+        metrics.count(name, value, **labels)
+
+
+@contextmanager
+def collect(active: bool = True) -> Iterator[Optional[Dict[str, float]]]:
+    """Collect a per-request stage breakdown (milliseconds) for spans in this context
+
+    Yields None, and collects nothing, when not ``active``.
+    """
+    if not active:
+        yield None
+        return
+    trace: Dict[str, float] = {}
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
@@ -0,0 +1,145 @@
+# rag/services/uploads.py
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from datetime import timedelta
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from ..models import Document, IngestionJob, UploadSession
+
+# Bytes read and written at a time while streaming uploads
+BLOCK_SIZE = 1024 * 1024
+
+PART_SUFFIX = ".part"
+
+ACTIVE_JOB_STATUSES = (IngestionJob.STATUS_QUEUED, IngestionJob.STATUS_RUNNING)
+
+
+def stage_file(blocks: Iterable[bytes], file_path: str) -> Tuple[str, str, int]:
+    """Write ``blocks`` to a temporary file next to ``file_path``, hashing as they go
+
+    Returns (temporary path, SHA-256, size). The caller moves the file into
+    place with ``os.replace``, or removes it, e.g. when it is a duplicate.
+    """
+    directory, name = os.path.split(file_path)
+    tmp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.upload")
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for block in blocks:
+                sha256.update(block)
+                f.write(block)
+                size += len(block)
+    except BaseException:
+        discard_file(tmp_path)
+        raise
+    return tmp_path, sha256.hexdigest(), size
+
+
+def discard_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def find_duplicate(file_hash: str, collection: str) -> Optional[Document]:
+    """A document of ``collection`` with exactly this content, if any
+
+    Documents still being ingested count too, so the same bytes uploaded
+    twice in a row are only indexed once.
+    """
+    documents = (
+        Document.objects.filter(collection=collection, file_hash=file_hash)
+        .filter(Q(indexed=True) | Q(jobs__status__in=ACTIVE_JOB_STATUSES))
+        .distinct()
+    )
+    for document in documents:
+        if os.path.exists(document.file_path):
+            return document
+    return None
+
+
+def active_job(document: Document) -> Optional[IngestionJob]:
+    """The queued or running ingestion job of a document, if any"""
+    return (
+        document.jobs.filter(status__in=ACTIVE_JOB_STATUSES).order_by("-created_at").first()
+    )
+
+
+def uploads_dir() -> str:
+    """Directory holding the parts of unfinished resumable uploads"""
+    return os.path.join(settings.MEDIA_ROOT, "uploads")
+
+
+def session_dir(session: UploadSession) -> str:
+    return os.path.join(uploads_dir(), str(session.id))
+
+
+def write_part(session: UploadSession, index: int, blocks: Iterable[bytes]) -> int:
+    """Store part ``index`` of an upload; returns its size
+
+    Parts are written under a temporary name and swapped in, so a retried
+    part replaces a partial one and concurrent parts never share a file.
+    Raises ValueError if the part isn't exactly the expected size.
+    """
+    expected = session.part_length(index)
+    directory = session_dir(session)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{index}{PART_SUFFIX}")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for block in blocks:
+                size += len(block)
+                if size > expected:
+                    break
+                f.write(block)
+        if size != expected:
+            raise ValueError(f"Part {index} must be {expected} bytes")
+        os.replace(tmp_path, path)
+    except BaseException:
+        discard_file(tmp_path)
+        raise
+    return size
+
+
+def received_parts(session: UploadSession) -> List[int]:
+    try:
+        names = os.listdir(session_dir(session))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[: -len(PART_SUFFIX)]) for name in names if name.endswith(PART_SUFFIX))
+
+
+def iter_parts(session: UploadSession) -> Iterator[bytes]:
+    """Every part's bytes, in order, ``BLOCK_SIZE`` at a time"""
+    directory = session_dir(session)
+    for index in range(session.part_count):
+        with open(os.path.join(directory, f"{index}{PART_SUFFIX}"), "rb") as f:
+            yield from iter(lambda: f.read(BLOCK_SIZE), b"")
+
+
+def discard_parts(session: UploadSession) -> None:
+    shutil.rmtree(session_dir(session), ignore_errors=True)
+
+
+def expire_sessions() -> int:
+    """Drop uploads started more than ``RAG_UPLOAD_SESSION_HOURS`` ago"""
+    hours = getattr(settings, "RAG_UPLOAD_SESSION_HOURS", 24)
+    expired = UploadSession.objects.filter(created_at__lt=timezone.now() - timedelta(hours=hours))
+    count = 0
+    for session in expired:
+        discard_parts(session)
+        session.delete()
+        count += 1
+    return count
@@ -1,3 +1,1676 @@
-from django.test import TestCase
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pypdf
+from asgiref.sync import async_to_sync
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import clear_url_caches, resolve
+from django.utils import timezone
+from langchain.schema import Document
+from langchain_chroma.vectorstores import maximal_marginal_relevance as langchain_mmr
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from ragBackend import urls as project_urls
+
+from . import urls as rag_urls
+from . import views
+from .benchmarks.compare import compare
+from .benchmarks.synthetic import write_pdf
+from .models import Document as DocumentModel
+from .services import tracing
+from .services.answer_cache import (
+    CACHE_HIT,
+    CACHE_MISS,
+    CACHE_SEMANTIC,
+    AnswerCache,
+    get_answer_cache,
+)
+from .services.chroma_db import ChromaDBService, documents_dir
+from .services.chunk_store import ChunkStore
+from .services.compact_store import CompactCollection
+from .services.context import SEPARATOR, ContextAssembler
+from .services.embedding import EmbeddingService, QueryMicroBatcher
+from .services.embedding_cache import EmbeddingCache
+from .services.fakes import FakeLLM, FakeLlamaClient, StubScorer
+from .services.filters import RetrievalFilter
+from .services.ingestion import IngestionPipeline, get_pipeline
+from .services.keyword_index import KeywordIndex
+from .services.llm import (
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    GenerationCancelled,
+    LLMQueueFull,
+    LLMScheduler,
+    PromptPrefixCache,
+)
+from .services.mmr import MMRParams, maximal_marginal_relevance
+from .services.pdf import PDFProcessor, _load_pdf_pages, file_fingerprint
+from .services.rag import KEYWORD_MAX_FETCH, RAGService
+from .services.registry import (
+    DEFAULT_COLLECTION,
+    FakeBackend,
+    ModelRegistry,
+    get_registry,
+    validate_collection,
+)
+from .services.rerank import Reranker
+from .services.text_cache import PageTextCache
+
+
+class FakeModelsMixin:
+    """Fake models (RAG_MODEL_BACKEND=fake), with every index and upload in a temporary directory"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        overrides = override_settings(
+            BASE_DIR=self.directory,
+            MEDIA_ROOT=os.path.join(self.directory, "media"),
+            RAG_MODEL_BACKEND="fake",
+            RAG_EMBEDDING_CACHE_DIR="",
+            RAG_TEXT_CACHE_DIR="",
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        registry = get_registry()
+        registry.set_backend("fake")
+        self.addCleanup(registry.teardown)
+        get_answer_cache().invalidate()
+
+    def write_pdf(self, name: str, pages: int = 3, seed: int = 0) -> str:
+        return write_pdf(os.path.join(self.directory, name), pages, seed=seed)
+
+    def upload(self, name: str, pages: int = 3, seed: int = 0):
+        with open(self.write_pdf(name, pages, seed), "rb") as f:
+            return self.client.post("/api/upload/", {"file": f})
+
+    def wait_for_job(self, job_id, timeout: float = 30) -> dict:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = self.client.get(f"/api/jobs/{job_id}/").json()
+            if job["status"] in ("completed", "failed"):
+                return job
+            time.sleep(0.05)
+        self.fail(f"Job {job_id} didn't finish within {timeout}s")
+
+    def query(self, path: str = "/api/query/", **body):
+        return self.client.post(path, body, content_type="application/json")
+
+    def index(self, name: str, pages: int = 3, seed: int = 0) -> DocumentModel:
+        """Index a synthetic PDF in the calling thread, skipping the upload pipeline"""
+        path = self.write_pdf(name, pages, seed)
+        document = DocumentModel.objects.create(name=name, file_path=path)
+        chunks = PDFProcessor().process_pdf(path)["chunks"]
+        document.chunk_ids = ChromaDBService().replace_document(document, chunks)
+        document.chunk_count = len(chunks)
+        document.file_hash = file_fingerprint(path)[0]
+        document.indexed = True
+        document.save()
+        return document
+
+    def indexed_ids(self, document: DocumentModel) -> set:
+        """Ids of the vectors in the store for a document"""
+        return set(
+            ChromaDBService().get_vectorstore()._collection.get(
+                where={"document_id": str(document.id)}, include=[]
+            )["ids"]
+        )
+
+
+def sse_events(response):
+    """Decode a Server-Sent Events response into (event, data) pairs"""
+    body = b"".join(response.streaming_content).decode("utf-8")
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+# Ingestion runs on worker threads, which only see committed rows
+class QueryEndToEndTests(FakeModelsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        response = self.upload("handbook.pdf", pages=4, seed=1)
+        self.assertEqual(response.status_code, 202, response.content)
+        job = self.wait_for_job(response.json()["job_id"])
+        self.assertEqual(job["status"], "completed", job)
+
+    def test_upload_then_query_cites_the_document(self):
+        response = self.query(query="lorem ipsum dolor", cache=False)
+
+        self.assertEqual(response.status_code, 200, response.content)
+        result = response.json()
+        self.assertTrue(result["answer"])
+        self.assertTrue(result["sources"])
+        self.assertEqual({s["document_name"] for s in result["sources"]}, {"handbook.pdf"})
+
+    def test_repeated_query_is_served_from_the_cache(self):
+        first = self.query(query="lorem ipsum dolor").json()
+        second = self.query(query="Lorem ipsum dolor?").json()
+
+        self.assertEqual(first["cache"], "miss")
+        self.assertEqual(second["cache"], "hit")
+        self.assertEqual(second["answer"], first["answer"])
+
+    def test_stream_sends_sources_then_tokens_then_the_answer(self):
+        response = self.query("/api/query/stream/", query="lorem ipsum dolor", cache=False)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = sse_events(response)
+        names = [name for name, _ in events]
+        self.assertEqual(names[0], "sources")
+        self.assertEqual(names[-1], "done")
+        self.assertEqual(set(names[1:-1]), {"token"})
+        sources = events[0][1]["sources"]
+        self.assertEqual({s["document_name"] for s in sources}, {"handbook.pdf"})
+        answer = "".join(data["text"] for name, data in events if name == "token")
+        self.assertEqual(events[-1][1]["answer"], answer)
+
+    def test_invalid_options_are_rejected(self):
+        for body in ({}, {"query": "x", "cache": "false"}, {"query": "x", "mode": "fuzzy"}):
+            with self.subTest(body=body):
+                self.assertEqual(self.query(**body).status_code, 400)
+
+
+class IngestionJobTests(FakeModelsMixin, TransactionTestCase):
+    def test_job_reports_its_progress_until_completed(self):
+        running, release = threading.Event(), threading.Event()
+        process = IngestionPipeline.process
+
+        def gated_process(pipeline, job):
+            running.set()
+            release.wait(10)
+            return process(pipeline, job)
+
+        with mock.patch.object(IngestionPipeline, "process", gated_process):
+            response = self.upload("report.pdf", pages=3, seed=8)
+            self.assertEqual(response.status_code, 202, response.content)
+            self.assertEqual(response.json()["status"], "queued")
+            job_id = response.json()["job_id"]
+            self.assertTrue(running.wait(10))
+            self.assertEqual(self.client.get(f"/api/jobs/{job_id}/").json()["status"], "running")
+            release.set()
+            job = self.wait_for_job(job_id)
+
+        self.assertEqual(job["status"], "completed", job["error"])
+        self.assertEqual((job["pages_parsed"], job["pages_total"]), (3, 3))
+        self.assertGreater(job["chunks_total"], 0)
+        self.assertEqual(job["chunks_embedded"], job["chunks_total"])
+        document = DocumentModel.objects.get(pk=job["document_id"])
+        self.assertTrue(document.indexed)
+        self.assertEqual(document.chunk_count, job["chunks_total"])
+
+    def test_failed_job_records_the_error(self):
+        upload = SimpleUploadedFile("broken.pdf", b"not a pdf", content_type="application/pdf")
+        with self.assertLogs("rag.services.ingestion", "ERROR"):
+            response = self.client.post("/api/upload/", {"file": upload})
+            job = self.wait_for_job(response.json()["job_id"])
+
+        self.assertEqual(job["status"], "failed")
+        self.assertTrue(job["error"])
+        self.assertFalse(DocumentModel.objects.get(pk=job["document_id"]).indexed)
+
+    def test_full_queue_answers_503_and_keeps_nothing(self):
+        with mock.patch.object(get_pipeline(), "max_pending", 0):
+            response = self.upload("late.pdf", seed=9)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("error", response.json())
+        self.assertFalse(DocumentModel.objects.exists())
+        self.assertFalse(os.path.exists(os.path.join(documents_dir(), "late.pdf")))
+
+    def test_unknown_job_is_404(self):
+        response = self.client.get("/api/jobs/00000000-0000-0000-0000-000000000000/")
+        self.assertEqual(response.status_code, 404)
+
+
+class RecordingEmbeddings(Embeddings):
+    """Embeds a text as [its length, 1]; records the batches it is called with"""
+
+    def __init__(self, error: Exception = None):
+        self.batches = []
+        self.error = error
+
+    def embed_documents(self, texts):
+        self.batches.append(list(texts))
+        if self.error is not None:
+            raise self.error
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class EmbeddingServiceTests(SimpleTestCase):
+    texts = ["fives", "a", "four", "tw"]
+
+    def test_batches_similar_lengths_and_keeps_the_input_order(self):
+        model = RecordingEmbeddings()
+        service = EmbeddingService(model, batch_size=2, micro_batch_window_ms=0)
+
+        vectors = service.embed_documents(self.texts)
+        self.assertEqual(model.batches, [["a", "tw"], ["four", "fives"]])
+        self.assertEqual([vector[0] for vector in vectors], [5, 1, 4, 2])
+
+    def test_without_bucketing_batches_follow_the_input_order(self):
+        model = RecordingEmbeddings()
+        service = EmbeddingService(
+            model, batch_size=2, bucket_by_length=False, micro_batch_window_ms=0
+        )
+
+        service.embed_documents(self.texts)
+        self.assertEqual(model.batches, [["fives", "a"], ["four", "tw"]])
+
+
+class QueryMicroBatcherTests(SimpleTestCase):
+    texts = ["a", "bb", "ccc"]
+
+    def batcher(self, model, **kwargs):
+        batcher = QueryMicroBatcher(model, **kwargs)
+        self.addCleanup(batcher.close)
+        return batcher
+
+    def test_queries_within_the_window_share_one_model_call(self):
+        model = RecordingEmbeddings()
+        batcher = self.batcher(model, window_ms=200)
+        futures = [batcher.submit(text) for text in self.texts]
+
+        self.assertEqual([f.result(5)[0] for f in futures], [1, 2, 3])
+        self.assertEqual(model.batches, [self.texts])
+
+    def test_full_batches_go_without_waiting_for_the_window(self):
+        model = RecordingEmbeddings()
+        batcher = self.batcher(model, window_ms=200, max_batch=2)
+        futures = [batcher.submit(text) for text in self.texts]
+
+        start = time.monotonic()
+        futures[0].result(5)
+        self.assertLess(time.monotonic() - start, 0.2)
+        [f.result(5) for f in futures]
+        self.assertEqual([len(batch) for batch in model.batches], [2, 1])
+
+    def test_a_failed_call_fails_every_query_in_the_batch(self):
+        batcher = self.batcher(RecordingEmbeddings(error=RuntimeError("GPU gone")), window_ms=200)
+        futures = [batcher.submit(text) for text in self.texts]
+
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(5)
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def open(self, **kwargs):
+        cache = EmbeddingCache(self.directory, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_hits_ignore_whitespace_and_are_per_model(self):
+        cache = self.open()
+        cache.put_many("model-a", ["hello world"], [[1.0, 2.0]])
+
+        self.assertEqual(
+            cache.get_many("model-a", [" hello\n world", "other"]), [[1.0, 2.0], None]
+        )
+        self.assertEqual(cache.get_many("model-b", ["hello world"]), [None])
+
+    def test_evicts_the_least_recently_used_entry(self):
+        cache = self.open(max_entries=2)
+        cache.put_many("model", ["a", "b"], [[1.0], [2.0]])
+        time.sleep(0.01)
+        cache.get_many("model", ["a"])
+        time.sleep(0.01)
+        cache.put_many("model", ["c"], [[3.0]])
+
+        self.assertEqual(cache.get_many("model", ["a", "b", "c"]), [[1.0], None, [3.0]])
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_reopened_cache_serves_earlier_vectors(self):
+        cache = self.open()
+        cache.put_many("model", ["a", "b"], [[1.0, 0.5], [2.0, 0.5]])
+        cache.close()
+
+        self.assertEqual(self.open().get_many("model", ["b", "a"]), [[2.0, 0.5], [1.0, 0.5]])
+
+    def test_service_only_embeds_chunks_it_has_not_seen(self):
+        model = RecordingEmbeddings()
+        service = EmbeddingService(model, micro_batch_window_ms=0, cache=self.open())
+        service.embed_documents(["x", "yy"])
+
+        vectors = service.embed_documents(["yy", "zzz", "zzz"])
+        self.assertEqual(model.batches[1:], [["zzz"]])
+        self.assertEqual([vector[0] for vector in vectors], [2, 3, 3])
+
+
+class RebuildIndexTests(FakeModelsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Synthetic PDFs land where the rebuild looks for them
+        self.directory = documents_dir()
+        os.makedirs(self.directory)
+
+    def rebuild(self):
+        with self.assertNoLogs("rag.services.chroma_db", "ERROR"):
+            return ChromaDBService().rebuild_index()
+
+    def test_reports_what_changed_since_the_last_rebuild(self):
+        self.write_pdf("manual.pdf", seed=1)
+        self.write_pdf("notes.pdf", seed=2)
+        result = self.rebuild()
+        self.assertEqual(result["details"]["added"], ["manual.pdf", "notes.pdf"])
+        self.assertEqual(self.rebuild()["details"]["skipped"], ["manual.pdf", "notes.pdf"])
+
+        notes = DocumentModel.objects.get(name="notes.pdf")
+        self.write_pdf("manual.pdf", pages=2, seed=3)
+        os.remove(notes.file_path)
+        with open(os.path.join(self.directory, "broken.pdf"), "wb") as f:
+            f.write(b"not a pdf")
+        with self.assertLogs("rag.services.chroma_db", "ERROR"):
+            result = ChromaDBService().rebuild_index()
+
+        self.assertEqual(
+            result["details"],
+            {
+                "added": [],
+                "updated": ["manual.pdf"],
+                "removed": ["notes.pdf"],
+                "skipped": [],
+                "failed": ["broken.pdf"],
+            },
+        )
+        manual = DocumentModel.objects.get(name="manual.pdf")
+        self.assertEqual(self.indexed_ids(manual), set(manual.chunk_ids))
+        self.assertEqual(self.indexed_ids(notes), set())
+        self.assertFalse(DocumentModel.objects.filter(name="broken.pdf").exists())
+
+    def test_full_rebuild_reindexes_unchanged_files(self):
+        self.write_pdf("manual.pdf", seed=1)
+        self.rebuild()
+
+        result = ChromaDBService().rebuild_index(full=True)
+
+        self.assertEqual(result["details"]["updated"], ["manual.pdf"])
+        manual = DocumentModel.objects.get(name="manual.pdf")
+        self.assertTrue(manual.indexed)
+        self.assertEqual(self.indexed_ids(manual), set(manual.chunk_ids))
+
+
+class AnswerCacheTests(TestCase):
+    def setUp(self):
+        self.cache = AnswerCache(version_ttl=0)
+
+    def test_exact_hit_until_invalidated(self):
+        self.cache.put("What is RAG?", {"answer": "a"})
+
+        self.assertEqual(self.cache.get("what is rag"), ({"answer": "a"}, CACHE_HIT))
+        self.cache.invalidate()
+        self.assertEqual(self.cache.get("what is rag"), (None, CACHE_MISS))
+
+    def test_semantic_hit_only_within_the_same_scope(self):
+        self.cache.put("What is RAG?", {"answer": "a"}, [1.0, 0.0], scope={"mode": "hybrid"})
+
+        self.assertEqual(
+            self.cache.get("Explain RAG", [0.99, 0.01], scope={"mode": "hybrid"})[1],
+            CACHE_SEMANTIC,
+        )
+        self.assertEqual(
+            self.cache.get("Explain RAG", [0.99, 0.01], scope={"mode": "vector"})[1], CACHE_MISS
+        )
+
+    def test_other_workers_indexing_invalidates(self):
+        self.cache.put("What is RAG?", {"answer": "a"})
+        DocumentModel.objects.create(name="new.pdf", file_path="new.pdf", indexed=True)
+
+        self.assertEqual(self.cache.get("What is RAG?"), (None, CACHE_MISS))
+
+    def test_corpus_version_is_reused_within_its_ttl(self):
+        cache = AnswerCache(version_ttl=60)
+        cache.put("What is RAG?", {"answer": "a"})
+        DocumentModel.objects.create(name="new.pdf", file_path="new.pdf", indexed=True)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get("What is RAG?")[1], CACHE_HIT)
+
+
+@override_settings(RAG_TEXT_CACHE_DIR="")
+class ProcessManyTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def write_pdf(self, name, pages, seed=0, **metadata):
+        path = write_pdf(os.path.join(self.directory, name), pages, seed=seed)
+        if metadata:
+            writer = pypdf.PdfWriter(clone_from=path)
+            writer.add_metadata(metadata)
+            writer.write(path)
+        return path
+
+    def test_page_ranges_get_the_same_chunks_as_a_whole_file(self):
+        path = self.write_pdf("manual.pdf", 5, seed=5, **{"/Author": "Ada"})
+        processor = PDFProcessor()
+
+        (result,) = processor.process_many([path], max_workers=2, pages_per_task=2)
+        whole = processor.process_pdf(path)["chunks"]
+        self.assertEqual(result["page_count"], 5)
+        self.assertEqual(
+            [(c.page_content, c.metadata) for c in result["chunks"]],
+            [(c.page_content, c.metadata) for c in whole],
+        )
+        self.assertEqual(result["chunks"][-1].metadata["author"], "Ada")
+
+    def test_a_failed_file_is_reported_and_the_rest_are_processed(self):
+        paths = [
+            self.write_pdf("manual.pdf", 3, seed=1),
+            os.path.join(self.directory, "missing.pdf"),
+            os.path.join(self.directory, "broken.pdf"),
+            self.write_pdf("notes.pdf", 4, seed=2),
+        ]
+        with open(paths[2], "wb") as f:
+            f.write(b"not a pdf")
+
+        results = PDFProcessor().process_many(paths, max_workers=2, pages_per_task=2)
+        results = {result["name"]: result for result in results}
+
+        self.assertEqual(set(results), {"manual.pdf", "missing.pdf", "broken.pdf", "notes.pdf"})
+        for name in ("missing.pdf", "broken.pdf"):
+            self.assertIn("error", results[name])
+            self.assertEqual(results[name]["chunks"], [])
+        for name in ("manual.pdf", "notes.pdf"):
+            self.assertNotIn("error", results[name])
+            self.assertTrue(results[name]["chunks"])
+
+
+class IterChunksTests(SimpleTestCase):
+    def setUp(self):
+        self.processor = PDFProcessor(chunk_size=100, chunk_overlap=30)
+        self.processor.text_cache = None
+
+    def pages(self, *word_counts):
+        """Pages of numbered words; a count of 0 is a blank page"""
+        return [
+            Document(
+                page_content=" ".join(f"p{page}w{i}" for i in range(count)) or "  ",
+                metadata={"page": page, "source": "manual.pdf"},
+            )
+            for page, count in enumerate(word_counts)
+        ]
+
+    def iter_chunks(self, pages):
+        with mock.patch.object(self.processor, "load_pages", return_value=iter(pages)):
+            return list(self.processor.iter_chunks("manual.pdf"))
+
+    def test_matches_splitting_the_joined_pages(self):
+        pages = [page for page in self.pages(30, 25, 0, 40) if page.page_content.strip()]
+        text = "\n".join(page.page_content for page in pages)
+        # Offset of each page in the joined text
+        starts, offset = [], 0
+        for page in pages:
+            starts.append((offset, page.metadata["page"]))
+            offset += len(page.page_content) + 1
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=100, chunk_overlap=30, add_start_index=True
+        )
+        expected = splitter.create_documents([text])
+
+        chunks = self.iter_chunks(pages)
+
+        self.assertEqual([c.page_content for c in chunks], [e.page_content for e in expected])
+        self.assertEqual(
+            [c.metadata["page"] for c in chunks],
+            [
+                max(page for start, page in starts if start <= e.metadata["start_index"])
+                for e in expected
+            ],
+        )
+        self.assertEqual([c.metadata["chunk_id"] for c in chunks], list(range(len(chunks))))
+
+    def test_overlap_carries_across_page_breaks(self):
+        chunks = self.iter_chunks(self.pages(5, 5, 5, 0, 5, 5, 5, 5))
+
+        self.assertEqual(len(chunks), 2)
+        first, second = (chunk.page_content.splitlines() for chunk in chunks)
+        self.assertEqual([line[:2] for line in first], ["p0", "p1", "p2", "p4"])
+        # The overlap is page 4's line, so the second chunk starts on page 4
+        self.assertEqual(second[0], first[-1])
+        self.assertEqual([chunk.metadata["page"] for chunk in chunks], [0, 4])
+
+
+class ReplaceDocumentTests(FakeModelsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.chroma = ChromaDBService()
+        self.document = self.index("manual.pdf", seed=3)
+        self.chunks = PDFProcessor().process_pdf(self.document.file_path)["chunks"]
+
+    def vector_ids(self):
+        return self.indexed_ids(self.document)
+
+    def test_shorter_version_deletes_only_the_stale_vectors(self):
+        ids = self.chroma.replace_document(self.document, self.chunks[:2])
+
+        self.assertEqual(self.vector_ids(), set(ids))
+        self.assertEqual(ids, self.document.chunk_ids[:2])
+
+    def test_failed_embedding_keeps_the_old_vectors(self):
+        old_ids = set(self.document.chunk_ids)
+        with mock.patch.object(
+            self.chroma.embeddings, "embed_documents", side_effect=RuntimeError("GPU gone")
+        ), self.assertRaises(RuntimeError):
+            self.chroma.replace_document(self.document, self.chunks[:2])
+
+        self.assertEqual(self.vector_ids(), old_ids)
+        self.assertTrue(DocumentModel.objects.get(pk=self.document.pk).indexed)
+
+    def test_failed_upsert_drops_the_document(self):
+        with mock.patch.object(
+            self.chroma.chunk_store, "write", side_effect=OSError("disk full")
+        ), self.assertRaises(OSError):
+            self.chroma.replace_document(self.document, self.chunks[:2])
+
+        self.assertEqual(self.vector_ids(), set())
+        self.assertFalse(DocumentModel.objects.get(pk=self.document.pk).indexed)
+
+
+class KeywordIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def ids(self, index, query):
+        return [chunk_id for chunk_id, _ in index.search(query)]
+
+    def test_add_search_delete(self):
+        index = KeywordIndex(self.directory)
+        index.add(["a", "b"], ["apples and pears", "pears only"])
+
+        self.assertEqual(self.ids(index, "apples"), ["a"])
+        self.assertEqual(set(self.ids(index, "pears")), {"a", "b"})
+        index.delete(["a"])
+        self.assertEqual(self.ids(index, "apples"), [])
+        self.assertEqual(len(index), 1)
+
+    def test_re_adding_an_id_replaces_its_text(self):
+        index = KeywordIndex(self.directory)
+        index.add(["a"], ["apples"])
+        index.add(["a"], ["pears"])
+
+        self.assertEqual(self.ids(index, "apples"), [])
+        self.assertEqual(self.ids(index, "pears"), ["a"])
+
+    def test_saved_index_reloads(self):
+        index = KeywordIndex(self.directory)
+        index.add(["a"], ["apples"])
+        index.save()
+
+        self.assertEqual(self.ids(KeywordIndex(self.directory), "apples"), ["a"])
+
+    def test_saves_from_two_instances_merge(self):
+        first, second = KeywordIndex(self.directory), KeywordIndex(self.directory)
+        first.add(["a"], ["apples"])
+        first.save()
+        second.add(["b"], ["pears"])
+        second.save()
+        first.delete(["a"])
+        first.save()
+
+        for index in (first, second, KeywordIndex(self.directory)):
+            self.assertEqual(self.ids(index, "pears"), ["b"])
+            self.assertEqual(self.ids(index, "apples"), [])
+
+    def test_reset_is_seen_by_other_instances(self):
+        first, second = KeywordIndex(self.directory), KeywordIndex(self.directory)
+        first.add(["a"], ["apples"])
+        first.save()
+        self.assertEqual(self.ids(second, "apples"), ["a"])
+        first.reset()
+
+        self.assertEqual(self.ids(second, "apples"), [])
+
+
+class ContextAssemblerTests(SimpleTestCase):
+    def setUp(self):
+        # One token per character keeps the budgets easy to follow
+        self.assembler = ContextAssembler(count_tokens=len)
+
+    def doc(self, text):
+        return Document(page_content=text)
+
+    def test_neighbouring_chunks_overlap_is_cut(self):
+        shared = "the overlap the splitter repeats in both chunks"
+        left, right = "a" * 40 + " " + shared, shared + " " + "b" * 40
+
+        packed = self.assembler.pack([self.doc(left), self.doc(right)], budget=1000)
+
+        self.assertEqual(packed.context, left + SEPARATOR + "b" * 40)
+        self.assertEqual(packed.tokens, len(packed.context))
+        # The chunk after a packed one loses its head, the one before it its tail
+        packed = self.assembler.pack([self.doc(right), self.doc(left)], budget=1000)
+        self.assertEqual(packed.context, right + SEPARATOR + "a" * 40)
+
+    def test_duplicates_are_dropped_and_short_overlaps_kept(self):
+        text = "x" * 30 + " a passage uploaded twice, or a piece of it " + "y" * 30
+        coincidence = "y" * 10 + " unrelated text"
+
+        packed = self.assembler.pack(
+            [self.doc(text), self.doc(text[20:70]), self.doc(coincidence)], budget=1000
+        )
+
+        self.assertEqual([doc.page_content for doc in packed.docs], [text, coincidence])
+        self.assertEqual(packed.context, text + SEPARATOR + coincidence)
+
+    def test_chunks_over_the_budget_give_way_to_smaller_ones(self):
+        docs = [self.doc("a" * 60), self.doc("b" * 50), self.doc("c" * 30), self.doc("d" * 5)]
+
+        packed = self.assembler.pack(docs, budget=100)
+
+        # 60 + 2 + 30 + 2 + 5 tokens, with the separators counted
+        self.assertEqual([doc.page_content[0] for doc in packed.docs], ["a", "c", "d"])
+        self.assertEqual(packed.tokens, 99)
+        self.assertEqual(packed.tokens, len(packed.context))
+
+
+class PromptPrefixCacheTests(SimpleTestCase):
+    PREFIX = "You answer questions from the context below ."
+
+    def setUp(self):
+        self.client = FakeLlamaClient()
+        self.cache = PromptPrefixCache(self.client, self.PREFIX)
+        self.prefix_tokens = len(self.PREFIX.split()) + 1  # with the BOS token
+
+    def generate(self, prompt):
+        """Tokens the client had to evaluate for a generation under the cache"""
+        with self.cache.session(prompt) as stats:
+            before = self.client.evaluated
+            self.client.prefill(prompt)
+            return stats, self.client.evaluated - before
+
+    def test_only_the_rest_of_the_prompt_is_evaluated(self):
+        stats, evaluated = self.generate(f"{self.PREFIX} Context: one two Question: why")
+
+        self.assertEqual(stats["prefix_cached_tokens"], self.prefix_tokens)
+        self.assertEqual(evaluated, 5)
+        self.assertEqual(self.client.evaluated, self.prefix_tokens + 5)
+
+    def test_prefix_is_restored_after_another_prompt_ran(self):
+        self.generate(f"{self.PREFIX} Question: one")
+        self.client.prefill("An unrelated prompt")
+
+        stats, evaluated = self.generate(f"{self.PREFIX} Question: two")
+
+        self.assertEqual(stats["prefix_cached_tokens"], self.prefix_tokens)
+        self.assertEqual(evaluated, 2)
+
+    def test_prompt_without_the_prefix_is_a_miss(self):
+        stats, evaluated = self.generate("Summarise: one two three")
+
+        # Only the BOS token is shared
+        self.assertEqual(stats["prefix_cached_tokens"], 1)
+        self.assertEqual(evaluated, 4)
+
+    def test_supports_only_clients_with_kv_state_access(self):
+        self.assertTrue(PromptPrefixCache.supports(FakeLLM(client=self.client)))
+        self.assertFalse(PromptPrefixCache.supports(FakeLLM()))
+
+
+class CollectionTests(FakeModelsMixin, TransactionTestCase):
+    def upload_to(self, collection, name, seed):
+        with open(self.write_pdf(name, seed=seed), "rb") as f:
+            response = self.client.post("/api/upload/", {"file": f, "collection": collection})
+        self.assertEqual(response.status_code, 202, response.content)
+        job = self.wait_for_job(response.json()["job_id"])
+        self.assertEqual(job["status"], "completed", job)
+
+    def test_names_are_validated(self):
+        for name in ("legal", "team-2024", "a.b_c"):
+            with self.subTest(name=name):
+                self.assertEqual(validate_collection(name), name)
+        for name in ("ab", "-legal", "legal.", "a..b", "../docs", "x" * 64, None):
+            with self.subTest(name=name), self.assertRaises(ValueError):
+                validate_collection(name)
+        self.assertEqual(
+            documents_dir("legal"), os.path.join(self.directory, "media", "documents", "legal")
+        )
+
+    def test_uploads_and_queries_are_routed_by_collection(self):
+        self.upload_to(DEFAULT_COLLECTION, "handbook.pdf", seed=1)
+        self.upload_to("legal", "contract.pdf", seed=2)
+        self.assertTrue(os.path.exists(os.path.join(documents_dir("legal"), "contract.pdf")))
+
+        for collections, names in (
+            (None, {"handbook.pdf"}),
+            (["legal"], {"contract.pdf"}),
+            (["legal", DEFAULT_COLLECTION], {"handbook.pdf", "contract.pdf"}),
+        ):
+            with self.subTest(collections=collections):
+                body = {"query": "lorem ipsum dolor", "cache": False}
+                if collections:
+                    body["collections"] = collections
+                sources = self.query(**body).json()["sources"]
+                self.assertEqual({s["document_name"] for s in sources}, names)
+
+        listed = self.client.get("/api/collections/").json()
+        self.assertEqual(listed["default"], DEFAULT_COLLECTION)
+        self.assertEqual(
+            [(c["name"], c["documents"]) for c in listed["collections"]],
+            sorted([(DEFAULT_COLLECTION, 1), ("legal", 1)]),
+        )
+
+    def test_invalid_collections_are_rejected(self):
+        self.assertEqual(self.query(query="x", collections=["a..b"]).status_code, 400)
+        self.assertEqual(self.query(query="x", collections=[]).status_code, 400)
+        with open(self.write_pdf("handbook.pdf"), "rb") as f:
+            response = self.client.post("/api/upload/", {"file": f, "collection": "../up"})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(DocumentModel.objects.exists())
+
+
+class RetrievalFilterTests(FakeModelsMixin, TestCase):
+    def document(self, name, collection=DEFAULT_COLLECTION, days_ago=0):
+        document = DocumentModel.objects.create(
+            name=name, file_path=f"/docs/{collection}/{name}", collection=collection
+        )
+        created_at = timezone.now() - timedelta(days=days_ago)
+        DocumentModel.objects.filter(pk=document.pk).update(created_at=created_at)
+        return document
+
+    def test_from_dict_validates_and_parses(self):
+        self.assertIsNone(RetrievalFilter.from_dict({}))
+        self.assertIsNone(RetrievalFilter.from_dict({"document_names": []}))
+        filters = RetrievalFilter.from_dict(
+            {"document_names": "a.pdf", "page_min": 0, "created_after": "2026-01-02T03:04:05"}
+        )
+        self.assertEqual(filters.document_names, ("a.pdf",))
+        self.assertEqual(filters.page_min, 0)
+        self.assertTrue(timezone.is_aware(filters.created_after))
+        for data in (
+            ["a.pdf"],
+            {"pages": 1},
+            {"document_ids": ["not-a-uuid"]},
+            {"document_names": [1]},
+            {"page_max": -1},
+            {"page_max": True},
+            {"created_before": "yesterday"},
+        ):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                RetrievalFilter.from_dict(data)
+
+    def test_page_range_applies_to_every_collection(self):
+        self.assertEqual(RetrievalFilter().resolve(["a-b", "c-d"]), {"a-b": None, "c-d": None})
+        self.assertEqual(
+            RetrievalFilter(page_min=2).resolve(["a-b"]), {"a-b": {"page": {"$gte": 2}}}
+        )
+        self.assertEqual(
+            RetrievalFilter(page_min=2, page_max=4).resolve(["a-b"]),
+            {"a-b": {"$and": [{"page": {"$gte": 2}}, {"page": {"$lte": 4}}]}},
+        )
+
+    def test_documents_resolve_to_their_sources_per_collection(self):
+        old = self.document("manual.pdf", days_ago=30)
+        new = self.document("manual.pdf", collection="legal")
+        self.document("notes.pdf", collection="legal")
+
+        where = RetrievalFilter(document_names=("manual.pdf",), page_max=3).resolve(
+            [DEFAULT_COLLECTION, "legal"]
+        )
+        self.assertEqual(
+            where,
+            {
+                DEFAULT_COLLECTION: {
+                    "$and": [{"source": {"$in": [old.file_path]}}, {"page": {"$lte": 3}}]
+                },
+                "legal": {"$and": [{"source": {"$in": [new.file_path]}}, {"page": {"$lte": 3}}]},
+            },
+        )
+        # Collections without a match are left out
+        recent = RetrievalFilter(created_after=timezone.now() - timedelta(days=1))
+        self.assertEqual(set(recent.resolve([DEFAULT_COLLECTION, "legal"])), {"legal"})
+        by_id = RetrievalFilter(document_ids=(str(old.id),))
+        self.assertEqual(by_id.resolve(["legal"]), {})
+
+    def test_query_only_cites_matching_pages(self):
+        self.index("manual.pdf", pages=4, seed=1)
+        document = self.index("notes.pdf", pages=4, seed=2)
+
+        filters = {"document_ids": [str(document.id)], "page_min": 1, "page_max": 2}
+        result = self.query(query="lorem ipsum dolor", cache=False, filters=filters).json()
+
+        self.assertEqual({s["document_name"] for s in result["sources"]}, {"notes.pdf"})
+        pages = {chunk["page"] for s in result["sources"] for chunk in s["chunks"]}
+        self.assertTrue(pages)
+        self.assertLessEqual(pages, {1, 2})
+
+
+class FilteredKeywordSearchTests(FakeModelsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.index("a.pdf", pages=6, seed=6)
+        self.index("b.pdf", pages=2, seed=7)
+        self.rag = RAGService(get_registry())
+        self.where = RetrievalFilter(document_names=("b.pdf",)).resolve([DEFAULT_COLLECTION])[
+            DEFAULT_COLLECTION
+        ]
+
+    def test_returns_the_best_matches_that_pass_the_filter(self):
+        collection = self.rag.get_vectorstore(DEFAULT_COLLECTION)._collection
+        with mock.patch.object(collection, "get", wraps=collection.get) as get:
+            docs = self.rag.keyword_search("lorem dolor", k=3, where=self.where)
+
+        self.assertEqual([doc.metadata["name"] for doc in docs], ["b.pdf"] * 3)
+        # Only BM25 hits are looked up, never every chunk the filter matches
+        for call in get.call_args_list:
+            self.assertTrue(call.kwargs["ids"])
+            self.assertLessEqual(len(call.kwargs["ids"]), KEYWORD_MAX_FETCH * 3)
+
+    def test_matches_the_unfiltered_ranking_of_the_allowed_chunks(self):
+        everything = self.rag.keyword_search("lorem dolor", k=1000)
+        allowed = [doc.id for doc in everything if doc.metadata["name"] == "b.pdf"]
+
+        docs = self.rag.keyword_search("lorem dolor", k=5, where=self.where)
+        self.assertEqual([doc.id for doc in docs], allowed[:5])
+
+
+class MissingCrossEncoderBackend(FakeBackend):
+    """Fake models on a machine without sentence-transformers"""
+
+    def create_reranker(self):
+        raise ImportError("No module named 'sentence_transformers'")
+
+
+class RerankTests(SimpleTestCase):
+    def setUp(self):
+        self.docs = [
+            Document(page_content=text, metadata={"source": "a.pdf", "chunk_id": i})
+            for i, text in enumerate(["nothing relevant", "apples", "apples and pears", "pears"])
+        ]
+
+    def test_orders_by_score_and_keeps_top_n(self):
+        ranked, stats = Reranker(StubScorer()).rerank("apples pears", self.docs, top_n=3)
+
+        self.assertEqual(ranked[0].page_content, "apples and pears")
+        self.assertEqual(len(ranked), 3)
+        self.assertNotIn("nothing relevant", [doc.page_content for doc in ranked])
+        self.assertFalse(stats["rerank_fallback"])
+
+    def test_repeated_query_reuses_cached_scores(self):
+        reranker = Reranker(StubScorer())
+        first, _ = reranker.rerank("apples pears", self.docs, top_n=4)
+        second, stats = reranker.rerank("Apples pears?", self.docs, top_n=4)
+
+        self.assertEqual(stats["rerank_cached"], len(self.docs))
+        self.assertEqual(second, first)
+
+    def test_reorders_only_what_was_scored_within_the_budget(self):
+        # A two-pair probe takes 100 ms, leaving room for one more pair
+        reranker = Reranker(StubScorer(delay=0.05), batch_size=4, budget_ms=175)
+        ranked, stats = reranker.rerank("apples pears", self.docs, top_n=4)
+
+        self.assertTrue(stats["rerank_fallback"])
+        self.assertEqual(stats["rerank_scored"], 3)
+        # "pears" wasn't scored and keeps its place after the three that were
+        self.assertEqual(ranked, [self.docs[2], self.docs[1], self.docs[0], self.docs[3]])
+
+    def test_measured_cost_bounds_the_first_batch(self):
+        reranker = Reranker(StubScorer(delay=0.05), batch_size=4, budget_ms=30)
+        reranker.rerank("warm up", self.docs[:1], top_n=1)
+        ranked, stats = reranker.rerank("apples pears", self.docs, top_n=2)
+
+        self.assertEqual(stats["rerank_scored"], 0)
+        self.assertLess(stats["rerank_ms"], 30)
+        self.assertEqual(ranked, self.docs[:2])
+
+    def test_keeps_retrieval_order_without_a_cross_encoder(self):
+        with tempfile.TemporaryDirectory() as directory:
+            registry = ModelRegistry(base_dir=directory)
+            registry.set_backend(MissingCrossEncoderBackend())
+            with self.assertLogs("rag.services.registry", "ERROR"):
+                reranker = registry.get_reranker()
+            ranked, stats = reranker.rerank("apples pears", self.docs, top_n=2)
+
+        self.assertTrue(stats["rerank_fallback"])
+        self.assertEqual(ranked, self.docs[:2])
+
+
+class GatedLLM:
+    """LLM stub whose generations wait for ``gate``; records the prompts it serves"""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.prompts = []
+
+    def stream(self, prompt):
+        self.prompts.append(prompt)
+        if not self.gate.wait(10):
+            raise TimeoutError("gate never opened")
+        yield f"answer to {prompt}"
+
+
+class SchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.llm = GatedLLM()
+        self.scheduler = LLMScheduler([self.llm], max_queue=2)
+        self.addCleanup(self.scheduler.close)
+        self.addCleanup(self.llm.gate.set)
+
+    def occupy_slot(self):
+        """Start a generation and wait until the slot is busy with it"""
+        request = self.scheduler.submit("running")
+        deadline = time.monotonic() + 5
+        while self.llm.prompts != ["running"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.llm.prompts, ["running"])
+        return request
+
+    def test_interactive_requests_overtake_queued_batch_ones(self):
+        self.occupy_slot()
+        batch = self.scheduler.submit("batch", PRIORITY_BATCH)
+        interactive = self.scheduler.submit("interactive", PRIORITY_INTERACTIVE)
+        self.llm.gate.set()
+
+        self.assertEqual(batch.result(5), "answer to batch")
+        self.assertEqual(interactive.result(5), "answer to interactive")
+        self.assertEqual(self.llm.prompts, ["running", "interactive", "batch"])
+
+    def test_full_queue_rejects_with_a_retry_estimate(self):
+        self.occupy_slot()
+        self.scheduler.submit("first")
+        self.scheduler.submit("second")
+
+        with self.assertRaises(LLMQueueFull) as raised:
+            self.scheduler.submit("third")
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        self.assertEqual(self.scheduler.metrics()["rejected"], 1)
+
+    def test_cancelled_request_leaves_the_queue(self):
+        self.occupy_slot()
+        queued = self.scheduler.submit("queued")
+        queued.cancel()
+
+        with self.assertRaises(GenerationCancelled):
+            queued.result(5)
+        self.assertEqual(self.scheduler.queue_depth, 0)
+        self.llm.gate.set()
+        self.scheduler.submit("next").result(5)
+        self.assertNotIn("queued", self.llm.prompts)
+        self.assertEqual(self.scheduler.metrics()["cancelled"], 1)
+
+    def test_identical_queued_prompts_share_one_generation(self):
+        self.occupy_slot()
+        requests = [self.scheduler.submit("same") for _ in range(2)]
+        self.llm.gate.set()
+
+        self.assertEqual([r.result(5) for r in requests], ["answer to same"] * 2)
+        self.assertEqual(self.llm.prompts.count("same"), 1)
+
+
+
+
+class BusyQueueTests(FakeModelsMixin, SimpleTestCase):
+    @override_settings(RAG_LLM_QUEUE_LIMIT=0)
+    def test_stream_answers_429_with_retry_after(self):
+        response = self.query("/api/query/stream/", query="anything")
+
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+        self.assertEqual(response.json()["retry_after"], int(response["Retry-After"]))
+
+
+class AsyncViewTests(FakeModelsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        # The views are picked when the URLconf is imported
+        overrides = override_settings(RAG_ASYNC_VIEWS=True)
+        overrides.enable()
+        self.addCleanup(self.reload_urls)
+        self.addCleanup(overrides.disable)
+        self.reload_urls()
+
+        response = self.upload("handbook.pdf", pages=4, seed=1)
+        self.assertEqual(response.status_code, 202, response.content)
+        job = self.wait_for_job(response.json()["job_id"])
+        self.assertEqual(job["status"], "completed", job)
+
+    def reload_urls(self):
+        importlib.reload(rag_urls)
+        importlib.reload(project_urls)
+        clear_url_caches()
+
+    def query(self, path: str = "/api/query/", **body):
+        """POST through the async client; a streamed body is read in full"""
+
+        async def post():
+            response = await self.async_client.post(
+                path, body, content_type="application/json"
+            )
+            if response.streaming:
+                content = b"".join([part async for part in response.streaming_content])
+                response.streaming_content = [content]
+            return response
+
+        return async_to_sync(post)()
+
+    def test_async_views_are_routed(self):
+        self.assertIs(resolve("/api/query/").func, views.query_endpoint_async)
+        self.assertIs(resolve("/api/query/stream/").func, views.query_stream_async)
+        self.assertIs(resolve("/api/query/batch/").func, views.query_batch_async)
+        self.assertIs(resolve("/api/upload/").func, views.upload_document_async)
+
+    def test_query_cites_the_uploaded_document(self):
+        response = self.query(query="lorem ipsum dolor", cache=False)
+
+        self.assertEqual(response.status_code, 200, response.content)
+        result = response.json()
+        self.assertTrue(result["answer"])
+        self.assertEqual({s["document_name"] for s in result["sources"]}, {"handbook.pdf"})
+        self.assertEqual(self.query(query="x", mode="fuzzy").status_code, 400)
+
+    def test_stream_sends_sources_then_tokens_then_the_answer(self):
+        response = self.query("/api/query/stream/", query="lorem ipsum dolor", cache=False)
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = sse_events(response)
+        names = [name for name, _ in events]
+        self.assertEqual(names[0], "sources")
+        self.assertEqual(names[-1], "done")
+        self.assertEqual(set(names[1:-1]), {"token"})
+        answer = "".join(data["text"] for name, data in events if name == "token")
+        self.assertEqual(events[-1][1]["answer"], answer)
+
+    def test_batch_streams_an_answer_per_question_then_stats(self):
+        queries = ["lorem ipsum", "dolor sit amet", "lorem ipsum"]
+        response = self.query("/api/query/batch/", queries=queries, cache=False)
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual([line["event"] for line in lines], ["answer"] * 3 + ["stats"])
+        self.assertEqual(
+            sorted((line["data"]["index"], line["data"]["query"]) for line in lines[:-1]),
+            list(enumerate(queries)),
+        )
+        self.assertEqual(lines[-1]["data"]["unique_questions"], 2)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_render_is_prometheus_text(self):
+        metrics = tracing.Metrics()
+        for seconds in (0.003, 0.004, 20.0):
+            metrics.observe("embed_query", seconds)
+        metrics.count("rag_queries_total", cache="hit")
+        metrics.count("rag_queries_total", 2, cache="miss")
+
+        lines = metrics.render({"rag_ingestion_pending": 1}).splitlines()
+
+        self.assertIn("# TYPE rag_stage_duration_seconds histogram", lines)
+        bucket = 'rag_stage_duration_seconds_bucket{stage="embed_query",le="%s"} %d'
+        self.assertIn(bucket % ("0.0025", 0), lines)
+        self.assertIn(bucket % ("0.005", 2), lines)
+        self.assertIn(bucket % ("10.0", 2), lines)
+        self.assertIn(bucket % ("+Inf", 3), lines)
+        self.assertIn('rag_stage_duration_seconds_count{stage="embed_query"} 3', lines)
+        self.assertIn('rag_queries_total{cache="hit"} 1', lines)
+        self.assertIn('rag_queries_total{cache="miss"} 2', lines)
+        self.assertEqual(lines.count("# TYPE rag_queries_total counter"), 1)
+        self.assertEqual(
+            lines[-2:], ["# TYPE rag_ingestion_pending gauge", "rag_ingestion_pending 1"]
+        )
+
+    @override_settings(RAG_METRICS=False)
+    def test_spans_only_time_when_metrics_are_on_or_a_trace_is_collected(self):
+        tracing.metrics.reset()
+        with tracing.span("vector_search"):
+            pass
+        self.assertEqual(tracing.metrics.stages, {})
+
+        with tracing.collect() as trace:
+            with tracing.span("vector_search"):
+                pass
+            with tracing.span("vector_search"):
+                pass
+        self.assertEqual(list(trace), ["vector_search"])
+        self.assertEqual(tracing.metrics.stages, {})
+
+
+class TraceTests(FakeModelsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index("handbook.pdf", seed=1)
+        tracing.metrics.reset()
+
+    def test_stage_breakdown_is_opt_in(self):
+        plain = self.query(query="lorem ipsum dolor", cache=False).json()
+        traced = self.query(query="lorem ipsum dolor", cache=False, trace=True).json()
+
+        self.assertNotIn("trace", plain)
+        stages = {"embed_query", "vector_search", "prompt_assembly"}
+        self.assertTrue(stages <= set(traced["trace"]), traced["trace"])
+        self.assertEqual(self.query(query="x", trace="yes").status_code, 400)
+
+    def test_metrics_endpoint_counts_queries(self):
+        self.query(query="lorem ipsum dolor", cache=False)
+
+        response = self.client.get("/api/metrics/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        lines = response.content.decode().splitlines()
+        self.assertIn('rag_queries_total{cache="miss"} 1', lines)
+        self.assertIn('rag_stage_duration_seconds_count{stage="query"} 1', lines)
+        self.assertIn("rag_ingestion_pending 0", lines)
+
+
+class BenchmarkTests(SimpleTestCase):
+    def test_compare_reports_only_regressions_past_the_threshold(self):
+        baseline = {"ingest": {"pages_per_sec": 100.0}, "query": {"p95_ms": 50.0, "count": 10}}
+        current = {"ingest": {"pages_per_sec": 80.0}, "query": {"p95_ms": 55.0, "count": 99}}
+
+        regressions = compare(current, baseline, threshold=0.15)
+        self.assertEqual([r["metric"] for r in regressions], ["ingest.pages_per_sec"])
+        self.assertEqual(regressions[0]["change"], -0.2)
+
+    def test_command_writes_results_and_fails_on_a_regression(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "result.json")
+            args = ["end_to_end", "--pages", "2", "--queries", "4", "--concurrency", "2"]
+            call_command("benchmark", *args, "--output", output, stdout=io.StringIO())
+            with open(output) as f:
+                result = json.load(f)
+            self.assertEqual(set(result["ingest"]), {"2_pages"})
+
+            # A baseline ten times faster than this run
+            baseline = os.path.join(directory, "baseline.json")
+            result["ingest"]["2_pages"]["pages_per_sec"] *= 10
+            with open(baseline, "w") as f:
+                json.dump(result, f)
+            with self.assertRaises(CommandError):
+                call_command(
+                    "benchmark",
+                    *args,
+                    "--baseline",
+                    baseline,
+                    stdout=io.StringIO(),
+                    stderr=io.StringIO(),
+                )
+
+
+class ChunkStoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.store = ChunkStore(directory)
+        text = " ".join(f"déjà{i}" for i in range(40))
+        # Chunks overlapping by 40 characters, then one that doesn't continue them
+        self.chunks = [
+            Document(page_content=text[0:120], metadata={"chunk_id": 0, "page": 0}),
+            Document(page_content=text[80:200], metadata={"chunk_id": 1, "page": 1}),
+            Document(page_content="A separate section.", metadata={"chunk_id": 2, "page": 2}),
+        ]
+        self.text = text[:200]
+
+    def test_overlapping_chunks_are_stored_once(self):
+        self.store.write("doc", self.chunks)
+
+        for chunk in self.chunks:
+            stored = self.store.get("doc", chunk.metadata["chunk_id"])
+            self.assertEqual(stored["text"], chunk.page_content)
+            self.assertEqual(stored["page"], chunk.metadata["page"])
+        window = self.store.get("doc", 1, context=1)
+        self.assertEqual(window["text"], self.text + "\n" + "A separate section.")
+        self.assertEqual(
+            window["text"][window["chunk_start"] : window["chunk_end"]],
+            self.chunks[1].page_content,
+        )
+        self.assertEqual((window["first_chunk_id"], window["last_chunk_id"]), (0, 2))
+
+    def test_missing_chunks_and_rewrites(self):
+        self.assertIsNone(self.store.get("doc", 0))
+        self.store.write("doc", self.chunks)
+        self.assertIsNone(self.store.get("doc", 3))
+
+        self.store.write("doc", self.chunks[2:])
+        self.assertIsNone(self.store.get("doc", 0))
+        self.assertEqual(self.store.get("doc", 2)["text"], "A separate section.")
+
+    def test_failed_write_keeps_the_previous_file(self):
+        self.store.write("doc", self.chunks)
+        with self.assertRaises(RuntimeError), self.store.writer("doc") as writer:
+            writer.add(self.chunks[2:])
+            raise RuntimeError("embedding failed")
+
+        self.assertEqual(self.store.get("doc", 0)["text"], self.chunks[0].page_content)
+        self.assertEqual(os.listdir(self.store.directory), ["doc.chunks"])
+
+
+class ChunkTextEndpointTests(FakeModelsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.document = self.index("manual.pdf", pages=3, seed=2)
+        self.chunks = PDFProcessor().process_pdf(self.document.file_path)["chunks"]
+
+    def get(self, chunk_id, **params):
+        return self.client.get(f"/api/documents/{self.document.id}/chunks/{chunk_id}/", params)
+
+    def test_chunk_with_its_neighbours(self):
+        result = self.get(1, context=1).json()
+
+        self.assertEqual(result["document_name"], "manual.pdf")
+        self.assertEqual((result["first_chunk_id"], result["last_chunk_id"]), (0, 2))
+        self.assertEqual(
+            result["text"][result["chunk_start"] : result["chunk_end"]],
+            self.chunks[1].page_content,
+        )
+        for chunk in self.chunks[:3]:
+            self.assertIn(chunk.page_content, result["text"])
+
+    def test_documents_without_a_stored_file_fall_back_to_chroma(self):
+        stored = self.get(1).json()
+        ChromaDBService().chunk_store.delete(self.document.id)
+
+        fallback = self.get(1).json()
+
+        self.assertEqual(fallback["text"], stored["text"])
+        self.assertEqual(fallback["page"], stored["page"])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.get(1, context=views.MAX_CITATION_CONTEXT + 1).status_code, 400)
+        self.assertEqual(self.get(1, context="all").status_code, 400)
+        self.assertEqual(self.get(len(self.chunks)).status_code, 404)
+        response = self.client.get(f"/api/documents/{uuid.uuid4()}/chunks/0/")
+        self.assertEqual(response.status_code, 404)
+
+
+class CompactCollectionTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.vectors = np.eye(8, dtype=np.float32)
+
+    def open(self, **kwargs):
+        collection = CompactCollection(self.directory, **kwargs)
+        self.addCleanup(collection.close)
+        return collection
+
+    def upsert(self, collection, rows, **kwargs):
+        collection.upsert(
+            ids=[f"v{row}" for row in rows],
+            embeddings=self.vectors[rows],
+            documents=[f"doc {row}" for row in rows],
+            metadatas=[{"group": row % 2} for row in rows],
+            **kwargs,
+        )
+
+    def nearest(self, collection, row, k=1, where=None):
+        hits = collection.search(self.vectors[row], k, where)
+        return [segment.ids[i] for segment, i, _ in hits]
+
+    def test_upsert_and_search(self):
+        collection = self.open()
+        self.upsert(collection, list(range(8)))
+
+        self.assertEqual(collection.count(), 8)
+        self.assertEqual(self.nearest(collection, 3), ["v3"])
+        self.assertEqual(
+            set(self.nearest(collection, 3, k=8, where={"group": 0})), {"v0", "v2", "v4", "v6"}
+        )
+
+    def test_upsert_replaces_an_existing_id(self):
+        collection = self.open()
+        self.upsert(collection, [0, 1])
+        collection.upsert(ids=["v0"], embeddings=self.vectors[[5]], documents=["moved"])
+
+        self.assertEqual(collection.count(), 2)
+        self.assertEqual(collection.get(ids=["v0"])["documents"], ["moved"])
+        self.assertEqual(self.nearest(collection, 5), ["v0"])
+
+    def test_delete_by_id_and_filter(self):
+        collection = self.open()
+        self.upsert(collection, list(range(8)))
+        collection.delete(ids=["v0"])
+        collection.delete(where={"group": 1})
+
+        self.assertEqual(sorted(collection.get()["ids"]), ["v2", "v4", "v6"])
+
+    def test_merge_drops_deleted_rows(self):
+        collection = self.open(max_segments=100)
+        for row in range(4):
+            self.upsert(collection, [row])
+        collection.delete(ids=["v1"])
+        collection.merge(list(collection._segments))
+
+        self.assertEqual(len(collection._segments), 1)
+        self.assertEqual(len(collection._segments[0]), 3)
+        self.assertEqual(sorted(collection.get()["ids"]), ["v0", "v2", "v3"])
+        self.assertEqual(self.nearest(collection, 3), ["v3"])
+
+    def test_other_instances_reload_writes(self):
+        writer, reader = self.open(), self.open()
+        self.upsert(writer, [0, 1, 2])
+        self.assertEqual(reader.count(), 3)
+
+        writer.delete(ids=["v1"])
+        writer.merge(list(writer._segments))
+        self.upsert(reader, [3])
+        self.assertEqual(sorted(writer.get()["ids"]), ["v0", "v2", "v3"])
+        self.assertEqual(sorted(reader.get()["ids"]), ["v0", "v2", "v3"])
+
+        reader.reset()
+        self.assertEqual(writer.count(), 0)
+        self.assertEqual(self.open().count(), 0)
+
+
+class MMRTests(SimpleTestCase):
+    def test_matches_the_langchain_implementation(self):
+        rng = np.random.default_rng(22)
+        vectors = rng.normal(size=(60, 16))
+        for lambda_mult, k in ((0.5, 5), (0.2, 10), (0.9, 20)):
+            with self.subTest(lambda_mult=lambda_mult, k=k):
+                query = rng.normal(size=16)
+                self.assertEqual(
+                    maximal_marginal_relevance(query, vectors, k, lambda_mult),
+                    langchain_mmr(query, vectors.tolist(), lambda_mult=lambda_mult, k=k),
+                )
+
+    def test_edge_cases(self):
+        vectors = np.eye(3)
+        query = np.array([0.9, 0.5, 0.1])
+        self.assertEqual(maximal_marginal_relevance(query, np.empty((0, 3)), 2), [])
+        self.assertEqual(maximal_marginal_relevance(query, vectors, 0), [])
+        self.assertEqual(sorted(maximal_marginal_relevance(query, vectors, 10)), [0, 1, 2])
+        # Relevance alone when diversity has no weight
+        self.assertEqual(maximal_marginal_relevance(query, vectors, 3, lambda_mult=1), [0, 1, 2])
+
+    @override_settings(RAG_MMR_MAX_FETCH_K=50)
+    def test_params_are_validated(self):
+        self.assertIsNone(MMRParams.from_dict({}))
+        params = MMRParams.from_dict({"k": 4, "fetch_k": 50, "lambda_mult": 1})
+        self.assertEqual(params, MMRParams(k=4, fetch_k=50, lambda_mult=1.0))
+        self.assertIsInstance(params.lambda_mult, float)
+        self.assertEqual(MMRParams.from_dict({"k": 4}).scope(), {"k": 4})
+        for data in (
+            {"k": 0},
+            {"k": True},
+            {"k": 51},
+            {"k": 8, "fetch_k": 4},
+            {"lambda_mult": 1.5},
+            {"lambda_mult": "0.5"},
+        ):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                MMRParams.from_dict(data)
+
+
+class PageTextCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.cache = PageTextCache(os.path.join(self.directory, "text"))
+        self.path = write_pdf(os.path.join(self.directory, "manual.pdf"), 4, seed=8)
+        self.file_hash = file_fingerprint(self.path)[0]
+
+    def test_pages_read_back_as_the_loader_yields_them(self):
+        pages = list(_load_pdf_pages(self.path))
+        self.cache.write(self.file_hash, pages)
+
+        self.assertEqual(self.cache.page_count(self.file_hash), 4)
+        cached = list(self.cache.pages(self.file_hash, self.path))
+        self.assertEqual(
+            [(p.page_content, p.metadata) for p in cached],
+            [(p.page_content, p.metadata) for p in pages],
+        )
+        middle = list(self.cache.pages(self.file_hash, "/moved/manual.pdf", 1, 3))
+        self.assertEqual([p.page_content for p in middle], [p.page_content for p in pages[1:3]])
+        self.assertEqual([p.metadata["page"] for p in middle], [1, 2])
+        self.assertEqual({p.metadata["source"] for p in middle}, {"/moved/manual.pdf"})
+
+    def test_processor_parses_each_file_once(self):
+        with override_settings(RAG_TEXT_CACHE_DIR=self.cache.directory):
+            processor = PDFProcessor()
+        first = processor.process_pdf(self.path)["chunks"]
+        self.assertTrue(processor.is_cached(self.file_hash))
+
+        with mock.patch("rag.services.pdf._load_pdf_pages") as load:
+            second = processor.process_pdf(self.path, file_hash=self.file_hash)["chunks"]
+        load.assert_not_called()
+        self.assertEqual(
+            [(c.page_content, c.metadata) for c in second],
+            [(c.page_content, c.metadata) for c in first],
+        )
+
+    def test_partly_read_files_are_not_cached_and_prune_keeps_the_listed_ones(self):
+        with override_settings(RAG_TEXT_CACHE_DIR=self.cache.directory):
+            processor = PDFProcessor()
+        next(processor.load_pages(self.path, self.file_hash))
+        self.assertFalse(self.cache.has(self.file_hash))
+
+        self.cache.write(self.file_hash, _load_pdf_pages(self.path))
+        self.cache.write("0" * 64, _load_pdf_pages(self.path))
+        self.assertEqual(self.cache.prune([self.file_hash, None]), 1)
+        self.assertEqual(os.listdir(self.cache.directory), [f"{self.file_hash}.pages"])
+
+
+class RechunkTests(FakeModelsMixin, TestCase):
+    def test_resplits_cached_text_and_parses_the_rest(self):
+        with override_settings(RAG_TEXT_CACHE_DIR=os.path.join(self.directory, "text")):
+            manual = self.index("manual.pdf", pages=4, seed=4)
+            notes = self.index("notes.pdf", pages=2, seed=5)
+            # notes.pdf was indexed before the cache existed
+            text_cache = PDFProcessor().text_cache
+            os.remove(text_cache.path(notes.file_hash))
+
+            with mock.patch("rag.services.pdf._load_pdf_pages", wraps=_load_pdf_pages) as load:
+                result = ChromaDBService().rechunk(chunk_size=300, chunk_overlap=0)
+
+        self.assertEqual(
+            result["details"], {"cached": ["manual.pdf"], "parsed": ["notes.pdf"], "failed": []}
+        )
+        self.assertEqual([c.args[0] for c in load.call_args_list], [notes.file_path])
+        self.assertTrue(text_cache.has(notes.file_hash))
+        chunk_count = manual.chunk_count
+        for document in (manual, notes):
+            document.refresh_from_db()
+            self.assertEqual(self.indexed_ids(document), set(document.chunk_ids))
+            self.assertEqual(document.chunk_count, len(document.chunk_ids))
+        self.assertGreater(manual.chunk_count, chunk_count)
+        self.assertLessEqual(len(ChromaDBService().chunk_text(manual, 0)["text"]), 300)
+
+    def test_failed_document_keeps_its_old_chunks(self):
+        document = self.index("manual.pdf", seed=4)
+        old_ids = self.indexed_ids(document)
+
+        with mock.patch(
+            "rag.services.embedding.EmbeddingService.embed_documents",
+            side_effect=RuntimeError("GPU gone"),
+        ), self.assertLogs("rag.services.chroma_db", "ERROR"):
+            result = ChromaDBService().rechunk(chunk_size=300, chunk_overlap=0)
+
+        self.assertEqual(result["failed"], 1)
+        document.refresh_from_db()
+        self.assertTrue(document.indexed)
+        self.assertEqual(set(document.chunk_ids), old_ids)
+        self.assertEqual(self.indexed_ids(document), old_ids)
+
+
+@override_settings(RAG_UPLOAD_PART_SIZE=4096)
+class ChunkedUploadTests(FakeModelsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        with open(self.write_pdf("large.pdf", pages=4, seed=2), "rb") as f:
+            self.data = f.read()
+
+    def start(self, **body):
+        body = {"name": "large.pdf", "size": len(self.data), **body}
+        return self.client.post("/api/uploads/", body, content_type="application/json")
+
+    def put_part(self, upload, index, data=None):
+        if data is None:
+            size = upload["part_size"]
+            data = self.data[index * size : (index + 1) * size]
+        return self.client.put(
+            f"/api/uploads/{upload['id']}/parts/{index}/",
+            data,
+            content_type="application/octet-stream",
+        )
+
+    def complete(self, upload):
+        return self.client.post(f"/api/uploads/{upload['id']}/complete/")
+
+    def test_start_validates_name_and_size(self):
+        self.assertEqual(self.start(name="notes.txt").status_code, 400)
+        self.assertEqual(self.start(size=0).status_code, 400)
+        self.assertEqual(self.start(size="12").status_code, 400)
+
+    def test_parts_must_have_the_expected_index_and_size(self):
+        upload = self.start().json()
+
+        self.assertEqual(self.put_part(upload, upload["part_count"]).status_code, 400)
+        self.assertEqual(self.put_part(upload, 0, b"short").status_code, 400)
+        self.assertEqual(self.client.get(f"/api/uploads/{upload['id']}/").json()["received"], [])
+
+    def test_complete_needs_every_part(self):
+        upload = self.start().json()
+        self.put_part(upload, 0)
+
+        response = self.complete(upload)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["missing"], list(range(1, upload["part_count"])))
+
+    def test_parts_in_any_order_assemble_the_file(self):
+        upload = self.start().json()
+        self.assertGreater(upload["part_count"], 2)
+        for index in reversed(range(upload["part_count"])):
+            self.assertEqual(self.put_part(upload, index).status_code, 200)
+
+        response = self.complete(upload)
+        self.assertEqual(response.status_code, 202, response.content)
+        result = response.json()
+        self.assertEqual(result["sha256"], hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(self.wait_for_job(result["job_id"])["status"], "completed")
+        with open(DocumentModel.objects.get(pk=result["id"]).file_path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_completing_twice_returns_the_same_document(self):
+        upload = self.start().json()
+        for index in range(upload["part_count"]):
+            self.put_part(upload, index)
+        first = self.complete(upload).json()
+        self.wait_for_job(first["job_id"])
+
+        second = self.complete(upload)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()["id"], first["id"])
+        self.assertEqual(second.json()["job_id"], first["job_id"])
+        self.assertEqual(DocumentModel.objects.count(), 1)
+        self.assertEqual(self.put_part(upload, 0).status_code, 409)
+
+    def test_same_bytes_sent_while_the_first_copy_is_ingesting_are_a_duplicate(self):
+        started, release = threading.Event(), threading.Event()
+        process = IngestionPipeline.process
+
+        def gated_process(pipeline, job):
+            started.set()
+            release.wait(10)
+            return process(pipeline, job)
+
+        def upload(name):
+            file = SimpleUploadedFile(name, self.data, content_type="application/pdf")
+            return self.client.post("/api/upload/", {"file": file})
+
+        # The hash taken while writing the upload is reused, never recomputed
+        with mock.patch.object(IngestionPipeline, "process", gated_process), mock.patch(
+            "rag.services.ingestion.file_fingerprint", side_effect=AssertionError("hashed again")
+        ):
+            first = upload("large.pdf").json()
+            self.assertTrue(started.wait(10))
+            second = upload("copy.pdf")
+            release.set()
+            job = self.wait_for_job(first["job_id"])
+
+        self.assertEqual(job["status"], "completed", job["error"])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(
+            {key: second.json()[key] for key in ("id", "job_id", "duplicate")},
+            {"id": first["id"], "job_id": first["job_id"], "duplicate": True},
+        )
+        document = DocumentModel.objects.get(pk=first["id"])
+        self.assertEqual(document.file_hash, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(DocumentModel.objects.count(), 1)
+
+
+class QueryBatchTests(FakeModelsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index("handbook.pdf", pages=4, seed=1)
+
+    def batch(self, **body):
+        response = self.query("/api/query/batch/", **body)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        return [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+    def test_cached_answers_come_first_and_repeats_are_answered_once(self):
+        self.query(query="lorem ipsum")
+        queries = ["dolor sit amet", "lorem ipsum", " dolor  sit amet", "consectetur"]
+
+        lines = self.batch(queries=queries, concurrency=2)
+
+        self.assertEqual([line["event"] for line in lines], ["answer"] * 4 + ["stats"])
+        self.assertEqual(lines[0]["data"]["index"], 1)
+        self.assertEqual(lines[0]["data"]["cache"], "hit")
+        answers = {line["data"]["index"]: line["data"] for line in lines[:-1]}
+        self.assertEqual(
+            {i: answer["query"] for i, answer in answers.items()}, dict(enumerate(queries))
+        )
+        self.assertEqual(answers[0]["answer"], answers[2]["answer"])
+        stats = lines[-1]["data"]
+        self.assertEqual((stats["questions"], stats["unique_questions"]), (4, 3))
+        self.assertEqual((stats["answered"], stats["failed"], stats["cache_hits"]), (4, 0, 1))
+
+    def test_a_failed_generation_only_fails_its_questions(self):
+        stream = FakeLLM._stream
+
+        def failing_stream(llm, prompt, *args, **kwargs):
+            if "broken question" in prompt:
+                raise RuntimeError("generation failed")
+            return stream(llm, prompt, *args, **kwargs)
+
+        with mock.patch.object(FakeLLM, "_stream", failing_stream):
+            lines = self.batch(queries=["lorem ipsum", "broken question", "broken question"])
+
+        events = {line["data"]["index"]: line for line in lines[:-1]}
+        self.assertEqual(events[0]["event"], "answer")
+        for index in (1, 2):
+            self.assertEqual(events[index]["event"], "error")
+            self.assertEqual(events[index]["data"]["query"], "broken question")
+            self.assertIn("generation failed", events[index]["data"]["error"])
+        self.assertEqual((lines[-1]["data"]["answered"], lines[-1]["data"]["failed"]), (1, 2))
+
+    @override_settings(RAG_BATCH_MAX_QUERIES=2)
+    def test_invalid_batches_are_rejected(self):
+        for body in (
+            {},
+            {"queries": []},
+            {"queries": "lorem ipsum"},
+            {"queries": ["lorem", " "]},
+            {"queries": ["a", "b", "c"]},
+            {"queries": ["a"], "concurrency": 0},
+            {"queries": ["a"], "mode": "fuzzy"},
+        ):
+            with self.subTest(body=body):
+                self.assertEqual(self.query("/api/query/batch/", **body).status_code, 400)
@@ -1,8 +1,45 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# ASGI deployments serve queries and uploads from the async views, so a slow
+# generation doesn't hold a worker thread
+if getattr(settings, "RAG_ASYNC_VIEWS", False):
+    query_view = views.query_endpoint_async
+    query_stream_view = views.query_stream_async
+    query_batch_view = views.query_batch_async
+    upload_view = views.upload_document_async
+else:
+    query_view = views.query_endpoint
+    query_stream_view = views.query_stream
+    query_batch_view = views.query_batch
+    upload_view = views.upload_document
+
 urlpatterns = [
-    path("query/", views.query_endpoint, name="query"),
-    path("upload/", views.upload_document, name="upload_document"),
+    path("query/", query_view, name="query"),
+    path("query/stream/", query_stream_view, name="query_stream"),
+    path("query/batch/", query_batch_view, name="query_batch"),
+    path("llm/status/", views.llm_status, name="llm_status"),
+    path("metrics/", views.metrics, name="metrics"),
+    path("upload/", upload_view, name="upload_document"),
+    path("uploads/", views.start_upload, name="start_upload"),
+    path("uploads/<uuid:upload_id>/", views.upload_status, name="upload_status"),
+    path(
+        "uploads/<uuid:upload_id>/parts/<int:index>/",
+        views.upload_part,
+        name="upload_part",
+    ),
+    path(
+        "uploads/<uuid:upload_id>/complete/",
+        views.complete_upload,
+        name="complete_upload",
+    ),
+    path("collections/", views.list_collections, name="list_collections"),
+    path(
+        "documents/<uuid:document_id>/chunks/<int:chunk_id>/",
+        views.chunk_text,
+        name="chunk_text",
+    ),
+    path("jobs/<uuid:job_id>/", views.job_status, name="job_status"),
     path("rebuild-index/", views.rebuild_index, name="rebuild_index"),
 ]
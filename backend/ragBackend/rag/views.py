@@ -1,15 +1,112 @@
 import os
+import asyncio
 import json
+from typing import Any, Dict, Tuple
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import JsonResponse
+from django.db.models import Count, Sum
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from .services.rag import RAGService
-from .services.pdf import PDFProcessor
-from .models import Document
+from .services import tracing
+from .services.aio import IO, RETRIEVAL, run_blocking
+from .services.rag import RETRIEVAL_MODES, RAGService
+from .services.chroma_db import ChromaDBService, documents_dir
+from .services.filters import RetrievalFilter
+from .services.ingestion import IngestionQueueFull, get_pipeline
+from .services.llm import LLMQueueFull
+from .services.mmr import MMRParams
+from .services.registry import DEFAULT_COLLECTION, get_registry, validate_collection
+from .services.uploads import (
+    BLOCK_SIZE,
+    active_job,
+    discard_file,
+    discard_parts,
+    expire_sessions,
+    find_duplicate,
+    iter_parts,
+    received_parts,
+    stage_file,
+    write_part,
+)
+from .models import Document, IngestionJob, UploadSession
+
+
+# Neighbouring chunks a citation can be widened by, on each side
+MAX_CITATION_CONTEXT = 5
+
+# UploadSession.file_hash while one request assembles the parts
+ASSEMBLING = "assembling"
+
+
+def _query_options(data):
+    """Validate the optional query parameters; returns (kwargs, error message)"""
+    mode = data.get("mode")
+    if mode is not None and mode not in RETRIEVAL_MODES:
+        return None, f"mode must be one of: {', '.join(RETRIEVAL_MODES)}"
+
+    context_tokens = data.get("context_tokens")
+    if context_tokens is not None:
+        try:
+            context_tokens = int(context_tokens)
+        except (TypeError, ValueError):
+            context_tokens = 0
+        if context_tokens <= 0:
+            return None, "context_tokens must be a positive integer"
+
+    rerank = data.get("rerank")
+    if rerank is not None and not isinstance(rerank, bool):
+        return None, "rerank must be a boolean"
+
+    trace = data.get("trace", False)
+    if not isinstance(trace, bool):
+        return None, "trace must be a boolean"
+
+    use_cache = data.get("cache", True)
+    if not isinstance(use_cache, bool):
+        return None, "cache must be a boolean"
+
+    collections = data.get("collections")
+    if isinstance(collections, str):
+        collections = [collections]
+    if collections is not None:
+        if not isinstance(collections, list) or not collections:
+            return None, "collections must be a non-empty list of collection names"
+        try:
+            collections = [validate_collection(name) for name in collections]
+        except ValueError as e:
+            return None, str(e)
+
+    try:
+        filters = RetrievalFilter.from_dict(data.get("filters"))
+        mmr = MMRParams.from_dict(data)
+    except ValueError as e:
+        return None, str(e)
+
+    return {
+        "use_cache": use_cache,
+        "mode": mode,
+        "context_tokens": context_tokens,
+        "rerank": rerank,
+        "trace": trace,
+        "collections": collections,
+        "filters": filters,
+        "mmr": mmr,
+    }, None
+
+
+def _busy(e: LLMQueueFull, response_class=Response):
+    """429 telling the client when to retry"""
+    response = response_class(
+        {"error": str(e), "retry_after": e.retry_after},
+        status=status.HTTP_429_TOO_MANY_REQUESTS,
+    )
+    response["Retry-After"] = str(e.retry_after)
+    return response
 
 
 @api_view(["POST"])
@@ -23,10 +120,16 @@ def query_endpoint(request):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        options, error = _query_options(request.data)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
         # Process the query
         rag_service = RAGService()
-        result = rag_service.query(query)
+        result = rag_service.query(query, **options)
         return Response(result)
+    except LLMQueueFull as e:
+        return _busy(e)
     except Exception as e:
         import traceback
 
@@ -36,68 +139,413 @@ def query_endpoint(request):
         )
 
 
-@api_view(["POST"])
-def upload_document(request):
-    """Upload and process a document"""
+def _json_query_request(request):
+    """Parse a JSON query request outside DRF; returns (query, options, error response)"""
     try:
-        if "file" not in request.FILES:
-            return Response(
-                {"error": "No file provided"}, status=status.HTTP_400_BAD_REQUEST
+        payload = json.loads(request.body or b"{}")
+    except ValueError:
+        payload = {}
+    query = payload.get("query")
+    if not query:
+        return None, None, JsonResponse(
+            {"error": "Query parameter is required"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    options, error = _query_options(payload)
+    if error:
+        return None, None, JsonResponse({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+    return query, options, None
+
+
+@csrf_exempt
+@require_POST
+async def query_endpoint_async(request):
+    """Async ``query_endpoint``: waits for the LLM without holding a worker thread"""
+    query, options, error_response = _json_query_request(request)
+    if error_response:
+        return error_response
+
+    try:
+        # First use loads the model: keep that off the event loop
+        await run_blocking(RETRIEVAL, get_registry().get_scheduler)
+        result = await RAGService().aquery(query, **options)
+        return JsonResponse(result)
+    except LLMQueueFull as e:
+        return _busy(e, JsonResponse)
+    except Exception as e:
+        import traceback
+
+        return JsonResponse(
+            {"error": str(e), "traceback": traceback.format_exc()},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+def _sse_event(event: str, data) -> str:
+    """Encode one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def _sse_response(event_stream) -> StreamingHttpResponse:
+    response = StreamingHttpResponse(event_stream, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop reverse proxies (nginx) from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@csrf_exempt
+@require_POST
+def query_stream(request):
+    """Process a query, streaming sources and LLM tokens as Server-Sent Events"""
+    # Plain Django view: DRF content negotiation would reject Accept: text/event-stream
+    query, options, error_response = _json_query_request(request)
+    if error_response:
+        return error_response
+
+    # Reject before the stream starts; once it has, a full queue is an error event
+    try:
+        get_registry().get_scheduler().check_capacity()
+    except LLMQueueFull as e:
+        return _busy(e, JsonResponse)
+
+    def event_stream():
+        events = None
+        try:
+            rag_service = RAGService()
+            events = rag_service.stream_query(query, **options)
+            for item in events:
+                yield _sse_event(item["event"], item["data"])
+        except LLMQueueFull as e:
+            yield _sse_event("error", {"error": str(e), "retry_after": e.retry_after})
+        except Exception as e:
+            import traceback
+
+            yield _sse_event(
+                "error", {"error": str(e), "traceback": traceback.format_exc()}
             )
+        finally:
+            # The server closes this generator when the client disconnects:
+            # pass that on so the generation is cancelled
+            if events is not None:
+                events.close()
 
-        uploaded_file = request.FILES["file"]
-        file_name = uploaded_file.name
+    return _sse_response(event_stream())
 
-        # Ensure the file is a PDF
-        if not file_name.lower().endswith(".pdf"):
-            return Response(
-                {"error": "Only PDF files are supported"},
-                status=status.HTTP_400_BAD_REQUEST,
+
+@csrf_exempt
+@require_POST
+async def query_stream_async(request):
+    """Async ``query_stream``: tokens are relayed without holding a worker thread"""
+    query, options, error_response = _json_query_request(request)
+    if error_response:
+        return error_response
+
+    try:
+        # First use loads the model: keep that off the event loop
+        scheduler = await run_blocking(RETRIEVAL, get_registry().get_scheduler)
+        scheduler.check_capacity()
+    except LLMQueueFull as e:
+        return _busy(e, JsonResponse)
+
+    async def event_stream():
+        try:
+            async for item in RAGService().astream_query(query, **options):
+                yield _sse_event(item["event"], item["data"])
+        except LLMQueueFull as e:
+            yield _sse_event("error", {"error": str(e), "retry_after": e.retry_after})
+        except Exception as e:
+            import traceback
+
+            yield _sse_event(
+                "error", {"error": str(e), "traceback": traceback.format_exc()}
             )
 
-        # Save file to documents directory
-        documents_dir = os.path.join(settings.MEDIA_ROOT, "documents")
-        os.makedirs(documents_dir, exist_ok=True)
+    return _sse_response(event_stream())
 
-        file_path = os.path.join(documents_dir, file_name)
 
-        with open(file_path, "wb+") as destination:
-            for chunk in uploaded_file.chunks():
-                destination.write(chunk)
+def _batch_request(request):
+    """Parse a batch query request; returns (queries, options, error response)"""
+    try:
+        payload = json.loads(request.body or b"{}")
+    except ValueError:
+        payload = {}
+    queries = payload.get("queries")
+    if (
+        not isinstance(queries, list)
+        or not queries
+        or not all(isinstance(query, str) and query.strip() for query in queries)
+    ):
+        return None, None, JsonResponse(
+            {"error": "queries must be a non-empty list of questions"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    limit = getattr(settings, "RAG_BATCH_MAX_QUERIES", 500)
+    if len(queries) > limit:
+        return None, None, JsonResponse(
+            {"error": f"At most {limit} queries per batch"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
 
-        # Process the document
-        processor = PDFProcessor()
-        rag_service = RAGService()
+    options, error = _query_options(payload)
+    concurrency = payload.get("concurrency")
+    if not error and concurrency is not None:
+        if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency <= 0:
+            error = "concurrency must be a positive integer"
+    if error:
+        return None, None, JsonResponse({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+    # Stage breakdowns are per request; the batch reports its own stats
+    options.pop("trace")
+    options["concurrency"] = concurrency
+    return queries, options, None
+
+
+def _ndjson_line(data) -> str:
+    return json.dumps(data, default=str) + "\n"
 
+
+def _ndjson_response(lines) -> StreamingHttpResponse:
+    response = StreamingHttpResponse(lines, content_type="application/x-ndjson")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@csrf_exempt
+@require_POST
+def query_batch(request):
+    """Answer a list of questions, streaming one NDJSON line per answer as it finishes
+
+    The last line holds the throughput stats of the batch.
+    """
+    queries, options, error_response = _batch_request(request)
+    if error_response:
+        return error_response
+
+    def lines():
+        events = None
         try:
-            result = processor.process_pdf(file_path)
-            chunks = result["chunks"]
+            events = RAGService().query_batch(queries, **options)
+            for item in events:
+                yield _ndjson_line(item)
+        except Exception as e:
+            import traceback
 
-            # Add to vector store
-            rag_service.add_documents(chunks)
+            yield _ndjson_line(
+                {"event": "error", "data": {"error": str(e), "traceback": traceback.format_exc()}}
+            )
+        finally:
+            # Cancels the queued generations when the client disconnects
+            if events is not None:
+                events.close()
 
-            # Save to database
-            document = Document.objects.create(
-                name=result["name"],
-                file_path=file_path,
-                file_type=result["file_type"],
-                chunk_count=len(chunks),
-                indexed=True,
+    return _ndjson_response(lines())
+
+
+@csrf_exempt
+@require_POST
+async def query_batch_async(request):
+    """Async ``query_batch``: answers are awaited without holding a worker thread"""
+    queries, options, error_response = _batch_request(request)
+    if error_response:
+        return error_response
+
+    async def lines():
+        try:
+            # First use loads the model: keep that off the event loop
+            await run_blocking(RETRIEVAL, get_registry().get_scheduler)
+            async for item in RAGService().aquery_batch(queries, **options):
+                yield _ndjson_line(item)
+        except Exception as e:
+            import traceback
+
+            yield _ndjson_line(
+                {"event": "error", "data": {"error": str(e), "traceback": traceback.format_exc()}}
             )
 
-            return Response(
-                {
-                    "id": document.id,
-                    "name": document.name,
-                    "chunk_count": document.chunk_count,
-                    "message": f"Successfully processed document with {len(chunks)} chunks.",
-                }
+    return _ndjson_response(lines())
+
+
+def _check_uploads(uploaded_files, collection: str) -> str:
+    """Validate uploaded files and their target collection; returns an error message, if any"""
+    if not uploaded_files:
+        return "No file provided"
+    # Ensure every file is a PDF
+    if any(not f.name.lower().endswith(".pdf") for f in uploaded_files):
+        return "Only PDF files are supported"
+    try:
+        validate_collection(collection)
+    except ValueError as e:
+        return str(e)
+    return ""
+
+
+def _upload_path(file_name: str, collection: str) -> str:
+    directory = documents_dir(collection)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, file_name)
+
+
+def _save_upload(uploaded_file, file_path: str) -> Tuple[str, str]:
+    """Write an upload next to ``file_path``, hashing it; returns (temporary path, SHA-256)"""
+    tmp_path, file_hash, _ = stage_file(uploaded_file.chunks(), file_path)
+    return tmp_path, file_hash
+
+
+def _duplicate(document: Document) -> Dict[str, Any]:
+    duplicate = {
+        "id": document.id,
+        "name": document.name,
+        "collection": document.collection,
+        "duplicate": True,
+    }
+    # Still being ingested: the client can follow the earlier upload's job
+    job = None if document.indexed else active_job(document)
+    if job is not None:
+        duplicate.update(job_id=job.id, status=job.status)
+    return duplicate
+
+
+def _finish_uploads(staged, collection: str):
+    """Publish staged (name, path, temporary path, hash) files and queue them
+
+    Files whose content the collection already has, indexed or being
+    indexed, are dropped rather than indexed again. Returns (payload, status).
+    """
+    saved, duplicates = [], []
+    for file_name, file_path, tmp_path, file_hash in staged:
+        duplicate = find_duplicate(file_hash, collection)
+        if duplicate is None:
+            saved.append((file_name, file_path, tmp_path, file_hash))
+        else:
+            discard_file(tmp_path)
+            duplicates.append(_duplicate(duplicate))
+
+    if not saved:
+        if len(duplicates) == 1:
+            message = (
+                "Document already queued for processing."
+                if "job_id" in duplicates[0]
+                else "Document already indexed."
             )
-        except Exception as e:
-            # Clean up the file if processing failed
+            return {**duplicates[0], "message": message}, status.HTTP_200_OK
+        return (
+            {"jobs": [], "duplicates": duplicates, "message": "Documents already indexed."},
+            status.HTTP_200_OK,
+        )
+    payload, code = _queue_uploads(saved, collection)
+    if duplicates:
+        payload["duplicates"] = duplicates
+    return payload, code
+
+
+def _queue_uploads(saved, collection: str):
+    """Publish staged (name, path, temporary path, hash) files and queue their ingestion
+
+    The hash computed while staging is stored on the document, so the job
+    doesn't read the file again to fingerprint it. A file replacing an
+    earlier upload keeps the previous version (file and row) until its
+    job is queued, and gets it back if the queue is full. Returns
+    (payload, status).
+    """
+    documents = {}
+    # file path -> (backup of the previous file or None, previous row fields or None)
+    previous = {}
+    try:
+        for file_name, file_path, tmp_path, file_hash in saved:
+            backup = None
             if os.path.exists(file_path):
-                os.remove(file_path)
-            raise e
+                backup = f"{tmp_path}.previous"
+                os.link(file_path, backup)
+            previous[file_path] = (
+                backup,
+                Document.objects.filter(file_path=file_path)
+                .values("name", "file_type", "indexed", "collection", "file_hash")
+                .first(),
+            )
+            os.replace(tmp_path, file_path)
+
+            # Save to database; it is flipped to indexed once the job completes.
+            # Re-uploading a file reuses its row so the job replaces its vectors.
+            documents[file_path], _ = Document.objects.update_or_create(
+                file_path=file_path,
+                defaults={
+                    "name": file_name,
+                    "file_type": "pdf",
+                    "indexed": False,
+                    "collection": collection,
+                    "file_hash": file_hash,
+                },
+            )
+
+        # Hand parsing, splitting, embedding and upserting to the worker pool;
+        # several files at once fan their parsing out over a process pool
+        pipeline = get_pipeline()
+        if len(documents) == 1:
+            jobs = [pipeline.submit(*documents.values())]
+        else:
+            jobs = pipeline.submit_bulk(list(documents.values()))
+    except BaseException as e:
+        for _, file_path, tmp_path, _ in saved:
+            discard_file(tmp_path)
+            if file_path not in previous:
+                continue
+            backup, row = previous[file_path]
+            if backup is not None:
+                os.replace(backup, file_path)
+            else:
+                discard_file(file_path)
+            if row is not None:
+                Document.objects.filter(file_path=file_path).update(**row)
+            elif file_path in documents:
+                documents[file_path].delete()
+        if isinstance(e, IngestionQueueFull):
+            return {"error": str(e)}, status.HTTP_503_SERVICE_UNAVAILABLE
+        raise
+
+    for backup, _ in previous.values():
+        if backup is not None:
+            discard_file(backup)
+
+    queued = [
+        {
+            "id": job.document.id,
+            "name": job.document.name,
+            "collection": job.document.collection,
+            "job_id": job.id,
+            "status": job.status,
+        }
+        for job in jobs
+    ]
+    if len(queued) == 1:
+        return (
+            {**queued[0], "message": "Document queued for processing."},
+            status.HTTP_202_ACCEPTED,
+        )
+    return (
+        {"jobs": queued, "message": f"{len(queued)} documents queued for processing."},
+        status.HTTP_202_ACCEPTED,
+    )
+
+
+@api_view(["POST"])
+def upload_document(request):
+    """Upload one or more documents and queue them for processing"""
+    try:
+        uploaded_files = request.FILES.getlist("file")
+        collection = request.data.get("collection") or DEFAULT_COLLECTION
+        error = _check_uploads(uploaded_files, collection)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Save files to the collection's documents directory
+        staged = []
+        for uploaded_file in uploaded_files:
+            file_path = _upload_path(uploaded_file.name, collection)
+            staged.append((uploaded_file.name, file_path, *_save_upload(uploaded_file, file_path)))
+
+        payload, code = _finish_uploads(staged, collection)
+        return Response(payload, status=code)
     except Exception as e:
         import traceback
 
@@ -107,55 +555,325 @@ def upload_document(request):
         )
 
 
+@csrf_exempt
+@require_POST
+async def upload_document_async(request):
+    """Async ``upload_document``: parsing, disk writes and the ORM stay off the event loop"""
+    try:
+        # Parsing the multipart body reads the spooled request from disk
+        uploaded_files = await run_blocking(IO, request.FILES.getlist, "file")
+        collection = request.POST.get("collection") or DEFAULT_COLLECTION
+        error = _check_uploads(uploaded_files, collection)
+        if error:
+            return JsonResponse({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Write every file in parallel on the I/O executor
+        paths = [_upload_path(f.name, collection) for f in uploaded_files]
+        written = await asyncio.gather(
+            *(
+                run_blocking(IO, _save_upload, uploaded_file, file_path)
+                for uploaded_file, file_path in zip(uploaded_files, paths)
+            )
+        )
+
+        staged = [
+            (f.name, file_path, *result)
+            for f, file_path, result in zip(uploaded_files, paths, written)
+        ]
+        payload, code = await sync_to_async(_finish_uploads)(staged, collection)
+        return JsonResponse(payload, status=code)
+    except Exception as e:
+        import traceback
+
+        return JsonResponse(
+            {"error": str(e), "traceback": traceback.format_exc()},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+def _upload_session(session: UploadSession) -> Dict[str, Any]:
+    return {
+        "id": session.id,
+        "name": session.name,
+        "collection": session.collection,
+        "size": session.size,
+        "part_size": session.part_size,
+        "part_count": session.part_count,
+        "received": received_parts(session),
+        "completed": session.document_id is not None,
+    }
+
+
 @api_view(["POST"])
-def rebuild_index(request):
-    """Rebuild the entire vector index from stored documents"""
+def start_upload(request):
+    """Start a resumable upload of one PDF, sent as parts of the returned ``part_size``"""
+    name = os.path.basename(str(request.data.get("name") or "").replace("\\", "/"))
+    collection = request.data.get("collection") or DEFAULT_COLLECTION
+    size = request.data.get("size")
+    max_size = getattr(settings, "RAG_UPLOAD_MAX_SIZE", 2 * 1024**3)
+
+    if not name.lower().endswith(".pdf"):
+        return Response(
+            {"error": "Only PDF files are supported"}, status=status.HTTP_400_BAD_REQUEST
+        )
     try:
-        documents_dir = os.path.join(settings.MEDIA_ROOT, "documents")
-        os.makedirs(documents_dir, exist_ok=True)
+        validate_collection(collection)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    if isinstance(size, bool) or not isinstance(size, int) or not 0 < size <= max_size:
+        return Response(
+            {"error": f"size must be an integer between 1 and {max_size}"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    expire_sessions()
+    session = UploadSession.objects.create(
+        name=name,
+        collection=collection,
+        size=size,
+        part_size=getattr(settings, "RAG_UPLOAD_PART_SIZE", 8 * 1024**2),
+    )
+    return Response(_upload_session(session), status=status.HTTP_201_CREATED)
+
+
+@api_view(["GET"])
+def upload_status(request, upload_id):
+    """Report which parts of a resumable upload the server already has"""
+    try:
+        session = UploadSession.objects.get(pk=upload_id)
+    except UploadSession.DoesNotExist:
+        return Response({"error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+    return Response(_upload_session(session))
+
+
+@csrf_exempt
+@require_http_methods(["PUT"])
+def upload_part(request, upload_id, index):
+    """Store part ``index`` of a resumable upload from the raw request body; safe to retry"""
+    try:
+        session = UploadSession.objects.get(pk=upload_id)
+    except UploadSession.DoesNotExist:
+        return JsonResponse({"error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+    if session.file_hash:
+        return JsonResponse(
+            {"error": "Upload already completed"}, status=status.HTTP_409_CONFLICT
+        )
+    if not 0 <= index < session.part_count:
+        return JsonResponse(
+            {"error": f"index must be between 0 and {session.part_count - 1}"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    try:
+        # Streamed to disk: parts never sit in memory whole
+        write_part(session, index, iter(lambda: request.read(BLOCK_SIZE), b""))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return JsonResponse(
+        {"index": index, "received": len(received_parts(session)), "part_count": session.part_count}
+    )
 
-        processor = PDFProcessor()
-        rag_service = RAGService()
 
-        # Get all PDF files in the documents directory
-        pdf_files = [f for f in os.listdir(documents_dir) if f.lower().endswith(".pdf")]
-
-        processed_docs = []
-        total_chunks = 0
-
-        for pdf_file in pdf_files:
-            file_path = os.path.join(documents_dir, pdf_file)
-            try:
-                result = processor.process_pdf(file_path)
-                chunks = result["chunks"]
-
-                # Add to vector store
-                rag_service.add_documents(chunks)
-
-                # Update or create document in database
-                document, created = Document.objects.update_or_create(
-                    file_path=file_path,
-                    defaults={
-                        "name": result["name"],
-                        "file_type": result["file_type"],
-                        "chunk_count": len(chunks),
-                        "indexed": True,
-                    },
-                )
-
-                processed_docs.append(document)
-                total_chunks += len(chunks)
-            except Exception as e:
-                print(f"Error processing {file_path}: {e}")
+def _completed_upload(session: UploadSession) -> Dict[str, Any]:
+    """Response to repeating the request that completed an upload"""
+    job = IngestionJob.objects.filter(document_id=session.document_id).order_by("-created_at")
+    job = job.first()
+    return {
+        "id": session.document_id,
+        "name": session.name,
+        "collection": session.collection,
+        "job_id": job.id if job else None,
+        "status": job.status if job else IngestionJob.STATUS_COMPLETED,
+        "sha256": session.file_hash,
+        "message": "Upload already completed.",
+    }
 
+
+@api_view(["POST"])
+def complete_upload(request, upload_id):
+    """Assemble a resumable upload and queue it for processing; safe to retry
+
+    Parts are streamed into the documents directory while the file is
+    hashed, and content the collection already has indexed isn't indexed
+    again.
+    """
+    try:
+        try:
+            session = UploadSession.objects.get(pk=upload_id)
+        except UploadSession.DoesNotExist:
+            return Response({"error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+        if session.document_id is not None:
+            return Response(_completed_upload(session))
+
+        missing = sorted(set(range(session.part_count)) - set(received_parts(session)))
+        if missing:
+            return Response(
+                {"error": f"{len(missing)} parts missing", "missing": missing},
+                status=status.HTTP_409_CONFLICT,
+            )
+        # Only one request assembles the parts
+        claimed = UploadSession.objects.filter(pk=session.pk, file_hash="").update(
+            file_hash=ASSEMBLING
+        )
+        if not claimed:
+            return Response(
+                {"error": "Upload is already being completed"}, status=status.HTTP_409_CONFLICT
+            )
+
+        try:
+            file_path = _upload_path(session.name, session.collection)
+            tmp_path, file_hash, _ = stage_file(iter_parts(session), file_path)
+            payload, code = _finish_uploads(
+                [(session.name, file_path, tmp_path, file_hash)], session.collection
+            )
+        except BaseException:
+            UploadSession.objects.filter(pk=session.pk).update(file_hash="")
+            raise
+        if code >= 400:
+            # Keep the parts: completing again retries without re-sending them
+            UploadSession.objects.filter(pk=session.pk).update(file_hash="")
+            return Response(payload, status=code)
+
+        session.file_hash = file_hash
+        session.document_id = payload["id"]
+        session.save(update_fields=["file_hash", "document"])
+        discard_parts(session)
+        return Response({**payload, "sha256": file_hash}, status=code)
+    except Exception as e:
+        import traceback
+
+        return Response(
+            {"error": str(e), "traceback": traceback.format_exc()},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+@api_view(["GET"])
+def llm_status(request):
+    """Report LLM queue depth, wait times and generation throughput"""
+    # Polling the status must not load the model
+    scheduler = get_registry().loaded_scheduler()
+    if scheduler is None:
+        return Response({"loaded": False})
+    return Response({"loaded": True, **scheduler.metrics()})
+
+
+@api_view(["GET"])
+def list_collections(request):
+    """List the collections documents were uploaded to, with their sizes"""
+    rows = (
+        Document.objects.values("collection")
+        .annotate(documents=Count("id"), chunks=Sum("chunk_count"))
+        .order_by("collection")
+    )
+    collections = {row["collection"]: row for row in rows}
+    collections.setdefault(
+        DEFAULT_COLLECTION, {"collection": DEFAULT_COLLECTION, "documents": 0, "chunks": 0}
+    )
+    return Response(
+        {
+            "default": DEFAULT_COLLECTION,
+            "collections": [
+                {"name": name, "documents": row["documents"], "chunks": row["chunks"] or 0}
+                for name, row in sorted(collections.items())
+            ],
+        }
+    )
+
+
+@require_GET
+def metrics(request):
+    """Stage latency histograms and counters in the Prometheus text format"""
+    gauges = {"rag_ingestion_pending": get_pipeline().pending}
+    # Report the LLM queue only once it exists: a scrape must not load a model
+    scheduler = get_registry().loaded_scheduler()
+    if scheduler is not None:
+        state = scheduler.metrics()
+        gauges["rag_llm_queue_depth"] = state["queue_depth"]
+        gauges["rag_llm_busy_slots"] = state["busy_slots"]
+        gauges["rag_llm_slots"] = state["slots"]
+    return HttpResponse(
+        tracing.metrics.render(gauges), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@api_view(["GET"])
+def job_status(request, job_id):
+    """Report the progress of a background ingestion job"""
+    try:
+        job = IngestionJob.objects.select_related("document").get(pk=job_id)
+    except IngestionJob.DoesNotExist:
+        return Response({"error": "Job not found"}, status=status.HTTP_404_NOT_FOUND)
+
+    return Response(
+        {
+            "id": job.id,
+            "document_id": job.document_id,
+            "document_name": job.document.name,
+            "status": job.status,
+            "stage": job.stage,
+            "pages_parsed": job.pages_parsed,
+            "pages_total": job.pages_total,
+            "chunks_total": job.chunks_total,
+            "chunks_embedded": job.chunks_embedded,
+            "error": job.error,
+            "created_at": job.created_at,
+            "updated_at": job.updated_at,
+        }
+    )
+
+
+@api_view(["GET"])
+def chunk_text(request, document_id, chunk_id):
+    """Full text of a cited chunk, optionally with ``?context=N`` chunks around it"""
+    try:
+        context = int(request.query_params.get("context", 0))
+    except ValueError:
+        context = -1
+    if not 0 <= context <= MAX_CITATION_CONTEXT:
         return Response(
-            {
-                "success": True,
-                "documents_processed": len(processed_docs),
-                "total_chunks": total_chunks,
-                "message": f"Successfully processed {len(processed_docs)} documents with {total_chunks} chunks.",
-            }
+            {"error": f"context must be an integer between 0 and {MAX_CITATION_CONTEXT}"},
+            status=status.HTTP_400_BAD_REQUEST,
         )
+
+    try:
+        document = Document.objects.get(pk=document_id)
+    except Document.DoesNotExist:
+        return Response({"error": "Document not found"}, status=status.HTTP_404_NOT_FOUND)
+
+    chunk = ChromaDBService(collection_name=document.collection).chunk_text(
+        document, chunk_id, context
+    )
+    if chunk is None:
+        return Response({"error": "Chunk not found"}, status=status.HTTP_404_NOT_FOUND)
+    return Response(
+        {
+            "document_id": document.id,
+            "document_name": document.name,
+            "collection": document.collection,
+            **chunk,
+        }
+    )
+
+
+@api_view(["POST"])
+def rebuild_index(request):
+    """Incrementally rebuild one collection's vector index from stored documents"""
+    try:
+        full = request.data.get("full", False)
+        # Form posts send strings
+        if isinstance(full, str):
+            full = {"true": True, "1": True, "false": False, "0": False}.get(full.lower(), full)
+        if not isinstance(full, bool):
+            return Response(
+                {"error": "full must be a boolean"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        collection = request.data.get("collection") or DEFAULT_COLLECTION
+        try:
+            chroma = ChromaDBService(collection_name=collection)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(chroma.rebuild_index(full=full))
     except Exception as e:
         import traceback
 
@@ -12,5 +12,10 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ragBackend.settings')
+# Serve queries and uploads from the async views (see rag/urls.py)
+os.environ.setdefault('RAG_ASYNC_VIEWS', '1')
+
+# Load the models as the server starts instead of on the first request
+os.environ.setdefault('RAG_WARMUP_ON_STARTUP', '1')
 
 application = get_asgi_application()
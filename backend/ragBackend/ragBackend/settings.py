@@ -83,6 +83,10 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Ingestion jobs write from worker threads while tests poll them; an
+        # in-memory test database fails those with "table is locked" instead
+        # of waiting
+        "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
     }
 }
 
@@ -150,3 +154,146 @@ CORS_ALLOWED_ORIGINS = [
     "http://127.0.0.1:4200",
 ]
 CORS_ALLOW_CREDENTIALS = True
+# Let the frontend read how long to back off after a 429
+CORS_EXPOSE_HEADERS = ["Retry-After"]
+
+# Logging: the rag app's warnings and errors (failed ingestion jobs, model
+# warm-up, PDF parsing) go to the console
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "rag": {"handlers": ["console"], "level": os.environ.get("RAG_LOG_LEVEL", "INFO")},
+    },
+}
+
+# RAG model settings
+# "default" loads HuggingFace embeddings + llama.cpp, "fake" loads deterministic
+# stand-ins that need no GPU or model files (tests, benchmarks)
+RAG_MODEL_BACKEND = os.environ.get("RAG_MODEL_BACKEND", "default")
+RAG_LLM_MODEL_PATH = os.environ.get(
+    "RAG_LLM_MODEL_PATH", "/home/sred/models/DeepSeek-R1-Distill-Qwen-7B-Q6_K.gguf"
+)
+# Load the models in the background when a server process starts. Off by default
+# so tests and management commands never load them; asgi.py and wsgi.py turn it
+# on for deployed servers (set it to 1 for runserver too)
+RAG_WARMUP_ON_STARTUP = os.environ.get("RAG_WARMUP_ON_STARTUP", "0") == "1"
+
+# LLM scheduler: model instances serving generations in parallel (each loads
+# its own copy of the weights) and queued generations accepted before
+# answering 429. The fake LLM's per-token delay simulates decode for load tests
+RAG_LLM_SLOTS = int(os.environ.get("RAG_LLM_SLOTS", "1"))
+RAG_LLM_QUEUE_LIMIT = int(os.environ.get("RAG_LLM_QUEUE_LIMIT", "16"))
+RAG_FAKE_LLM_TOKEN_MS = float(os.environ.get("RAG_FAKE_LLM_TOKEN_MS", "0"))
+
+# Batch queries (/api/query/batch/): questions accepted per request and the
+# generations a batch keeps queued at once (at most half of RAG_LLM_QUEUE_LIMIT)
+RAG_BATCH_MAX_QUERIES = int(os.environ.get("RAG_BATCH_MAX_QUERIES", "500"))
+RAG_BATCH_CONCURRENCY = int(os.environ.get("RAG_BATCH_CONCURRENCY", "4"))
+
+# Async query and upload views (asgi.py turns them on) and the thread pools
+# they offload blocking work to: retrieval (embedding, Chroma, answer cache)
+# and file I/O
+RAG_ASYNC_VIEWS = os.environ.get("RAG_ASYNC_VIEWS", "0") == "1"
+RAG_ASYNC_RETRIEVAL_WORKERS = int(os.environ.get("RAG_ASYNC_RETRIEVAL_WORKERS", "8"))
+RAG_ASYNC_IO_WORKERS = int(os.environ.get("RAG_ASYNC_IO_WORKERS", "4"))
+
+# Background ingestion: worker threads, concurrent embedding jobs (GPU bound),
+# the number of queued uploads accepted before rejecting new ones and the
+# chunks embedded and upserted per window while streaming an upload
+RAG_INGEST_WORKERS = int(os.environ.get("RAG_INGEST_WORKERS", "2"))
+RAG_MAX_CONCURRENT_EMBED_JOBS = int(os.environ.get("RAG_MAX_CONCURRENT_EMBED_JOBS", "1"))
+RAG_INGEST_QUEUE_LIMIT = int(os.environ.get("RAG_INGEST_QUEUE_LIMIT", "100"))
+RAG_INGEST_WINDOW = int(os.environ.get("RAG_INGEST_WINDOW", "64"))
+
+# Embedding engine: batch size, query micro-batching window (0 disables),
+# device ("auto" falls back to CPU without CUDA) and CPU threads (0 = all cores)
+RAG_EMBEDDING_BATCH_SIZE = int(os.environ.get("RAG_EMBEDDING_BATCH_SIZE", "32"))
+RAG_EMBEDDING_MICRO_BATCH_MS = float(os.environ.get("RAG_EMBEDDING_MICRO_BATCH_MS", "5"))
+RAG_EMBEDDING_DEVICE = os.environ.get("RAG_EMBEDDING_DEVICE", "auto")
+RAG_EMBEDDING_CPU_THREADS = int(os.environ.get("RAG_EMBEDDING_CPU_THREADS", "0"))
+
+# Persistent embedding cache keyed by (model, chunk hash); empty dir disables it
+RAG_EMBEDDING_CACHE_DIR = os.environ.get(
+    "RAG_EMBEDDING_CACHE_DIR", os.path.join(BASE_DIR, "embedding_cache")
+)
+RAG_EMBEDDING_CACHE_MAX_ENTRIES = int(
+    os.environ.get("RAG_EMBEDDING_CACHE_MAX_ENTRIES", "500000")
+)
+
+# Answer cache: entries kept per process and the cosine similarity above which
+# a past question counts as the same question (set above 1 to disable)
+RAG_ANSWER_CACHE_SIZE = int(os.environ.get("RAG_ANSWER_CACHE_SIZE", "256"))
+RAG_ANSWER_CACHE_SIMILARITY = float(os.environ.get("RAG_ANSWER_CACHE_SIMILARITY", "0.95"))
+# Seconds the corpus version (a query over the documents table) is trusted
+# for; changes made by this process invalidate the cache immediately, other
+# workers' uploads and rebuilds are noticed at most this late
+RAG_ANSWER_CACHE_VERSION_TTL = float(os.environ.get("RAG_ANSWER_CACHE_VERSION_TTL", "2"))
+
+# Chunking: splitter chunk size and overlap in characters. Changing them only
+# affects new uploads until `python manage.py rechunk` re-splits the rest
+RAG_CHUNK_SIZE = int(os.environ.get("RAG_CHUNK_SIZE", "1000"))
+RAG_CHUNK_OVERLAP = int(os.environ.get("RAG_CHUNK_OVERLAP", "200"))
+
+# Extracted page text keyed by PDF content hash, so re-chunking and rebuilds
+# don't parse a PDF twice; empty dir disables it
+RAG_TEXT_CACHE_DIR = os.environ.get("RAG_TEXT_CACHE_DIR", os.path.join(MEDIA_ROOT, "text_cache"))
+
+# Resumable uploads (/api/uploads/): part size the client must send, largest
+# file accepted and hours before an unfinished upload's parts are dropped
+RAG_UPLOAD_PART_SIZE = int(os.environ.get("RAG_UPLOAD_PART_SIZE", str(8 * 1024**2)))
+RAG_UPLOAD_MAX_SIZE = int(os.environ.get("RAG_UPLOAD_MAX_SIZE", str(2 * 1024**3)))
+RAG_UPLOAD_SESSION_HOURS = int(os.environ.get("RAG_UPLOAD_SESSION_HOURS", "24"))
+
+# PDF parsing process pool used by rebuilds and bulk uploads: worker processes
+# (0 = one per core) and pages per task, so large files spread across workers
+RAG_PDF_WORKERS = int(os.environ.get("RAG_PDF_WORKERS", "0"))
+RAG_PDF_PAGES_PER_TASK = int(os.environ.get("RAG_PDF_PAGES_PER_TASK", "50"))
+
+# Default retrieval mode when a query doesn't pick one: "vector" (MMR over
+# embeddings), "keyword" (BM25) or "hybrid" (both, reciprocal-rank fused)
+RAG_RETRIEVAL_MODE = os.environ.get("RAG_RETRIEVAL_MODE", "hybrid")
+
+# Vector retrieval (overridable per request): MMR picks RAG_RETRIEVAL_K chunks
+# out of the RAG_MMR_FETCH_K nearest (at least twice k), trading relevance (1)
+# for diversity (0) by RAG_MMR_LAMBDA. Requests may ask for up to
+# RAG_MMR_MAX_FETCH_K candidates
+RAG_RETRIEVAL_K = int(os.environ.get("RAG_RETRIEVAL_K", "10"))
+RAG_MMR_FETCH_K = int(os.environ.get("RAG_MMR_FETCH_K", "20"))
+RAG_MMR_LAMBDA = float(os.environ.get("RAG_MMR_LAMBDA", "0.5"))
+RAG_MMR_MAX_FETCH_K = int(os.environ.get("RAG_MMR_MAX_FETCH_K", "200"))
+
+# Query embeddings kept in memory, keyed by whitespace-normalized text (0 disables)
+RAG_QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("RAG_QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+
+# Threads searching the collections of one multi-collection query in parallel
+RAG_SEARCH_WORKERS = int(os.environ.get("RAG_SEARCH_WORKERS", "8"))
+
+# Vector engine: "chroma", or "compact" (memory-mapped int8/float16 segments
+# with float32 rescoring, in compact_index/). Switching doesn't move vectors:
+# run `python manage.py rebuild_index --full` afterwards
+RAG_VECTOR_BACKEND = os.environ.get("RAG_VECTOR_BACKEND", "chroma")
+RAG_COMPACT_PRECISION = os.environ.get("RAG_COMPACT_PRECISION", "int8")
+# Candidates rescored in float32, as a multiple of the results asked for
+RAG_COMPACT_RESCORE = int(os.environ.get("RAG_COMPACT_RESCORE", "4"))
+# Segments kept before the smaller half is merged in the background
+RAG_COMPACT_MAX_SEGMENTS = int(os.environ.get("RAG_COMPACT_MAX_SEGMENTS", "8"))
+
+# Token budget for retrieved chunks in the prompt (overridable per request);
+# always capped to what the context window leaves after the answer budget
+RAG_CONTEXT_TOKENS = int(os.environ.get("RAG_CONTEXT_TOKENS", "2048"))
+
+# Cross-encoder rerank stage (overridable per request): retrieve
+# RAG_RERANK_CANDIDATES chunks, keep the best RAG_RERANK_TOP_N. Candidates not
+# scored within RAG_RERANK_BUDGET_MS keep their retrieval order
+RAG_RERANK = os.environ.get("RAG_RERANK", "0") == "1"
+RAG_RERANK_MODEL = os.environ.get("RAG_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RAG_RERANK_CANDIDATES = int(os.environ.get("RAG_RERANK_CANDIDATES", "40"))
+RAG_RERANK_TOP_N = int(os.environ.get("RAG_RERANK_TOP_N", "10"))
+RAG_RERANK_BATCH_SIZE = int(os.environ.get("RAG_RERANK_BATCH_SIZE", "16"))
+RAG_RERANK_BUDGET_MS = int(os.environ.get("RAG_RERANK_BUDGET_MS", "200"))
+
+# Per-stage latency histograms and counters served at /api/metrics/. Off, spans
+# cost nothing unless a request asks for its own breakdown ("trace": true)
+RAG_METRICS = os.environ.get("RAG_METRICS", "1") == "1"
@@ -13,4 +13,7 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ragBackend.settings')
 
+# Load the models as the server starts instead of on the first request
+os.environ.setdefault('RAG_WARMUP_ON_STARTUP', '1')
+
 application = get_wsgi_application()
@@ -20,7 +20,7 @@ import { MatExpansionModule } from '@angular/material/expansion';
 import { MatTooltipModule } from '@angular/material/tooltip';
 
 // Service
-import { RagService } from '../services/rag.service';
+import { QueryBusyError, RagService } from '../services/rag.service';
 
 interface ChatMessage {
   isUser: boolean;
@@ -95,27 +95,25 @@ export class RagSystemComponent {
     this.isUploading = true;
     this.uploadProgress = 0;
 
-    const formData = new FormData();
-    formData.append('file', this.selectedFile);
-
-    // Simulate upload progress
-    const interval = setInterval(() => {
-      this.uploadProgress += 5;
-      if (this.uploadProgress >= 100) {
-        clearInterval(interval);
-      }
-    }, 100);
-
-    this.ragService.uploadDocument(formData).subscribe({
-      next: (response) => {
-        clearInterval(interval);
-        this.uploadProgress = 100;
-        this.isUploading = false;
-        this.snackBar.open(`Uploaded ${response.name} with ${response.chunk_count} chunks`, 'Close', { duration: 5000 });
+    this.ragService.uploadDocument(this.selectedFile).subscribe({
+      next: (event) => {
+        if (event.type === 'progress') {
+          this.uploadProgress = Math.round((event.uploaded / event.total) * 100);
+          return;
+        }
         this.selectedFile = null;
+        const response = event.response;
+        if (!response.job_id) {
+          // The same content was already indexed
+          this.isUploading = false;
+          this.uploadProgress = 0;
+          this.snackBar.open(`${response.name} is already indexed`, 'Close', { duration: 5000 });
+          return;
+        }
+        this.uploadProgress = 0;
+        this.watchIngestion(response.job_id);
       },
       error: (error) => {
-        clearInterval(interval);
         this.isUploading = false;
         this.uploadProgress = 0;
         console.error('Upload error:', error);
@@ -124,6 +122,39 @@ export class RagSystemComponent {
     });
   }
 
+  private watchIngestion(jobId: string): void {
+    this.ragService.watchJob(jobId).subscribe({
+      next: (job) => {
+        // Parsing/splitting count as the first 20%, embedding as the rest
+        if (job.chunks_total > 0) {
+          this.uploadProgress = 20 + Math.round((job.chunks_embedded / job.chunks_total) * 80);
+        } else if (job.pages_total > 0) {
+          // Streamed uploads embed while parsing, so pages track overall progress
+          this.uploadProgress = Math.round((job.pages_parsed / job.pages_total) * 100);
+        } else if (job.pages_parsed > 0) {
+          this.uploadProgress = 10;
+        }
+
+        if (job.status === 'completed') {
+          this.uploadProgress = 100;
+          this.isUploading = false;
+          this.snackBar.open(`Indexed ${job.document_name} with ${job.chunks_total} chunks`, 'Close', { duration: 5000 });
+        } else if (job.status === 'failed') {
+          this.isUploading = false;
+          this.uploadProgress = 0;
+          console.error('Ingestion error:', job.error);
+          this.snackBar.open('Error processing document', 'Close', { duration: 3000 });
+        }
+      },
+      error: (error) => {
+        this.isUploading = false;
+        this.uploadProgress = 0;
+        console.error('Error checking upload status:', error);
+        this.snackBar.open('Error checking upload status', 'Close', { duration: 3000 });
+      }
+    });
+  }
+
   rebuildIndex(): void {
     if (this.isRebuildingIndex) return;
 
@@ -133,7 +164,7 @@ export class RagSystemComponent {
     this.ragService.rebuildIndex().subscribe({
       next: (response) => {
         this.isRebuildingIndex = false;
-        this.snackBar.open(`Index rebuilt! Processed ${response.documents_processed} documents with ${response.total_chunks} chunks`, 'Close', { duration: 5000 });
+        this.snackBar.open(`Index rebuilt! ${response.message}`, 'Close', { duration: 5000 });
       },
       error: (error) => {
         this.isRebuildingIndex = false;
@@ -164,29 +195,49 @@ export class RagSystemComponent {
     // Scroll to bottom
     setTimeout(() => this.scrollToBottom(), 50);
 
-    // Send query to API
-    this.ragService.query(queryText).subscribe({
-      next: (response) => {
-        // Add AI response
-        this.messages.push({
-          isUser: false,
-          text: response.answer,
-          timestamp: new Date(),
-          sources: response.sources
-        });
-
-        this.isProcessing = false;
+    // Stream the answer from the API
+    let aiMessage: ChatMessage | null = null;
+
+    this.ragService.queryStream(queryText).subscribe({
+      next: (event) => {
+        switch (event.event) {
+          case 'sources':
+            // Add AI response as soon as the sources are known
+            aiMessage = {
+              isUser: false,
+              text: '',
+              timestamp: new Date(),
+              sources: event.data.sources
+            };
+            this.messages.push(aiMessage);
+            break;
+          case 'token':
+            if (aiMessage) {
+              aiMessage.text += event.data.text;
+            }
+            break;
+          case 'done':
+            if (aiMessage) {
+              aiMessage.text = event.data.answer;
+            }
+            break;
+        }
 
         // Scroll to bottom
         setTimeout(() => this.scrollToBottom(), 100);
       },
+      complete: () => {
+        this.isProcessing = false;
+      },
       error: (error) => {
         console.error('Error querying:', error);
 
         // Add error message
         this.messages.push({
           isUser: false,
-          text: 'Sorry, I encountered an error processing your query.',
+          text: error instanceof QueryBusyError
+            ? `The server is busy right now, please try again in ${error.retryAfter} seconds.`
+            : 'Sorry, I encountered an error processing your query.',
           timestamp: new Date()
         });
 
@@ -1,33 +1,210 @@
 // src/app/services/rag.service.ts
 import { Injectable } from '@angular/core';
-import { HttpClient } from '@angular/common/http';
-import { Observable } from 'rxjs';
+import { HttpClient, HttpErrorResponse } from '@angular/common/http';
+import { Observable, concat, from, of, throwError, timer } from 'rxjs';
+import { catchError, map, mergeMap, retry, switchMap, takeWhile, tap } from 'rxjs/operators';
 import { environment } from '../../environments/environment';
 
+export interface QueryTiming {
+  total_ms?: number;
+  retrieval_ms?: number;
+  ttft_ms?: number;
+  generation_ms?: number;
+  prompt_tokens?: number;
+  rerank_ms?: number;
+  rerank_cached?: number;
+  rerank_scored?: number;
+  rerank_fallback?: boolean;
+  queue_wait_ms?: number;
+  completion_tokens?: number;
+  tokens_per_s?: number;
+  prefill_ms?: number;
+  decode_ms?: number;
+}
+
+/** Milliseconds per pipeline stage (embed_query, vector_search, llm_decode, ...) */
+export type QueryTrace = Record<string, number>;
+
+export type CacheStatus = 'hit' | 'miss' | 'semantic';
+
+/** vector: MMR over embeddings, keyword: BM25, hybrid: both fused (server default) */
+export type RetrievalMode = 'vector' | 'keyword' | 'hybrid';
+
+export interface QueryOptions {
+  mode?: RetrievalMode;
+  /** Token budget for retrieved context (server default when omitted) */
+  context_tokens?: number;
+  /** Rerank a wider candidate set with the cross-encoder (server default when omitted) */
+  rerank?: boolean;
+  /** Return a per-stage latency breakdown */
+  trace?: boolean;
+  /** Collections to search (server default collection when omitted) */
+  collections?: string[];
+  filters?: QueryFilters;
+  /** Chunks retrieved per collection (server default when omitted) */
+  k?: number;
+  /** Nearest chunks MMR picks the k from (server default when omitted) */
+  fetch_k?: number;
+  /** MMR weight of relevance (1) against diversity (0) */
+  lambda_mult?: number;
+}
+
+/** Restrict retrieval to some documents and pages; all conditions must hold */
+export interface QueryFilters {
+  document_ids?: string[];
+  document_names?: string[];
+  /** Page range, numbered as `page` in the sources */
+  page_min?: number;
+  page_max?: number;
+  /** ISO 8601 upload time bounds */
+  created_after?: string;
+  created_before?: string;
+}
+
 export interface QueryResponse {
   answer: string;
   sources: DocumentSource[];
-  timing: {
-    total_ms: number;
-  };
+  cache: CacheStatus;
+  timing: QueryTiming;
+  trace?: QueryTrace;
+}
+
+export type QueryStreamEvent =
+  | { event: 'sources'; data: { sources: DocumentSource[]; timing: QueryTiming } }
+  | { event: 'token'; data: { text: string } }
+  | { event: 'done'; data: { answer: string; cache: CacheStatus; timing: QueryTiming; trace?: QueryTrace } }
+  | { event: 'error'; data: { error: string; retry_after?: number } };
+
+export interface QueryBatchOptions extends Omit<QueryOptions, 'trace'> {
+  /** Generations the batch keeps queued at once (server default when omitted) */
+  concurrency?: number;
+}
+
+export interface QueryBatchStats {
+  questions: number;
+  unique_questions: number;
+  answered: number;
+  failed: number;
+  cache_hits: number;
+  completion_tokens: number;
+  /** Chunks packed into prompts, and how many of them were distinct */
+  context_chunks: number;
+  unique_context_chunks: number;
+  retrieval_ms: number;
+  total_ms: number;
+  questions_per_s: number;
+  tokens_per_s: number;
+}
+
+/** One line of a batch; `index` is the question's position in the request */
+export type QueryBatchEvent =
+  | { event: 'answer'; data: QueryResponse & { index: number; query: string } }
+  | { event: 'error'; data: { index?: number; query?: string; error: string } }
+  | { event: 'stats'; data: QueryBatchStats };
+
+/** The server's LLM queue is full; retry after `retryAfter` seconds */
+export class QueryBusyError extends Error {
+  constructor(message: string, readonly retryAfter: number) {
+    super(message);
+  }
 }
 
 export interface DocumentSource {
   id: string | number;
+  document_id?: string;
   document_name: string;
   page?: number;
   source: string;
+  collection?: string;
+  content_preview?: string;
+  /** Every chunk of the document used for the answer; fetch one with getCitation() */
+  chunks?: { id: number; page: number }[];
+}
+
+export interface Citation {
+  document_id: string;
+  document_name: string;
+  collection: string;
+  chunk_id: number;
+  page: number;
+  /** The chunk, plus the neighbouring chunks that were asked for */
+  text: string;
+  /** Where the chunk itself sits in `text` */
+  chunk_start: number;
+  chunk_end: number;
+  first_chunk_id: number;
+  last_chunk_id: number;
 }
 
 export interface UploadResponse {
   id: string;
   name: string;
-  chunk_count: number;
+  collection: string;
+  /**
+   * Absent when the collection already had this content indexed; for a duplicate
+   * of an upload still being ingested, the job of that upload
+   */
+  job_id?: string;
+  status?: IngestionJob['status'];
+  duplicate?: boolean;
+  sha256?: string;
   message: string;
 }
 
+/** A resumable upload: the file is sent as `part_count` parts of `part_size` bytes */
+export interface UploadSession {
+  id: string;
+  name: string;
+  collection: string;
+  size: number;
+  part_size: number;
+  part_count: number;
+  /** Indexes of the parts the server already has */
+  received: number[];
+  completed: boolean;
+}
+
+export type UploadEvent =
+  | { type: 'progress'; uploaded: number; total: number }
+  | { type: 'complete'; response: UploadResponse };
+
+/** Parts sent at once, and attempts per request before an upload fails */
+const UPLOAD_CONCURRENCY = 4;
+const UPLOAD_RETRIES = 5;
+
+export interface IngestionJob {
+  id: string;
+  document_id: string;
+  document_name: string;
+  status: 'queued' | 'running' | 'completed' | 'failed';
+  stage: '' | 'parse' | 'split' | 'embed' | 'upsert';
+  pages_parsed: number;
+  pages_total: number;
+  chunks_total: number;
+  chunks_embedded: number;
+  error: string;
+}
+
+export interface Collection {
+  name: string;
+  documents: number;
+  chunks: number;
+}
+
+export interface CollectionsResponse {
+  default: string;
+  collections: Collection[];
+}
+
 export interface RebuildIndexResponse {
   success: boolean;
+  collection: string;
+  full: boolean;
+  added: number;
+  updated: number;
+  removed: number;
+  skipped: number;
+  failed: number;
   documents_processed: number;
   total_chunks: number;
   message: string;
@@ -41,15 +218,246 @@ export class RagService {
 
   constructor(private http: HttpClient) { }
 
-  query(queryText: string): Observable<QueryResponse> {
-    return this.http.post<QueryResponse>(`${this.apiUrl}/query/`, { query: queryText });
+  query(queryText: string, options: QueryOptions = {}): Observable<QueryResponse> {
+    return this.http.post<QueryResponse>(`${this.apiUrl}/query/`, { query: queryText, ...options });
+  }
+
+  /**
+   * Stream a query as Server-Sent Events: sources first, then one event per
+   * generated token, then a final event with the full answer and timing.
+   * Unsubscribing aborts the request.
+   */
+  queryStream(queryText: string, options: QueryOptions = {}): Observable<QueryStreamEvent> {
+    return new Observable<QueryStreamEvent>(subscriber => {
+      const controller = new AbortController();
+
+      const read = async () => {
+        const response = await fetch(`${this.apiUrl}/query/stream/`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+          body: JSON.stringify({ query: queryText, ...options }),
+          signal: controller.signal
+        });
+        if (response.status === 429) {
+          // The body carries the delay too, for when CORS hides Retry-After
+          const body = await response.json().catch(() => ({}));
+          const retryAfter =
+            Number(body.retry_after) || Number(response.headers.get('Retry-After')) || 1;
+          throw new QueryBusyError(body.error || 'The server is busy', retryAfter);
+        }
+        if (!response.ok || !response.body) {
+          throw new Error(`Query failed with status ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+
+          // Events are separated by a blank line
+          let boundary = buffer.indexOf('\n\n');
+          while (boundary !== -1) {
+            const event = this.parseSseEvent(buffer.slice(0, boundary));
+            buffer = buffer.slice(boundary + 2);
+            if (event) {
+              if (event.event === 'error') {
+                if (event.data.retry_after) {
+                  throw new QueryBusyError(event.data.error, event.data.retry_after);
+                }
+                throw new Error(event.data.error);
+              }
+              subscriber.next(event);
+            }
+            boundary = buffer.indexOf('\n\n');
+          }
+        }
+        subscriber.complete();
+      };
+
+      read().catch(error => {
+        if (!controller.signal.aborted) {
+          subscriber.error(error);
+        }
+      });
+
+      return () => controller.abort();
+    });
+  }
+
+  /**
+   * Answer many questions in one request. Answers arrive as they finish, in
+   * any order, then the batch stats. Unsubscribing aborts the request and
+   * the server cancels the generations still queued.
+   */
+  queryBatch(queries: string[], options: QueryBatchOptions = {}): Observable<QueryBatchEvent> {
+    return new Observable<QueryBatchEvent>(subscriber => {
+      const controller = new AbortController();
+
+      const read = async () => {
+        const response = await fetch(`${this.apiUrl}/query/batch/`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json', 'Accept': 'application/x-ndjson' },
+          body: JSON.stringify({ queries, ...options }),
+          signal: controller.signal
+        });
+        if (!response.ok || !response.body) {
+          throw new Error(`Batch query failed with status ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+
+          // One JSON object per line
+          let newline = buffer.indexOf('\n');
+          while (newline !== -1) {
+            const line = buffer.slice(0, newline).trim();
+            buffer = buffer.slice(newline + 1);
+            if (line) {
+              const event = JSON.parse(line) as QueryBatchEvent;
+              // Without an index the whole batch failed
+              if (event.event === 'error' && event.data.index === undefined) {
+                throw new Error(event.data.error);
+              }
+              subscriber.next(event);
+            }
+            newline = buffer.indexOf('\n');
+          }
+        }
+        subscriber.complete();
+      };
+
+      read().catch(error => {
+        if (!controller.signal.aborted) {
+          subscriber.error(error);
+        }
+      });
+
+      return () => controller.abort();
+    });
+  }
+
+  /**
+   * Upload a PDF as parts sent in parallel, each retried with backoff, then
+   * have the server assemble and queue it. Emits progress, then the server's
+   * response. An interrupted upload of the same file resumes where it stopped.
+   */
+  uploadDocument(file: File, collection?: string): Observable<UploadEvent> {
+    const key = `rag-upload:${collection ?? ''}:${file.name}:${file.size}:${file.lastModified}`;
+
+    return this.openUpload(file, collection, key).pipe(
+      switchMap(session => {
+        const partBytes = (index: number) =>
+          Math.min(session.part_size, session.size - index * session.part_size);
+        const received = new Set(session.received);
+        const pending = Array.from({ length: session.part_count }, (_, i) => i)
+          .filter(index => !received.has(index));
+        let uploaded = session.received.reduce((sum, index) => sum + partBytes(index), 0);
+
+        const parts = from(pending).pipe(
+          mergeMap(index => this.uploadPart(session, file, index).pipe(
+            map((): UploadEvent => {
+              uploaded += partBytes(index);
+              return { type: 'progress', uploaded, total: session.size };
+            })
+          ), UPLOAD_CONCURRENCY)
+        );
+        const complete = this.http.post<UploadResponse>(
+          `${this.apiUrl}/uploads/${session.id}/complete/`, {}
+        ).pipe(
+          retry({ count: UPLOAD_RETRIES, delay: (error, attempt) => this.retryDelay(error, attempt) }),
+          tap(() => localStorage.removeItem(key)),
+          map((response): UploadEvent => ({ type: 'complete', response }))
+        );
+
+        const started: UploadEvent = { type: 'progress', uploaded, total: session.size };
+        return concat(of(started), parts, complete);
+      })
+    );
+  }
+
+  /** The unfinished upload of this file if the server still has it, else a new one */
+  private openUpload(file: File, collection: string | undefined, key: string): Observable<UploadSession> {
+    const start = () => this.http.post<UploadSession>(`${this.apiUrl}/uploads/`, {
+      name: file.name, size: file.size, collection
+    }).pipe(tap(session => localStorage.setItem(key, session.id)));
+
+    const id = localStorage.getItem(key);
+    if (!id) {
+      return start();
+    }
+    return this.http.get<UploadSession>(`${this.apiUrl}/uploads/${id}/`).pipe(
+      catchError(error => error.status === 404 ? start() : throwError(() => error))
+    );
+  }
+
+  private uploadPart(session: UploadSession, file: File, index: number): Observable<unknown> {
+    const offset = index * session.part_size;
+    return this.http.put(
+      `${this.apiUrl}/uploads/${session.id}/parts/${index}/`,
+      file.slice(offset, offset + session.part_size),
+      { headers: { 'Content-Type': 'application/octet-stream' } }
+    ).pipe(
+      retry({ count: UPLOAD_RETRIES, delay: (error, attempt) => this.retryDelay(error, attempt) })
+    );
+  }
+
+  /** Back off 0.5 s, 1 s, 2 s, ... after network and server errors; fail on the rest */
+  private retryDelay(error: unknown, attempt: number): Observable<number> {
+    const status = error instanceof HttpErrorResponse ? error.status : 0;
+    if (status !== 0 && status !== 429 && status < 500) {
+      return throwError(() => error);
+    }
+    return timer(500 * 2 ** (attempt - 1));
+  }
+
+  getJob(jobId: string): Observable<IngestionJob> {
+    return this.http.get<IngestionJob>(`${this.apiUrl}/jobs/${jobId}/`);
+  }
+
+  /** Poll an ingestion job until it completes or fails, emitting every update */
+  watchJob(jobId: string, intervalMs = 1000): Observable<IngestionJob> {
+    return timer(0, intervalMs).pipe(
+      switchMap(() => this.getJob(jobId)),
+      takeWhile(job => job.status === 'queued' || job.status === 'running', true)
+    );
+  }
+
+  /** Full text of a cited chunk, with up to `context` neighbouring chunks on each side */
+  getCitation(documentId: string, chunkId: number, context = 0): Observable<Citation> {
+    return this.http.get<Citation>(`${this.apiUrl}/documents/${documentId}/chunks/${chunkId}/`, {
+      params: { context }
+    });
+  }
+
+  listCollections(): Observable<CollectionsResponse> {
+    return this.http.get<CollectionsResponse>(`${this.apiUrl}/collections/`);
   }
 
-  uploadDocument(formData: FormData): Observable<UploadResponse> {
-    return this.http.post<UploadResponse>(`${this.apiUrl}/upload/`, formData);
+  rebuildIndex(full = false, collection?: string): Observable<RebuildIndexResponse> {
+    return this.http.post<RebuildIndexResponse>(`${this.apiUrl}/rebuild-index/`, { full, collection });
   }
 
-  rebuildIndex(): Observable<RebuildIndexResponse> {
-    return this.http.post<RebuildIndexResponse>(`${this.apiUrl}/rebuild-index/`, {});
+  private parseSseEvent(raw: string): QueryStreamEvent | null {
+    let event = 'message';
+    const data: string[] = [];
+    for (const line of raw.split('\n')) {
+      if (line.startsWith('event:')) {
+        event = line.slice(6).trim();
+      } else if (line.startsWith('data:')) {
+        data.push(line.slice(5).trim());
+      }
+    }
+    if (!data.length) return null;
+    return { event, data: JSON.parse(data.join('\n')) } as QueryStreamEvent;
   }
 }